@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Benchmark the built-in DNS engine against massdns on a local stub DNS server
+
+Example:
+    python3 benchmark/bench_dns.py --count 100000
+    python3 benchmark/bench_dns.py --count 100000 --concurrent 5000 --massdns False
+    python3 benchmark/bench_dns.py --massdns_path /usr/local/bin/massdns
+"""
+
+import asyncio
+import multiprocessing
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common import dnsengine, utils  # noqa: E402
+from config import settings  # noqa: E402
+
+
+class StubProtocol(asyncio.DatagramProtocol):
+    """
+    Answer every A query with 10.0.0.1, names beginning with nx get NXDOMAIN
+    """
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        end = data.index(b'\x00', 12) + 5
+        question = data[12:end]
+        if question[1:3] == b'nx':
+            header = data[:2] + b'\x81\x83' + struct.pack('>HHHH', 1, 0, 0, 0)
+            self.transport.sendto(header + question, addr)
+            return
+        header = data[:2] + b'\x81\x80' + struct.pack('>HHHH', 1, 1, 0, 0)
+        answer = b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x01\x2c\x00\x04\x0a\x00\x00\x01'
+        self.transport.sendto(header + question + answer, addr)
+
+
+def serve(port, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(loop.create_datagram_endpoint(
+        StubProtocol, local_addr=('127.0.0.1', port)))
+    ready.set()
+    loop.run_forever()
+
+
+def count_lines(path):
+    with open(path) as fd:
+        return sum(1 for _ in fd)
+
+
+def bench(name, func, count):
+    start = time.perf_counter()
+    func()
+    elapse = time.perf_counter() - start
+    print(f'{name:<10} {count} names in {elapse:.2f}s, {count / elapse:.0f} QPS')
+
+
+def main(count=100000, concurrent=10000, port=15353, massdns=True, massdns_path=None):
+    """
+    Run the benchmark
+
+    :param int count: names to resolve
+    :param int concurrent: max in-flight queries
+    :param int port: stub DNS server port
+    :param bool massdns: also benchmark massdns
+    :param str massdns_path: massdns path (default the bundled massdns)
+    """
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(port, ready), daemon=True)
+    server.start()
+    ready.wait()
+    temp_dir = Path(tempfile.mkdtemp())
+    dict_path = temp_dir.joinpath('names.txt')
+    ns_path = temp_dir.joinpath('nameservers.txt')
+    names = (f'{"nx" if i % 10 == 0 else "sub"}{i}.example.com' for i in range(count))
+    dict_path.write_text('\n'.join(names))
+    ns_path.write_text(f'127.0.0.1:{port}')
+
+    output_path = temp_dir.joinpath('builtin.json')
+    bench('builtin', lambda: dnsengine.resolve_file(dict_path, ns_path, output_path,
+                                                    concurrent), count)
+    print(f'builtin    {count_lines(output_path)} NOERROR results')
+
+    if massdns_path:
+        massdns_path = Path(massdns_path)
+    else:
+        massdns_path = utils.gen_massdns_path(settings.third_party_dir.joinpath('massdns'))
+    if massdns and massdns_path.exists() and os.access(massdns_path, os.X_OK):
+        output_path = temp_dir.joinpath('massdns.json')
+        cmd = [str(massdns_path), '--quiet', '--resolvers', str(ns_path),
+               '--hashmap-size', str(concurrent), '--output', 'J', '--root',
+               '--outfile', str(output_path), '--filter', 'OK', str(dict_path)]
+        bench('massdns', lambda: subprocess.run(cmd), count)
+        print(f'massdns    {count_lines(output_path)} NOERROR results')
+    server.terminate()
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Benchmark saving enriched data row by row against the set based bulk update
+
+Each run fills a new result table in a temporary directory and updates the
+enrichment fields of all its urls.
+
+Example:
+    python3 benchmark/bench_enrich.py --count 20000
+    python3 benchmark/bench_enrich.py --count 200000 --row False
+"""
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common.database import Database  # noqa: E402
+from config import settings  # noqa: E402
+
+fields = ['public', 'cdn', 'cidr', 'asn', 'org', 'addr', 'isp']
+
+
+def gen_data(count):
+    rows = list()
+    data = list()
+    for i in range(count):
+        ip = f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}'
+        url = f'http://s{i}.example.com'
+        rows.append({'url': url, 'subdomain': f's{i}.example.com', 'port': 80, 'ip': ip})
+        data.append({'url': url, 'public': '0', 'cdn': i % 2, 'cidr': f'{ip}/24',
+                     'asn': 'AS64512', 'org': 'Example Org', 'addr': 'Example City',
+                     'isp': 'Example ISP'})
+    return rows, data
+
+
+def update_rows(db, data):
+    for info in data:
+        info = dict(info)
+        url = info.pop('url')
+        db.update_data_by_url('example.com', info, url)
+
+
+def update_bulk(db, data):
+    db.update_data_by_urls('example.com', data, fields)
+
+
+def bench(name, func, rows, data):
+    settings.result_save_dir = Path(tempfile.mkdtemp())
+    db = Database()
+    db.create_table('example.com')
+    db.insert_rows('example.com', rows)
+    start = time.perf_counter()
+    func(db, data)
+    elapse = time.perf_counter() - start
+    updated = db.query('select count() from example_com where asn = "AS64512"').scalar()
+    db.close()
+    count = len(data)
+    print(f'{name:<6} {count} rows in {elapse:.2f}s, {count / elapse:.0f} rows/s, '
+          f'{updated} updated')
+    return elapse
+
+
+def main(count=20000, row=True):
+    """
+    Run the benchmark
+
+    :param int count: rows to update
+    :param bool row: also benchmark the row by row update
+    """
+    rows, data = gen_data(count)
+    new = bench('bulk', update_bulk, rows, data)
+    if row:
+        old = bench('row', update_rows, rows, data)
+        print(f'speedup {old / new:.1f}x')
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Benchmark exporting a result table through tablib against the streaming exporter
+
+Each run fills a result table in a temporary directory and exports it, the
+time and the peak memory traced by tracemalloc are printed (tracing slows
+down both ways).
+
+Example:
+    python3 benchmark/bench_export.py --count 100000
+    python3 benchmark/bench_export.py --count 1000000 --fmt ndjson --compress True
+"""
+
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import fire
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import export  # noqa: E402
+from common import utils  # noqa: E402
+from common.database import Database  # noqa: E402
+from config import settings  # noqa: E402
+
+
+def gen_results(count):
+    for i in range(count):
+        yield {'url': f'http://s{i}.example.com', 'subdomain': f's{i}.example.com',
+               'port': 80, 'ip': f'10.0.{i // 256 % 256}.{i % 256}', 'alive': i % 2,
+               'resolve': 1, 'request': 1, 'status': 200, 'reason': 'OK',
+               'title': f'Page {i % 100}', 'banner': 'nginx', 'module': 'Bench',
+               'source': 'bench'}
+
+
+def fill_table(count, size=10000):
+    db = Database()
+    db.create_table('example.com')
+    batch = list()
+    for result in gen_results(count):
+        batch.append(result)
+        if len(batch) >= size:
+            db.save_db('example.com', batch, 'Bench')
+            batch = list()
+    db.save_db('example.com', batch, 'Bench')
+    db.close()
+
+
+def export_tablib(path, fmt, compress):
+    db = Database()
+    rows = db.export_data('example_com', False, None)
+    data = rows.export(fmt)
+    if fmt == 'csv':
+        data = '\ufeff' + data
+    utils.save_to_file(path, data)
+    rows.as_dict()
+    db.close()
+
+
+def export_stream(path, fmt, compress):
+    export.export_data('example.com', path=path, fmt=fmt, compress=compress, keep=False)
+
+
+def bench(name, func, fmt, compress):
+    path = str(settings.result_save_dir.joinpath(f'{name}.{fmt}'))
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(path, fmt, compress)
+    elapse = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<7} {elapse:.2f}s, peak memory {peak / 1024 / 1024:.1f}MB')
+
+
+def main(count=100000, fmt='csv', compress=False):
+    """
+    Run the benchmark
+
+    :param int count: rows of the result table
+    :param str fmt: csv, json or ndjson (tablib is skipped for ndjson)
+    :param bool compress: compress the streamed file with gzip
+    """
+    settings.result_save_dir = Path(tempfile.mkdtemp())
+    fill_table(count)
+    if fmt != 'ndjson':
+        bench('tablib', export_tablib, fmt, compress)
+    bench('stream', export_stream, fmt, compress)
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
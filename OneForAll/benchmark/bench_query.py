@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Benchmark querying result tables through records against the sqlite3 layer
+
+Each run fills a result table in a temporary directory. Reading all rows as
+dicts and many small counting queries are timed, every query opens a new
+Database the way the modules do, the records way builds an engine each time
+like the Database did before.
+
+Example:
+    python3 benchmark/bench_query.py --count 50000
+    python3 benchmark/bench_query.py --count 200000 --times 5 --small 5000
+"""
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common import records  # noqa: E402
+from common.database import Database, get_db_path  # noqa: E402
+from config import settings  # noqa: E402
+
+
+def gen_results(count):
+    return [{'url': f'http://s{i}.example.com', 'subdomain': f's{i}.example.com',
+             'port': 80, 'ip': f'10.0.{i // 256 % 256}.{i % 256}', 'alive': i % 2,
+             'title': f'Page {i % 100}', 'module': 'Bench', 'source': 'bench'}
+            for i in range(count)]
+
+
+def records_query(sql, as_dict):
+    db = records.Database(f'sqlite:///{get_db_path()}', connect_args={'timeout': 60})
+    conn = db.get_connection()
+    rows = conn.query(sql)
+    result = rows.as_dict() if as_dict else rows.scalar()
+    conn.close()
+    db.close()
+    return result
+
+
+def read_records(times):
+    for _ in range(times):
+        records_query('select * from example_com', True)
+
+
+def read_native(times):
+    for _ in range(times):
+        db = Database()
+        db.get_data('example.com').as_dict()
+        db.close()
+
+
+def count_records(times):
+    for _ in range(times):
+        records_query('select count() from example_com where alive = 1', False)
+
+
+def count_native(times):
+    for _ in range(times):
+        db = Database()
+        db.count_alive('example.com').scalar()
+        db.close()
+
+
+def bench(name, func, times):
+    start = time.perf_counter()
+    func(times)
+    elapse = time.perf_counter() - start
+    print(f'{name:<14} {times} queries in {elapse:.2f}s, '
+          f'{elapse / times * 1000:.2f}ms per query')
+    return elapse
+
+
+def main(count=50000, times=3, small=1000):
+    """
+    Run the benchmark
+
+    :param int count: rows of the result table
+    :param int times: reads of all rows of each way
+    :param int small: small counting queries of each way
+    """
+    settings.result_save_dir = Path(tempfile.mkdtemp())
+    db = Database()
+    db.create_table('example.com')
+    db.save_db('example.com', gen_results(count), 'Bench')
+    db.close()
+    old = bench('read records', read_records, times)
+    new = bench('read sqlite3', read_native, times)
+    print(f'read speedup   {old / new:.1f}x')
+    old = bench('count records', count_records, small)
+    new = bench('count sqlite3', count_native, small)
+    print(f'count speedup  {old / new:.1f}x')
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
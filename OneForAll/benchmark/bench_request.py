@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Benchmark the asyncio HTTP probing engine against the thread engine on a
+local HTTP stand-in server
+
+Example:
+    python3 benchmark/bench_request.py --count 5000 --delay 0.05
+    python3 benchmark/bench_request.py --count 20000 --delay 0.2 --thread False
+"""
+
+import asyncio
+import gzip
+import multiprocessing
+import sys
+import time
+from pathlib import Path
+
+import fire
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common import request  # noqa: E402
+from config import settings  # noqa: E402
+
+body = b'<html><head><title>OneForAll</title></head><body>' + b'x' * 2048 + b'</body></html>'
+gzip_body = gzip.compress(body)
+
+
+async def handle(reader, writer, delay):
+    try:
+        line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        path = line.split(b' ')[1]
+        await asyncio.sleep(delay)
+        if path.startswith(b'/redirect'):
+            head = b'HTTP/1.1 302 Found\r\nLocation: /\r\nContent-Length: 0\r\n\r\n'
+            writer.write(head)
+        elif path.startswith(b'/chunked'):
+            head = b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nTransfer-Encoding: chunked\r\n\r\n'
+            writer.write(head + b'%x\r\n' % len(body) + body + b'\r\n0\r\n\r\n')
+        else:
+            head = (b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nServer: stand-in\r\n'
+                    b'Content-Encoding: gzip\r\nContent-Length: %d\r\n\r\n' % len(gzip_body))
+            writer.write(head + gzip_body)
+        await writer.drain()
+    except (ConnectionError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+def serve(port, delay, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(asyncio.start_server(
+        lambda r, w: handle(r, w, delay), '127.0.0.1', port, backlog=4096))
+    ready.set()
+    loop.run_forever()
+
+
+def bench(name, req_data):
+    start = time.perf_counter()
+    resp_queue = request.bulk_request('example.com', req_data, ret=True)
+    elapse = time.perf_counter() - start
+    infos = list()
+    while not resp_queue.empty():
+        index, resp = resp_queue.get()
+        infos.append(request.gen_new_info(dict(req_data[index]), resp))
+    alive = sum(1 for info in infos if info.get('alive'))
+    titles = {info.get('title') for info in infos}
+    count = len(req_data)
+    print(f'{name:<8} {count} urls in {elapse:.2f}s, {count / elapse:.0f} requests/s, '
+          f'{alive} alive, titles {titles}')
+
+
+def main(count=5000, delay=0.05, port=18080, thread=True):
+    """
+    Run the benchmark
+
+    :param int count: urls to request
+    :param float delay: server response delay seconds
+    :param int port: stand-in server port
+    :param bool thread: also benchmark the thread engine
+    """
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(port, delay, ready), daemon=True)
+    server.start()
+    ready.wait()
+    paths = ['/', '/chunked', '/redirect']
+    req_data = [{'url': f'http://127.0.0.1:{port}{paths[i % 3]}?{i}', 'ip': '127.0.0.1'}
+                for i in range(count)]
+    settings.request_per_host_num = settings.request_async_concurrent_num
+    settings.request_engine = 'async'
+    bench('async', req_data)
+    if thread:
+        settings.request_engine = 'thread'
+        bench('thread', req_data)
+    server.terminate()
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
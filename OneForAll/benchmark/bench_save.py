@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Benchmark saving HTTP request results row by row against the batched save
+
+Responses are generated in memory so only the save path is measured, each
+run uses a new database in a temporary directory.
+
+Example:
+    python3 benchmark/bench_save.py --count 50000
+    python3 benchmark/bench_save.py --count 200000 --pages 1000 --processes 4
+"""
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+from queue import Queue
+
+import fire
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common import request, respstore  # noqa: E402
+from common.database import Database  # noqa: E402
+from config import settings  # noqa: E402
+
+
+def gen_results(count, pages):
+    req_data = list()
+    results = list()
+    for i in range(count):
+        req_data.append({'url': f'http://s{i}.example.com', 'subdomain': f's{i}.example.com',
+                         'ip': f'10.0.{i // 256 % 256}.{i % 256}', 'port': 80})
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.reason = 'OK'
+        resp.url = req_data[-1]['url']
+        resp.headers = requests.structures.CaseInsensitiveDict({
+            'Server': 'nginx', 'Content-Type': 'text/html'})
+        resp._content = (f'<html><head><title>Page {i % pages}</title></head><body>'
+                         + 'lorem ipsum ' * 200 + '</body></html>').encode()
+        results.append((i, resp))
+    return req_data, results
+
+
+def save_rows(name, req_data, results):
+    db = Database()
+    db.create_table(name)
+    for index, resp in results:
+        info = request.gen_new_info(dict(req_data[index]), resp)
+        respstore.store.flush(db)
+        db.insert_table(name, info)
+    db.close()
+
+
+def save_batches(name, req_data, results):
+    resp_queue = Queue()
+    for result in results:
+        resp_queue.put(result)
+    request.save(name, len(results), [dict(info) for info in req_data], resp_queue)
+
+
+def bench(title, func, req_data, results):
+    settings.result_save_dir = Path(tempfile.mkdtemp())
+    respstore.store = respstore.ResponseStore()
+    for _, resp in results:
+        resp.body_hash = None
+    start = time.perf_counter()
+    func('example.com', req_data, results)
+    elapse = time.perf_counter() - start
+    count = len(results)
+    print(f'{title:<10} {count} results in {elapse:.2f}s, {count / elapse:.0f} rows/s')
+    return elapse
+
+
+def main(count=20000, pages=100, processes=1):
+    """
+    Run the benchmark
+
+    :param int count: results to save
+    :param int pages: distinct response bodies
+    :param int processes: title extraction processes of the batched save
+    """
+    req_data, results = gen_results(count, pages)
+    old = bench('row', save_rows, req_data, results)
+    settings.request_title_process_num = processes
+    new = bench('batch', save_batches, req_data, results)
+    print(f'speedup    {old / new:.1f}x')
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Benchmark the fast html title extractor against the BeautifulSoup based one
+
+The corpus is read from a directory of saved pages or from the response
+column of a result database, a generated corpus is used when not given.
+
+Example:
+    python3 benchmark/bench_title.py
+    python3 benchmark/bench_title.py --path results/result.sqlite3 --processes 4
+    python3 benchmark/bench_title.py --path /tmp/pages
+"""
+
+import random
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import fire
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common.htmltitle import get_html_title, get_html_titles  # noqa: E402
+
+
+def get_soup_title(markup):
+    soup = BeautifulSoup(markup, 'html.parser')
+    for tag in (soup.title, soup.h1, soup.h2, soup.h3):
+        if tag:
+            return tag.text
+    for name in ('description', 'keywords'):
+        meta = soup.find('meta', attrs={'name': name})
+        if meta:
+            return meta.get('content', '')
+    text = soup.text
+    if len(text) <= 200:
+        return repr(text)
+    return 'None'
+
+
+def gen_corpus(count):
+    random.seed(0)
+    paragraph = '<p>Lorem ipsum <a href="/item?id=1&amp;p=2">dolor</a> sit amet, ' \
+                '<b>consectetur</b> adipiscing elit.</p>\n'
+    script = '<script>var data = {"title": "<title>x</title>"};</script>\n'
+    pages = list()
+    for i in range(count):
+        body = paragraph * random.randint(10, 400)
+        kind = i % 5
+        if kind in (0, 1, 2):
+            head = f'<head><meta charset="utf-8">{script}<title>Page {i}</title></head>'
+        elif kind == 3:
+            head = f'<head><meta name="description" content="Site {i}">{script}</head>'
+            body = f'<div class="nav">{paragraph * 5}</div><h2>Section {i}</h2>{body}'
+        else:
+            head = '<head></head>'
+            body = '<center>nginx</center>' if i % 2 else body
+        pages.append(f'<!DOCTYPE html><html>{head}<body>{body}</body></html>')
+    return pages
+
+
+def read_corpus(path):
+    path = Path(path)
+    if path.is_dir():
+        return [item.read_text(errors='replace') for item in sorted(path.rglob('*.htm*'))]
+    conn = sqlite3.connect(str(path))
+    tables = [row[0] for row in conn.execute("select name from sqlite_master "
+                                             "where type = 'table'")]
+    pages = list()
+    for table in tables:
+        columns = [row[1] for row in conn.execute(f'pragma table_info("{table}")')]
+        if 'response' not in columns:
+            continue
+        rows = conn.execute(f'select response from "{table}" where response is not null')
+        pages.extend(row[0] for row in rows)
+    conn.close()
+    return pages
+
+
+def bench(name, func, pages):
+    start = time.perf_counter()
+    titles = func(pages)
+    elapse = time.perf_counter() - start
+    print(f'{name:<14} {len(pages)} pages in {elapse:.2f}s, {len(pages) / elapse:.0f} pages/s')
+    return titles, elapse
+
+
+def main(path=None, count=2000, processes=0):
+    """
+    Run the benchmark
+
+    :param str path: directory of saved pages or result database
+    :param int count: pages to generate when path is not given
+    :param int processes: also benchmark the process pool of this size
+    """
+    pages = read_corpus(path) if path else gen_corpus(count)
+    size = sum(len(page) for page in pages)
+    print(f'corpus         {len(pages)} pages, {size / 1024 / 1024:.1f} MB')
+    old, old_elapse = bench('beautifulsoup', lambda items: [get_soup_title(item) for item in items],
+                            pages)
+    new, new_elapse = bench('fast', lambda items: [get_html_title(item) for item in items], pages)
+    print(f'speedup        {old_elapse / new_elapse:.1f}x')
+    if processes > 1:
+        bench(f'fast x{processes}', lambda items: get_html_titles(items, processes), pages)
+    diff = sum(1 for a, b in zip(old, new) if a != b)
+    print(f'different      {diff} titles')
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -7,15 +7,21 @@ OneForAll subdomain brute module
 :copyright: Copyright (c) 2019, Jing Ling. All rights reserved.
 :license: GNU General Public License v3.0, see LICENSE for more details.
 """
-import gc
+import collections
+import itertools
 import json
 import time
+from pathlib import Path
 
 import exrex
 import fire
 
 import export
-from common import utils
+from common import utils, dnsengine
+from common.bloom import BloomFilter
+from common.budget import dns_budget
+from common.journal import Journal
+from common.progress import Progress
 from config import settings
 from common.module import Module
 from modules import wildcard
@@ -28,9 +34,8 @@ def gen_subdomains(expression, path):
 
     :param  str  expression: generate subdomains expression
     :param  str  path: path of wordlist
-    :return set  subdomains: list of subdomains
+    :return: subdomain generator
     """
-    subdomains = set()
     with open(path, encoding='utf-8', errors='ignore') as fd:
         for line in fd:
             word = line.strip().lower()
@@ -42,15 +47,7 @@ def gen_subdomains(expression, path):
                 word = word[1:]
             if word.endswith('.'):
                 word = word[:-1]
-            subdomain = expression.replace('*', word)
-            subdomains.add(subdomain)
-    size = len(subdomains)
-    logger.log('DEBUG', f'The size of the dictionary generated by {path} is {size}')
-    if size == 0:
-        logger.log('ALERT', 'Please check the dictionary content!')
-    else:
-        utils.check_random_subdomain(subdomains)
-    return subdomains
+            yield expression.replace('*', word)
 
 
 def gen_fuzz_subdomains(expression, rule, fuzzlist):
@@ -60,39 +57,94 @@ def gen_fuzz_subdomains(expression, rule, fuzzlist):
     :param  str  expression: generate subdomains expression
     :param  str  rule: regexp rule
     :param  str  fuzzlist: fuzz dictionary
-    :return set  subdomains: list of subdomains
+    :return: subdomain generator
     """
-    subdomains = set()
     if fuzzlist:
-        fuzz_domain = gen_subdomains(expression, fuzzlist)
-        subdomains.update(fuzz_domain)
+        yield from gen_subdomains(expression, fuzzlist)
     if rule:
-        fuzz_count = exrex.count(rule)
-        if fuzz_count > 10000000:
-            logger.log('ALERT', f'The dictionary generated by this rule is too large: '
-                                f'{fuzz_count} > 10000000')
         for fuzz_string in exrex.generate(rule):
             fuzz_string = fuzz_string.lower()
             if not fuzz_string.isalnum():
                 continue
-            fuzz_domain = expression.replace('*', fuzz_string)
-            subdomains.add(fuzz_domain)
-        utils.check_random_subdomain(subdomains)
-    logger.log('DEBUG', f'Dictionary size based on fuzz mode: {len(subdomains)}')
-    return subdomains
+            yield expression.replace('*', fuzz_string)
+
+
+def count_fuzz_subdomains(rule, fuzzlist):
+    count = 0
+    if fuzzlist:
+        count += count_lines(fuzzlist)
+    if rule:
+        fuzz_count = exrex.count(rule)
+        if fuzz_count > 10000000:
+            logger.log('ALERT', f'The dictionary generated by this rule is too large: '
+                                f'{fuzz_count} > 10000000')
+        count += fuzz_count
+    return count
+
 
+def count_lines(path):
+    with open(path, 'rb') as fd:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: fd.read(1 << 20), b'')) + 1
 
-def gen_word_subdomains(expression, path):
+
+def dedup_subdomains(subdomains, capacity):
     """
-    Generate subdomains based on word mode
+    Deduplicate subdomains lazily with a bloom filter
 
-    :param  str  expression: generate subdomains expression
-    :param  str  path: path of wordlist
-    :return set  subdomains: list of subdomains
+    The filter holds at most brute_dedup_capacity subdomains, a larger
+    dictionary is deduplicated chunk by chunk with a new filter for each chunk
+    so duplicates in different chunks are kept.
+
+    :param subdomains: subdomain iterable
+    :param int capacity: expected subdomain count
+    :return: subdomain generator
+    """
+    limit = settings.brute_dedup_capacity
+    if capacity > limit:
+        logger.log('ALERT', f'The expected dictionary size {capacity} exceeds '
+                            f'{limit}, deduplicate it chunk by chunk')
+    error_rate = settings.brute_dedup_error_rate
+    seen = BloomFilter(min(capacity, limit), error_rate)
+    added = 0  # 当前过滤器中的子域数量
+    count = 0
+    for subdomain in subdomains:
+        if added >= limit:
+            # 超过容量后误判率迅速升高 换用新的过滤器
+            seen = BloomFilter(limit, error_rate)
+            added = 0
+        if not seen.add(subdomain):
+            continue
+        added += 1
+        if not count:
+            utils.check_random_subdomain([subdomain])
+        count += 1
+        yield subdomain
+    logger.log('INFOR', f'Dictionary size: {count}')
+    if count == 0:
+        utils.check_random_subdomain([])
+    if count > 10000000:
+        logger.log('ALERT', f'The generated dictionary is '
+                            f'too large {count} > 10000000')
+
+
+def gen_chunks(names, size):
     """
-    subdomains = gen_subdomains(expression, path)
-    logger.log('DEBUG', f'Dictionary based on word mode size: {len(subdomains)}')
-    return subdomains
+    Split names into lazy chunks, each chunk must be consumed before the next
+
+    :param names: name iterable
+    :param int size: chunk size
+    :return: chunk generator
+    """
+    names = iter(names)
+    for first in names:
+        yield itertools.chain((first,), itertools.islice(names, size - 1))
+
+
+def save_chunk(chunk, fd):
+    for name in chunk:
+        fd.write(name)
+        fd.write('\n')
+        yield name
 
 
 def query_domain_ns_a(ns_list):
@@ -144,138 +196,184 @@ def check_dict():
         exit(0)
 
 
-def gen_result_infos(items, infos, subdomains, appear_times, wc_ips, wc_ttl):
-    qname = items.get('name')[:-1]  # 去除最右边的`.`点号
-    reason = items.get('status')
-    resolver = items.get('resolver')
-    data = items.get('data')
-    answers = data.get('answers')
-    info = dict()
+def gen_row_info(qname, resolver, records, appear_times, wc_ips, wc_ttl):
+    """
+    Judge one candidate row and generate its info
+
+    :param str qname: subdomain
+    :param str resolver: resolver
+    :param list records: (cname, ip, ttl) of A records
+    :param dict appear_times: IP and cname appear times
+    :param list wc_ips: wildcard IPs
+    :param int wc_ttl: wildcard TTL
+    :return dict: info or None when the subdomain is invalid
+    """
     cnames = list()
     ips = list()
     ip_times = list()
     cname_times = list()
     ttls = list()
-    is_valid_flags = list()
-    have_a_record = False
-    for answer in answers:
-        if answer.get('type') != 'A':
-            continue
-        have_a_record = True
-        ttl = answer.get('ttl')
+    reason = 'OK'
+    for cname, ip, ttl in records:
         ttls.append(ttl)
-        name = answer.get('name')  # 去除最右边的`.`点号
-        cname = name[:-1].lower()  # 去除最右边的`.`点号
         cnames.append(cname)
         cname_num = appear_times.get(cname)
         cname_times.append(cname_num)
-        ip = answer.get('data')
         ips.append(ip)
         ip_num = appear_times.get(ip)
         ip_times.append(ip_num)
         isvalid, reason = wildcard.is_valid_subdomain(ip, ip_num, cname, cname_num, ttl, wc_ttl, wc_ips)
-        logger.log('TRACE', f'{ip} effective: {isvalid} reason: {reason}')
-        is_valid_flags.append(isvalid)
-    if not have_a_record:
-        logger.log('TRACE', f'All query result of {qname} no A record{answers}')
-    # 为了优化内存 只添加有A记录且通过判断的子域到记录中
-    if have_a_record and all(is_valid_flags):
-        info['resolve'] = 1
-        info['reason'] = reason
-        info['ttl'] = ttls
-        info['cname'] = cnames
-        info['ip'] = ips
-        info['ip_times'] = ip_times
-        info['cname_times'] = cname_times
-        info['resolver'] = resolver
-        infos[qname] = info
-        subdomains.append(qname)
-    return infos, subdomains
-
-
-def stat_appear_times(result_path):
-    logger.log('INFOR', f'Counting IP cname appear times')
-    times = dict()
-    logger.log('DEBUG', f'Reading {result_path}')
-    with open(result_path) as fd:
-        for line in fd:
-            line = line.strip()
-            try:
-                items = json.loads(line)
-            except Exception as e:
-                logger.log('ERROR', e.args)
-                logger.log('ERROR', f'Error parsing {result_path} '
-                                    f'line {line} Skip this line')
-                continue
-            status = items.get('status')
-            if status != 'NOERROR':
-                continue
-            data = items.get('data')
-            if 'answers' not in data:
-                continue
-            answers = data.get('answers')
-            for answer in answers:
-                if answer.get('type') == 'A':
-                    ip = answer.get('data')
-                    # 取值 如果是首次出现的IP集合 出现次数先赋值0
-                    value_one = times.setdefault(ip, 0)
-                    times[ip] = value_one + 1
-                    name = answer.get('data')
-                    cname = name[:-1].lower()  # 去除最右边的`.`点号
-                    # 取值 如果是首次出现的IP集合 出现次数先赋值0
-                    value_two = times.setdefault(cname, 0)
-                    times[cname] = value_two + 1
-                if answer.get('type') == 'CNAME':
-                    name = answer.get('data')
-                    cname = name[:-1].lower()  # 去除最右边的`.`点号
-                    # 取值 如果是首次出现的IP集合 出现次数先赋值0
-                    value_three = times.setdefault(cname, 0)
-                    times[cname] = value_three + 1
-    return times
-
-
-def deal_output(output_path, appear_times, wildcard_ips, wildcard_ttl):
-    logger.log('INFOR', f'Processing result')
-    infos = dict()  # 用来记录所有域名有关信息
-    subdomains = list()  # 用来保存所有通过有效性检查的子域
-    logger.log('DEBUG', f'Processing {output_path}')
-    with open(output_path) as fd:
-        for line in fd:
-            line = line.strip()
-            try:
-                items = json.loads(line)
-            except Exception as e:
-                logger.log('ERROR', e.args)
-                logger.log('ERROR', f'Error parsing {line} Skip this line')
-                continue
-            qname = items.get('name')[:-1]  # 去除最右边的`.`点号
-            status = items.get('status')
-            if status != 'NOERROR':
-                logger.log('TRACE', f'Found {qname}\'s result {status} '
-                                    f'while processing {line}')
-                continue
-            data = items.get('data')
-            if 'answers' not in data:
-                logger.log('TRACE', f'Processing {line}, {qname} no response')
-                continue
-            infos, subdomains = gen_result_infos(items, infos, subdomains,
-                                                 appear_times, wildcard_ips,
-                                                 wildcard_ttl)
-    return infos, subdomains
+        if not isvalid:
+            logger.log('TRACE', f'{qname} {ip} invalid reason: {reason}')
+            return None
+    return {'resolve': 1, 'reason': reason, 'ttl': ttls, 'cname': cnames, 'ip': ips,
+            'ip_times': ip_times, 'cname_times': cname_times, 'resolver': resolver}
 
 
-def save_brute_dict(dict_path, dict_set):
-    dict_data = '\n'.join(dict_set)
-    if not utils.save_to_file(dict_path, dict_data):
-        logger.log('FATAL', 'Saving dictionary error')
-        exit(1)
+class OutputProcessor(object):
+    """
+    Single pass processor of massdns output
+
+    The output is parsed once: IP and cname appear times are counted and
+    the A records of each subdomain are kept as compact candidate rows, rows
+    beyond the memory limit are spilled to a temporary file. The wildcard
+    judgment is made afterwards over the compact rows only.
+
+    :param spill_dir: directory of the temporary file
+    :param int max_rows: max candidate rows kept in memory
+    """
+    def __init__(self, spill_dir, max_rows=None):
+        self.times = dict()  # IP和cname出现次数
+        self.rows = list()  # 候选记录(子域, 解析服务器, A记录列表)
+        self.max_rows = max_rows or settings.brute_memory_rows
+        self.spill_path = spill_dir.joinpath(f'brute_rows_{utils.get_timestring()}'
+                                             f'_{id(self)}.tsv')
+        self.spill_fd = None
+        self.count = 0
+
+    def add_item(self, items):
+        """
+        Process one result in massdns output structure
+
+        :param dict items: resolved result
+        """
+        qname = items.get('name')[:-1]  # 去除最右边的`.`点号
+        status = items.get('status')
+        if status != 'NOERROR':
+            return
+        answers = items.get('data', {}).get('answers')
+        if not answers:
+            logger.log('TRACE', f'Processing {qname} no response')
+            return
+        times = self.times
+        records = list()
+        for answer in answers:
+            rtype = answer.get('type')
+            if rtype == 'A':
+                ip = answer.get('data')
+                times[ip] = times.get(ip, 0) + 1
+                key = ip[:-1].lower()  # 与原有的出现次数统计保持一致
+                times[key] = times.get(key, 0) + 1
+                cname = answer.get('name')[:-1].lower()  # 去除最右边的`.`点号
+                records.append((cname, ip, answer.get('ttl')))
+            elif rtype == 'CNAME':
+                cname = answer.get('data')[:-1].lower()
+                times[cname] = times.get(cname, 0) + 1
+        if not records:
+            logger.log('TRACE', f'All query result of {qname} no A record{answers}')
+            return
+        self.add_row(qname, items.get('resolver'), records)
+
+    def add_row(self, qname, resolver, records):
+        self.count += 1
+        if len(self.rows) < self.max_rows:
+            self.rows.append((qname, resolver, records))
+            return
+        if self.spill_fd is None:
+            logger.log('DEBUG', f'Spilling candidate rows to {self.spill_path}')
+            self.spill_fd = open(self.spill_path, 'w')
+        record_str = '|'.join(f'{cname} {ip} {ttl}' for cname, ip, ttl in records)
+        self.spill_fd.write(f'{qname}\t{resolver}\t{record_str}\n')
+
+    def add_file(self, output_path):
+        """
+        Process one massdns output file
+
+        :param output_path: output file path
+        """
+        logger.log('DEBUG', f'Processing {output_path}')
+        with open(output_path) as fd:
+            for line in fd:
+                line = line.strip()
+                try:
+                    items = json.loads(line)
+                except Exception as e:
+                    logger.log('ERROR', e.args)
+                    logger.log('ERROR', f'Error parsing {line} Skip this line')
+                    continue
+                self.add_item(items)
+
+    def iter_rows(self):
+        yield from self.rows
+        if self.spill_fd is None:
+            return
+        self.spill_fd.close()
+        self.spill_fd = None
+        with open(self.spill_path) as fd:
+            for line in fd:
+                qname, resolver, record_str = line.rstrip('\n').split('\t')
+                records = list()
+                for record in record_str.split('|'):
+                    cname, ip, ttl = record.split(' ')
+                    records.append((cname, ip, int(ttl)))
+                yield qname, resolver, records
+
+    def deal(self, wildcard_ips, wildcard_ttl):
+        """
+        Judge all candidate rows
+
+        :param list wildcard_ips: wildcard IPs
+        :param int wildcard_ttl: wildcard TTL
+        :return: (infos, subdomains)
+        """
+        logger.log('INFOR', f'Processing {self.count} candidate results')
+        infos = dict()  # 用来记录所有域名有关信息
+        subdomains = list()  # 用来保存所有通过有效性检查的子域
+        resolve_time = utils.get_timestamp()
+        for qname, resolver, records in self.iter_rows():
+            if qname in infos:  # 分块去重的字典中可能有重复的子域
+                continue
+            info = gen_row_info(qname, resolver, records, self.times,
+                                wildcard_ips, wildcard_ttl)
+            # 为了优化内存 只添加有A记录且通过判断的子域到记录中
+            if info:
+                info['resolve_time'] = resolve_time
+                infos[qname] = info
+                subdomains.append(qname)
+        self.close()
+        return infos, subdomains
+
+    def close(self):
+        self.rows = list()
+        if self.spill_fd is not None:
+            self.spill_fd.close()
+            self.spill_fd = None
+        if self.spill_path.exists():
+            self.spill_path.unlink()
+
+
+def deal_output(output_paths, spill_dir, wildcard_ips, wildcard_ttl):
+    logger.log('INFOR', f'Processing result')
+    processor = OutputProcessor(spill_dir)
+    for output_path in output_paths:
+        processor.add_file(output_path)
+    return processor.deal(wildcard_ips, wildcard_ttl)
 
 
-def delete_file(dict_path, output_path):
-    if settings.delete_generated_dict:
-        dict_path.unlink()
+def delete_file(output_paths):
     if settings.delete_massdns_result:
-        output_path.unlink()
+        for output_path in output_paths:
+            output_path.unlink()
 
 
 class Brute(Module):
@@ -290,9 +388,10 @@ class Brute(Module):
         brute.py --target domain.com --word True --recursive True --depth 2 run
         brute.py --target d.com --fuzz True --place m.*.d.com --rule '[a-z]' run
         brute.py --target d.com --fuzz True --place m.*.d.com --fuzzlist subnames.txt run
+        brute.py --target domain.com --word True --resume True run
 
     Note:
-        --fmt csv/json (result format)
+        --fmt csv/json/ndjson (result format)
         --path   Result path (default None, automatically generated)
 
 
@@ -312,11 +411,12 @@ class Brute(Module):
     :param bool export:     Export the results (default True)
     :param str  fmt:        Result format (default csv)
     :param str  path:       Result directory (default None)
+    :param bool resume:     Resume the interrupted brute (default False)
     """
     def __init__(self, target=None, targets=None, concurrent=None,
                  word=False, wordlist=None, recursive=False, depth=None,
                  nextlist=None, fuzz=False, place=None, rule=None, fuzzlist=None,
-                 export=True, alive=True, fmt='csv', path=None):
+                 export=True, alive=True, fmt='csv', path=None, resume=None):
         Module.__init__(self)
         self.module = 'Brute'
         self.source = 'Brute'
@@ -336,16 +436,24 @@ class Brute(Module):
         self.alive = alive
         self.fmt = fmt
         self.path = path
+        self.resume = resume or settings.enable_resume
         self.bulk = False  # 是否是批量爆破场景
         self.domains = list()  # 待爆破的所有域名集合
         self.domain = str()  # 当前正在进行爆破的域名
         self.ips_times = dict()  # IP集合出现次数
         self.enable_wildcard = None  # 当前域名是否使用泛解析
         self.quite = False
+        self.massdns_path = None
+        self.dict_size = 0  # 生成字典的预计大小
 
     def gen_brute_dict(self, domain):
+        """
+        Generate the deduplicated brute dictionary lazily
+
+        :param str domain: domain to be brute
+        :return: (subdomain generator, dictionary signature)
+        """
         logger.log('INFOR', f'Generating dictionary for {domain}')
-        dict_set = set()
         # 如果domain不是self.subdomain 而是self.domain的子域则生成递归爆破字典
         if self.word:
             self.place = ''
@@ -355,18 +463,20 @@ class Brute(Module):
         main_domain = utils.get_main_domain(domain)
         if domain != main_domain:
             wordlist = self.recursive_nextlist
+        sources = list()
+        capacity = 0
         if self.word:
-            word_subdomains = gen_word_subdomains(self.place, wordlist)
-            dict_set.update(word_subdomains)
+            sources.append(gen_subdomains(self.place, wordlist))
+            capacity += count_lines(wordlist)
         if self.fuzz:
-            fuzz_subdomains = gen_fuzz_subdomains(self.place, self.rule, self.fuzzlist)
-            dict_set.update(fuzz_subdomains)
-        count = len(dict_set)
-        logger.log('INFOR', f'Dictionary size: {count}')
-        if count > 10000000:
-            logger.log('ALERT', f'The generated dictionary is '
-                                f'too large {count} > 10000000')
-        return dict_set
+            sources.append(gen_fuzz_subdomains(self.place, self.rule, self.fuzzlist))
+            capacity += count_fuzz_subdomains(self.rule, self.fuzzlist)
+        # 字典按固定顺序生成 续扫时参数不变则分块与上次一致
+        signature = [self.place, str(wordlist) if self.word else None, self.fuzz,
+                     self.rule, str(self.fuzzlist), settings.brute_chunk_size]
+        names = dedup_subdomains(itertools.chain(*sources), capacity)
+        self.dict_size = capacity
+        return names, signature
 
     def check_brute_params(self):
         if not (self.word or self.fuzz):
@@ -405,14 +515,83 @@ class Brute(Module):
         if self.recursive_nextlist is None:
             self.recursive_nextlist = settings.recursive_nextlist_path or data_dir.joinpath('subnames_next.txt')
 
+    def run_massdns(self, journal, names, dict_path, ns_path, log_path):
+        """
+        Feed the dictionary to massdns or the built-in DNS engine chunk by
+        chunk as it is generated, finished chunks are recorded in the journal
+        and skipped when resuming
+
+        :return list: massdns output paths
+        """
+        done = journal.done('chunk')
+        # 只续扫从第0块起连续完成的块 之后的块全部重新运行
+        marks = list()
+        for index in itertools.count():
+            mark = done.get(str(index))
+            if not isinstance(mark, dict) or not Path(mark['output']).exists():
+                break
+            marks.append(mark)
+        output_paths = list()
+        dict_fd = None
+        if not settings.delete_generated_dict:
+            offset = marks[-1]['offset'] if marks else None
+            if offset is not None and dict_path.exists():
+                # 截掉中断时写了一半的块 避免续扫后字典中的子域重复
+                with open(dict_path, 'r+') as fd:
+                    fd.truncate(offset)
+                dict_fd = open(dict_path, 'a')
+            else:
+                marks = list()
+                dict_fd = open(dict_path, 'w')
+        progress = Progress('Brute Progress', self.dict_size, 'name')
+        for index, chunk in enumerate(gen_chunks(names, settings.brute_chunk_size)):
+            if index < len(marks):
+                logger.log('INFOR', f'Resume: skip the finished chunk {index} of {dict_path}')
+                collections.deque(progress.iterate(chunk), maxlen=0)
+                output_paths.append(Path(marks[index]['output']))
+                continue
+            if dict_fd:
+                chunk = save_chunk(chunk, dict_fd)
+            output_path = dict_path.with_name(f'{dict_path.stem}_{index}.json')
+            concurrent_num = dns_budget.acquire(self.concurrent_num)
+            try:
+                if self.massdns_path:
+                    logger.log('INFOR', f'Running massdns to brute subdomains (chunk {index})')
+                    # massdns从标准输入读取 读取进度近似于解析进度
+                    utils.call_massdns(massdns_path=self.massdns_path, dict_path=None,
+                                       ns_path=ns_path, output_path=output_path,
+                                       log_path=log_path, quiet_mode=self.quite,
+                                       concurrent_num=concurrent_num,
+                                       names=progress.iterate(chunk))
+                else:
+                    logger.log('INFOR', f'Running built-in DNS engine to brute '
+                                        f'subdomains (chunk {index})')
+                    dnsengine.resolve_to_file(chunk, ns_path, output_path,
+                                              concurrent_num, progress=progress)
+            finally:
+                dns_budget.release(concurrent_num)
+            offset = None
+            if dict_fd:
+                dict_fd.flush()
+                offset = dict_fd.tell()
+            # 记录该块写完后字典文件的长度 续扫时据此截断
+            journal.mark('chunk', index, {'output': str(output_path), 'offset': offset})
+            output_paths.append(output_path)
+        progress.close(complete=True)
+        if dict_fd:
+            dict_fd.close()
+        return output_paths
+
     def main(self, domain):
         start = time.time()
         logger.log('INFOR', f'Blasting {domain} ')
+        journal = Journal(domain, 'brute', self.resume)
         massdns_dir = settings.third_party_dir.joinpath('massdns')
         result_dir = settings.result_save_dir
         temp_dir = result_dir.joinpath('temp')
         utils.check_dir(temp_dir)
-        massdns_path = utils.get_massdns_path(massdns_dir)
+        if not utils.use_builtin_engine():
+            self.massdns_path = utils.get_massdns_path(massdns_dir)
         timestring = utils.get_timestring()
 
         wildcard_ips = list()  # 泛解析IP列表
@@ -424,28 +603,30 @@ class Brute(Module):
 
         if self.enable_wildcard:
             wildcard_ips, wildcard_ttl = wildcard.collect_wildcard_record(domain, ns_ip_list)
-        ns_path = utils.get_ns_path(settings.use_china_nameservers, self.enable_wildcard, ns_ip_list)
-
-        dict_set = self.gen_brute_dict(domain)
-
-        dict_name = f'generated_subdomains_{domain}_{timestring}.txt'
-        dict_path = temp_dir.joinpath(dict_name)
-        save_brute_dict(dict_path, dict_set)
-        del dict_set
-        gc.collect()
+        ns_path = utils.get_ns_path(settings.use_china_nameservers, self.enable_wildcard,
+                                    ns_ip_list, domain)
+
+        names, signature = self.gen_brute_dict(domain)
+        dict_path = journal.value('dict')
+        if dict_path and journal.value('signature') == signature:
+            dict_path = Path(dict_path)
+        else:
+            journal.reset()
+            dict_name = f'generated_subdomains_{domain}_{timestring}.txt'
+            dict_path = temp_dir.joinpath(dict_name)
+            journal.finish('dict', str(dict_path))
+            journal.finish('signature', signature)
+        # 先取出第一个子域以便在检查配置前提示
+        names = iter(names)
+        first = next(names, None)
+        if first is not None:
+            names = itertools.chain((first,), names)
 
-        output_name = f'resolved_result_{domain}_{timestring}.json'
-        output_path = temp_dir.joinpath(output_name)
         log_path = result_dir.joinpath('massdns.log')
         check_dict()
-        logger.log('INFOR', f'Running massdns to brute subdomains')
-        utils.call_massdns(massdns_path, dict_path, ns_path, output_path,
-                           log_path, quiet_mode=self.quite,
-                           concurrent_num=self.concurrent_num)
-        appear_times = stat_appear_times(output_path)
-        self.infos, self.subdomains = deal_output(output_path, appear_times,
+        output_paths = self.run_massdns(journal, names, dict_path, ns_path, log_path)
+        self.infos, self.subdomains = deal_output(output_paths, temp_dir,
                                                   wildcard_ips, wildcard_ttl)
-        delete_file(dict_path, output_path)
         end = time.time()
         self.elapse = round(end - start, 1)
         logger.log('ALERT', f'{self.source} module takes {self.elapse} seconds, '
@@ -454,6 +635,8 @@ class Brute(Module):
                             f'{self.subdomains}')
         self.gen_result()
         self.save_db()
+        delete_file(output_paths)
+        journal.finish('done')
         return self.subdomains
 
     def run(self):
@@ -496,7 +679,8 @@ class Brute(Module):
                                    alive=self.alive,
                                    limit='resolve',
                                    path=self.path,
-                                   fmt=self.fmt)
+                                   fmt=self.fmt,
+                                   keep=False)
 
 
 if __name__ == '__main__':
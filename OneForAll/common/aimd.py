@@ -0,0 +1,303 @@
+"""
+AIMD adaptive concurrency control of HTTP probing
+
+Every destination IP, ASN and the whole request stage has its own window of
+in-flight requests. A window grows by one with each success while it is fully
+used, it stops growing when the connect latency rises well above the observed
+minimum, and it is halved when the recent share of timeouts or overload responses (429, 503) is
+too high. Timeouts of destinations never seen alive are filtered ports or dead
+hosts rather than congestion, so they only slow down their own destination.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+from requests import exceptions
+
+from config import settings
+from config.log import logger
+
+overload_codes = {429, 503}
+
+
+def classify(resp):
+    """
+    Classify the result of a request
+
+    :param resp: response or exception
+    :return str: timeout, overload, error or ok
+    """
+    if isinstance(resp, exceptions.Timeout):
+        return 'timeout'
+    if isinstance(resp, Exception):
+        return 'error'
+    if resp.status_code in overload_codes:
+        return 'overload'
+    return 'ok'
+
+
+def get_latency(resp, elapse):
+    """
+    Get the connect latency of a response, the time to response headers is
+    used when the engine does not measure the connect time
+
+    :param resp: response or exception
+    :param float elapse: seconds the request took
+    :return float: latency seconds
+    """
+    latency = getattr(resp, 'connect_elapsed', None)
+    if latency is not None:
+        return latency
+    if isinstance(resp, Exception):
+        return elapse
+    return resp.elapsed.total_seconds() or elapse
+
+
+class Window(object):
+    """
+    AIMD concurrency window
+
+    :param str name:    window name used in the log
+    :param int maximum: max concurrency
+    :param int minimum: min concurrency
+    :param int initial: initial concurrency (default maximum)
+    :param int sample:  recent results used to compute the timeout rate
+    """
+    def __init__(self, name, maximum, minimum=1, initial=None, sample=20):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(max(self.minimum, min(initial or self.maximum, self.maximum)))
+        self.inflight = 0
+        self.results = deque(maxlen=sample)  # 近期结果 1表示超时或过载
+        self.min_samples = max(2, sample // 5)
+        self.latency = None  # 平滑后的连接延迟
+        self.min_latency = None
+        self.last_decrease = 0
+        self.decreases = 0
+        self.alive = False  # 是否有过成功的请求
+        self.waiters = deque()  # 等待该窗口的异步请求
+
+    def full(self):
+        return self.inflight >= int(self.limit)
+
+    def free(self):
+        return int(self.limit) - self.inflight
+
+    def update(self, outcome, latency, now):
+        """
+        Update the window with a finished request
+
+        :return tuple: (old limit, new limit, reason) when the limit changed
+        """
+        old = int(self.limit)
+        saturated = self.inflight + 1 >= old
+        if outcome in ('timeout', 'overload'):
+            self.results.append(1)
+            rate = sum(self.results) / len(self.results)
+            cooldown = max(1.0, self.latency or 0)
+            if len(self.results) >= self.min_samples \
+                    and rate >= settings.request_adaptive_timeout_rate \
+                    and now - self.last_decrease >= cooldown:
+                self.limit = max(self.minimum, self.limit * settings.request_adaptive_decrease)
+                self.last_decrease = now
+                self.decreases += 1
+                self.results.clear()
+                reason = f'{outcome} rate {rate:.0%}'
+                return old, int(self.limit), reason
+            return None
+        self.results.append(0)
+        if outcome != 'ok':
+            return None
+        self.alive = True
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+        if not saturated or self.limit >= self.maximum:
+            return None
+        factor = settings.request_adaptive_latency_factor
+        if self.latency and self.min_latency \
+                and self.latency > max(self.min_latency * factor, 0.01):
+            return None  # 延迟上升说明已接近瓶颈
+        self.limit = min(self.limit + 1, self.maximum)
+        return old, int(self.limit), 'saturated without congestion'
+
+
+class Controller(object):
+    """
+    Adaptive concurrency controller of the request stage
+
+    :param int maximum:  max global concurrency
+    :param int initial:  initial global concurrency (default maximum)
+    :param int per_host: max concurrency of each IP
+    :param int per_asn:  max concurrency of each ASN (None means no ASN limit)
+    :param dict asns:    {ip: asn} of destination IPs
+    """
+    def __init__(self, maximum, initial=None, per_host=None, per_asn=None, asns=None):
+        minimum = min(settings.request_adaptive_min_num, maximum)
+        self.total = Window('global', maximum, minimum, initial, sample=100)
+        self.per_host = per_host or settings.request_per_host_num
+        self.per_asn = per_asn
+        self.asns = asns or dict()
+        self.windows = dict()
+        self.cond = threading.Condition()
+        self.stats = {'ok': 0, 'error': 0, 'timeout': 0, 'overload': 0}
+        self.latencies = list()  # 成功请求连接延迟的抽样
+        self.finished = 0
+        self.low = self.total.limit
+        self.high = self.total.limit
+
+    def get_windows(self, ip):
+        windows = [self.total]
+        if not ip:
+            return windows
+        keys = [('ip', ip, self.per_host)]
+        asn = self.asns.get(ip)
+        if self.per_asn and asn:
+            keys.append(('asn', asn, self.per_asn))
+        for kind, key, maximum in keys:
+            window = self.windows.get((kind, key))
+            if window is None:
+                window = Window(f'{kind} {key}', maximum)
+                self.windows[(kind, key)] = window
+            windows.append(window)
+        return windows
+
+    def blocker(self, windows):
+        for window in windows:
+            if window.full():
+                return window
+        return None
+
+    def enter(self, windows):
+        for window in windows:
+            window.inflight += 1
+
+    def leave(self, windows, resp, elapse):
+        outcome = classify(resp)
+        latency = None
+        if outcome == 'ok':
+            latency = get_latency(resp, elapse)
+            self.sample(latency)
+        self.stats[outcome] += 1
+        self.finished += 1
+        now = time.monotonic()
+        alive = all(window.alive for window in windows[1:])
+        for window in windows:
+            window.inflight -= 1
+            if window is self.total and outcome == 'timeout' and not alive:
+                change = window.update('error', latency, now)
+            else:
+                change = window.update(outcome, latency, now)
+            if change:
+                self.log_change(window, *change)
+        self.low = min(self.low, self.total.limit)
+        self.high = max(self.high, self.total.limit)
+
+    def sample(self, latency):
+        if len(self.latencies) < 10000:
+            self.latencies.append(latency)
+        else:  # 蓄水池抽样
+            index = random.randrange(self.finished + 1)
+            if index < 10000:
+                self.latencies[index] = latency
+
+    def log_change(self, window, old, new, reason):
+        level = 'INFOR' if window is self.total else 'DEBUG'
+        if new < old:
+            logger.log(level, f'Request concurrency of {window.name} decreased '
+                              f'{old} -> {new} ({reason})')
+        elif window is self.total and (new & (new - 1) == 0 or new == window.maximum):
+            # 增加并发只在达到2的幂或上限时记录 避免刷屏
+            logger.log('DEBUG', f'Request concurrency of {window.name} increased '
+                                f'{old} -> {new} ({reason})')
+
+    def acquire(self, ip):
+        """
+        Wait in the current thread until a request to the IP can be sent
+
+        :param str ip: destination IP
+        :return list: windows to pass to release
+        """
+        with self.cond:
+            windows = self.get_windows(ip)
+            while self.blocker(windows):
+                self.cond.wait()
+            self.enter(windows)
+        return windows
+
+    def release(self, windows, resp, elapse):
+        """
+        Release a request acquired in a thread
+
+        :param list windows: windows returned by acquire
+        :param resp: response or exception
+        :param float elapse: seconds the request took
+        """
+        with self.cond:
+            self.leave(windows, resp, elapse)
+            self.cond.notify_all()
+
+    async def acquire_async(self, ip):
+        """
+        Wait in the event loop until a request to the IP can be sent
+
+        :param str ip: destination IP
+        :return list: windows to pass to release_async
+        """
+        windows = self.get_windows(ip)
+        while True:
+            window = self.blocker(windows)
+            if window is None:
+                break
+            waiter = asyncio.get_event_loop().create_future()
+            window.waiters.append(waiter)
+            await waiter
+        self.enter(windows)
+        return windows
+
+    def release_async(self, windows, resp, elapse):
+        """
+        Release a request acquired in the event loop and wake up waiters
+        """
+        self.leave(windows, resp, elapse)
+        for window in windows:
+            for _ in range(min(window.free(), len(window.waiters))):
+                waiter = window.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def log_summary(self):
+        """
+        Log the decisions and latency of the run for tuning request_timeout_second
+        """
+        if not self.finished:
+            return
+        total = self.total
+        rate = (self.stats['timeout'] + self.stats['overload']) / self.finished
+        decreased = sum(1 for window in self.windows.values() if window.decreases)
+        logger.log('INFOR', f'Adaptive request concurrency: global {int(self.low)}-'
+                            f'{int(self.high)} (final {int(total.limit)}, max '
+                            f'{total.maximum}), decreased {total.decreases} times, '
+                            f'{decreased} destinations slowed down, timeout and '
+                            f'overload rate {rate:.1%}, results {self.stats}')
+        if not self.latencies:
+            return
+        latencies = sorted(self.latencies)
+
+        def percentile(num):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * num))]
+
+        p50, p95, p99 = percentile(0.5), percentile(0.95), percentile(0.99)
+        logger.log('INFOR', f'Request connect latency p50 {p50:.3f}s p95 {p95:.3f}s '
+                            f'p99 {p99:.3f}s, request_timeout_second is '
+                            f'{settings.request_timeout_second}, connect timeout of '
+                            f'about {max(3.0, p99 * 3):.1f}s is enough for 99% of '
+                            f'the alive urls')
@@ -0,0 +1,42 @@
+"""
+Bloom filter for compact deduplication of large generated dictionaries
+"""
+
+import hashlib
+import math
+
+
+class BloomFilter(object):
+    """
+    Bloom filter
+
+    :param int capacity:     expected item count
+    :param float error_rate: false positive rate when capacity items added
+    """
+    def __init__(self, capacity, error_rate=0.0001):
+        capacity = max(capacity, 1000)
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hash_num = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, item):
+        """
+        Add item
+
+        :param str item: item
+        :return bool: whether the item was not seen before
+        """
+        digest = hashlib.blake2b(item.encode('utf-8', 'ignore'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        bits = self.bits
+        size = self.size
+        new = False
+        for i in range(self.hash_num):
+            pos = (first + i * second) % size
+            index = pos >> 3
+            mask = 1 << (pos & 7)
+            if not bits[index] & mask:
+                bits[index] |= mask
+                new = True
+        return new
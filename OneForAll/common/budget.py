@@ -0,0 +1,82 @@
+"""
+Global concurrency budgets shared by all targets of one run
+"""
+
+import threading
+
+from common import utils
+from config import settings
+from config.log import logger
+
+
+class Budget(object):
+    """
+    Concurrency budget shared across threads
+
+    Each acquire takes a share of the budget and must be released after use,
+    when the budget is used up acquire blocks until other holders release.
+
+    :param str name:  budget name
+    :param int total: total budget (None means unlimited)
+    """
+    def __init__(self, name, total=None):
+        self.name = name
+        self.total = total
+        self.free = total
+        self.parties = 1  # 共享该预算的目标数量
+        self.cond = threading.Condition()
+
+    def acquire(self, want):
+        """
+        Acquire part of the budget
+
+        :param int want: wanted amount
+        :return int: granted amount
+        """
+        want = max(1, want)
+        if self.total is None:
+            return want
+        share = max(1, self.total // self.parties)
+        with self.cond:
+            while self.free < 1:
+                self.cond.wait()
+            grant = min(want, share, self.free)
+            self.free -= grant
+        logger.log('DEBUG', f'Granted {grant}/{want} of {self.name} budget, '
+                            f'{self.free}/{self.total} free')
+        return grant
+
+    def release(self, grant):
+        """
+        Release the granted budget
+
+        :param int grant: granted amount
+        """
+        if self.total is None:
+            return
+        with self.cond:
+            self.free += grant
+            self.cond.notify_all()
+
+    def share(self, parties):
+        """
+        Divide budget evenly among parties
+
+        :param int parties: number of targets running at the same time
+        """
+        self.parties = max(1, parties)
+
+
+def get_http_total():
+    count = settings.global_request_thread_num
+    if isinstance(count, int):
+        return count
+    count = settings.request_thread_count
+    if isinstance(count, int):
+        return max(16, count)
+    return utils.get_request_count()
+
+
+dns_budget = Budget('DNS', settings.global_dns_concurrent_num)
+http_budget = Budget('HTTP', get_http_total())
+aio_http_budget = Budget('AsyncHTTP', settings.global_request_async_num)
@@ -0,0 +1,157 @@
+"""
+Pooled keep-alive HTTP client shared by all collection modules
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+
+from config import settings
+from config.log import logger
+
+lock = threading.Lock()
+session = None
+
+
+class PoolAdapter(HTTPAdapter):
+    """
+    HTTP adapter with per-host connection pools that keeps the connection
+    statistics of the pools evicted from the pool manager
+    """
+    def __init__(self, *args, **kwargs):
+        self.stats_lock = threading.Lock()
+        self.connections = 0  # 已回收连接池新建的连接数
+        self.requests = 0  # 已回收连接池发送的请求数
+        super().__init__(*args, **kwargs)
+
+    def dispose(self, pool):
+        with self.stats_lock:
+            self.connections += pool.num_connections
+            self.requests += pool.num_requests
+        pool.close()
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pools.dispose_func = self.dispose
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        new = proxy not in self.proxy_manager
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if new:
+            manager.pools.dispose_func = self.dispose
+        return manager
+
+    def get_managers(self):
+        return [self.poolmanager, *self.proxy_manager.values()]
+
+    def get_stats(self):
+        """
+        Get connection statistics
+
+        :return: (new connection count, request count)
+        """
+        with self.stats_lock:
+            connections, count = self.connections, self.requests
+        for manager in self.get_managers():
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                count += pool.num_requests
+        return connections, count
+
+
+class ScopedCookieJar(RequestsCookieJar):
+    """
+    Cookie jar that keeps the cookies of each thread apart
+    """
+    def __init__(self, policy=None):
+        self.local = threading.local()
+        super().__init__(policy)
+
+    @property
+    def _cookies(self):
+        cookies = getattr(self.local, 'cookies', None)
+        if cookies is None:
+            cookies = self.local.cookies = dict()
+        return cookies
+
+    @_cookies.setter
+    def _cookies(self, cookies):
+        self.local.cookies = cookies
+
+
+class Session(requests.Session):
+    """
+    Session whose cookies only live for one request
+
+    Cookies set by the responses of a redirect chain are sent with the
+    following requests of the chain, then cleared when the call returns so
+    they do not leak into the other requests of the same or other modules.
+    """
+    def __init__(self):
+        super().__init__()
+        self.cookies = ScopedCookieJar()
+
+    def request(self, *args, **kwargs):
+        try:
+            return super().request(*args, **kwargs)
+        finally:
+            self.cookies.clear()  # 只清除当前线程的cookie
+
+
+def new_session():
+    new = Session()
+    new.trust_env = False
+    adapter = PoolAdapter(pool_connections=settings.http_pool_host_num,
+                          pool_maxsize=settings.http_pool_max_size)
+    new.mount('http://', adapter)
+    new.mount('https://', adapter)
+    return new
+
+
+def get_session():
+    """
+    Get the process-wide pooled session
+
+    Proxy, header, cookie, timeout and verify are passed with each request so
+    the session only holds the connection pools.
+
+    :return: session
+    """
+    global session
+    if session is None:
+        with lock:
+            if session is None:
+                session = new_session()
+    return session
+
+
+def get_stats():
+    """
+    Get connection reuse statistics of the shared session
+
+    :return dict: statistics
+    """
+    connections = count = 0
+    if session is not None:
+        for adapter in {id(a): a for a in session.adapters.values()}.values():
+            if isinstance(adapter, PoolAdapter):
+                conn_num, req_num = adapter.get_stats()
+                connections += conn_num
+                count += req_num
+    return {'connections': connections, 'requests': count,
+            'reused': max(0, count - connections)}
+
+
+def log_stats():
+    stats = get_stats()
+    if not stats['requests']:
+        return
+    rate = round(stats['reused'] / stats['requests'] * 100, 1)
+    logger.log('INFOR', f'HTTP client sent {stats["requests"]} requests over '
+                        f'{stats["connections"]} connections, '
+                        f'{stats["reused"]} ({rate}%) reused connections')
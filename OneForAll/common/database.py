@@ -2,16 +2,219 @@
 SQLite database initialization and operation
 """
 
-from common import records
+import sqlite3
+import threading
+
+from sqlalchemy import event
+
+from common import records, respstore, sqlitedb
 
 from common.records import Connection
 from config.log import logger
 from config import settings
 
+# 结果表的字段及类型
+columns = [('id', 'integer primary key'), ('alive', 'int'), ('request', 'int'),
+           ('resolve', 'int'), ('url', 'text'), ('subdomain', 'text'),
+           ('port', 'int'), ('level', 'int'), ('cname', 'text'), ('ip', 'text'),
+           ('public', 'int'), ('cdn', 'int'), ('status', 'int'), ('reason', 'text'),
+           ('title', 'text'), ('banner', 'text'), ('header', 'text'),
+           ('history', 'text'), ('response', 'text'), ('truncated', 'int'),
+           ('content_length', 'int'), ('body_hash', 'text'), ('ip_times', 'text'),
+           ('cname_times', 'text'), ('ttl', 'text'), ('cidr', 'text'),
+           ('asn', 'text'), ('org', 'text'), ('addr', 'text'), ('isp', 'text'),
+           ('resolver', 'text'), ('module', 'text'), ('source', 'text'),
+           ('elapse', 'float'), ('find', 'int'), ('change', 'text'),
+           ('resolve_time', 'int'), ('request_time', 'int')]
+fields = [name for name, _ in columns]
+field_str = ', '.join(fields)
+param_str = ', '.join(f':{name}' for name in fields)
+# 结果表按这些字段查询、分组和排序
+index_fields = ['url', 'subdomain', 'alive', 'ip']
+version_table = 'schema_version'
+# 同一子域同一端口只保存一行 没有端口的结果按端口0处理
+unique_key = 'subdomain, ifnull(port, 0)'
+# 记录子域最先由哪个模块发现的字段 冲突时保留先保存的非空值
+provenance_fields = ['module', 'source', 'elapse', 'find']
+
+
+def gen_merge_str(overwrite):
+    """
+    Generate the set clause merging a conflicting row into the saved row
+
+    :param bool overwrite: the other fields are overwritten by the later row
+                           (resolve and request results), otherwise only its
+                           non-null values are used (collection results)
+    :return str: set clause
+    """
+    items = list()
+    for name in fields:
+        if name == 'id':
+            continue
+        if name in provenance_fields:
+            items.append(f'"{name}" = coalesce("{name}", excluded."{name}")')
+        elif overwrite:
+            items.append(f'"{name}" = excluded."{name}"')
+        else:
+            items.append(f'"{name}" = coalesce(excluded."{name}", "{name}")')
+    return ', '.join(items)
+
+
+# 收集结果冲突时后保存的空值不覆盖已有值 解析和请求结果冲突时使用后保存的值
+merge_str = gen_merge_str(False)
+update_str = gen_merge_str(True)
+upsert_supported = sqlite3.sqlite_version_info >= (3, 24, 0)
+update_from_supported = sqlite3.sqlite_version_info >= (3, 33, 0)
+# 每个数据库只建一次的records引擎 {数据库url: records.Database}
+engines = dict()
+engine_lock = threading.Lock()
+
+
+def set_pragmas(dbapi_conn, connection_record):
+    sqlitedb.set_pragmas(dbapi_conn)
+
+
+def get_db_path(db_path=None):
+    """
+    Get the database file path, the default database is used when empty
+
+    :param db_path: database path
+    :return str: database path
+    """
+    if not db_path:  # 数据库路径为空连接默认数据库
+        return f'{settings.result_save_dir}/result.sqlite3'
+    return str(db_path)
+
+
+def create_indexes(db, table_name):
+    """
+    Create the indexes of a result table
+
+    :param Database db: database
+    :param str table_name: table name
+    """
+    for name in index_fields:
+        db.query(f'create index if not exists "{table_name}_{name}_index" '
+                 f'on "{table_name}" ("{name}")')
+
+
+def merge_duplicates(db, table_name):
+    """
+    Merge the rows of the same subdomain and port into the first row, null
+    fields of the first row are filled with the values of the later rows and
+    the modules and sources of all rows are kept in the source table
+
+    :param Database db: database
+    :param str table_name: table name
+    :return int: count of merged rows
+    """
+    results = db.query(f'select count() - (select count() from (select 1 from '
+                       f'"{table_name}" group by {unique_key})) '
+                       f'from "{table_name}"')
+    count = results.scalar(0) if results else 0
+    if not count:
+        return 0
+    same = (f'dup.subdomain is "{table_name}".subdomain and '
+            f'ifnull(dup.port, 0) = ifnull("{table_name}".port, 0)')
+    set_str = ', '.join(f'"{name}" = coalesce("{name}", (select dup."{name}" '
+                        f'from "{table_name}" as dup where {same} and '
+                        f'dup."{name}" is not null order by dup.id limit 1))'
+                        for name in fields if name != 'id')
+    conn = db.native
+    with conn:  # 合并和删除在一个事务中完成
+        conn.execute(f'update "{table_name}" set {set_str} where id in '
+                     f'(select min(id) from "{table_name}" group by {unique_key} '
+                     f'having count() > 1)')
+        conn.execute(f'insert or ignore into "{table_name}_source" '
+                     f'(subdomain, module, source) select subdomain, module, source '
+                     f'from "{table_name}" where subdomain is not null '
+                     f'and source is not null')
+        conn.execute(f'delete from "{table_name}" where id not in '
+                     f'(select min(id) from "{table_name}" group by {unique_key})')
+    return count
+
+
+def create_unique_index(db, table_name):
+    """
+    Deduplicate a result table and create its unique index
+
+    :param Database db: database
+    :param str table_name: table name
+    """
+    count = merge_duplicates(db, table_name)
+    if count:
+        logger.log('ALERT', f'Merged {count} duplicate rows of the same subdomain '
+                            f'and port in {table_name} table')
+    db.query(f'create unique index if not exists "{table_name}_unique_index" '
+             f'on "{table_name}" ({unique_key})')
+
+
+# 结果表的迁移 第n个迁移把表从版本n-1升级到版本n 版本0是没有记录版本的旧表
+migrations = [create_indexes, create_unique_index]
+schema_version = len(migrations)
+
+
+def get_insert_sql(table_name, overwrite=False):
+    sql = f'insert into "{table_name}" ({field_str}) values ({param_str})'
+    if not upsert_supported:  # 旧版SQLite不支持UPSERT 只保留先保存的行
+        return sql.replace('insert into', 'insert or ignore into', 1)
+    set_str = update_str if overwrite else merge_str
+    return f'{sql} on conflict ({unique_key}) do update set {set_str}'
+
+
+def get_source_sql(table_name):
+    return (f'insert or ignore into "{table_name}_source" '
+            f'(subdomain, module, source) values (?, ?, ?)')
+
+
+def gen_sources(results):
+    """
+    Generate the provenance rows of results
+
+    :param list results: results
+    :return set: (subdomain, module, source) rows
+    """
+    return {(result.get('subdomain'), result.get('module'), result.get('source'))
+            for result in results if result.get('subdomain') and result.get('source')}
+
+
+def gen_row(result):
+    """
+    Generate a row with all fields of the result table, missing fields are None
+
+    :param dict result: result
+    :return dict: row
+    """
+    return {name: result.get(name) for name in fields}
+
 
 class Database(object):
+    """
+    Result database, queries run on the long-lived sqlite3 connection of the
+    current thread, the records connection is only opened when used
+
+    :param db_path: database path or records connection (default result database)
+    """
     def __init__(self, db_path=None):
-        self.conn = self.get_conn(db_path)
+        self._conn = None
+        if isinstance(db_path, Connection):
+            self._conn = db_path
+            self.path = None
+        else:
+            self.path = get_db_path(db_path)
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = self.get_conn(self.path)
+        return self._conn
+
+    @property
+    def native(self):
+        if self.path is None:
+            # 传入的records连接 取其SQLAlchemy连接下的sqlite3连接
+            return self.conn._conn.connection.connection
+        return sqlitedb.connect(self.path)
 
     @staticmethod
     def get_conn(db_path):
@@ -24,108 +227,225 @@ class Database(object):
         logger.log('TRACE', f'Establishing database connection')
         if isinstance(db_path, Connection):
             return db_path
-        protocol = 'sqlite:///'
-        if not db_path:  # 数据库路径为空连接默认数据库
-            db_path = f'{protocol}{settings.result_save_dir}/result.sqlite3'
-        else:
-            db_path = f'{protocol}{db_path}'
-        db = records.Database(db_path)  # 不存在数据库时会新建一个数据库
-        logger.log('TRACE', f'Use the database: {db_path}')
+        db_url = f'sqlite:///{get_db_path(db_path)}'
+        with engine_lock:
+            db = engines.get(db_url)
+            if db is None:
+                # 多个目标同时写入时等待锁释放而不是直接报database is locked
+                db = records.Database(db_url, connect_args={'timeout': 60})  # 不存在数据库时会新建一个数据库
+                event.listen(db._engine, 'connect', set_pragmas)
+                engines[db_url] = db
+        logger.log('TRACE', f'Use the database: {db_url}')
         return db.get_connection()
 
-    def query(self, sql):
+    def query(self, sql, **params):
+        """
+        Execute a statement, statements changing data are committed
+
+        :param str sql: sql statement
+        :param params: named parameters of the statement
+        :return: Rows (None when failed)
+        """
+        conn = self.native
         try:
-            results = self.conn.query(sql)
+            with conn:  # 成功时提交 失败时回滚
+                cursor = conn.execute(sql, params)
         except Exception as e:
             logger.log('ERROR', e.args)
             return None
-        return results
+        return sqlitedb.Rows(cursor)
 
     def create_table(self, table_name):
         """
-        Create table
+        Create table, the table is migrated to the current schema if exists
 
         :param str table_name: table name
         """
         table_name = table_name.replace('.', '_')
         if self.exist_table(table_name):
             logger.log('TRACE', f'{table_name} table already exists')
+            self.migrate(table_name)
             return
         logger.log('TRACE', f'Creating {table_name} table')
-        self.query(f'create table "{table_name}" ('
-                   f'id integer primary key,'
-                   f'alive int,'
-                   f'request int,'
-                   f'resolve int,'
-                   f'url text,'
-                   f'subdomain text,'
-                   f'port int,'
-                   f'level int,'
-                   f'cname text,'
-                   f'ip text,'
-                   f'public int,'
-                   f'cdn int,'
-                   f'status int,'
-                   f'reason text,'
-                   f'title text,'
-                   f'banner text,'
-                   f'header text,'
-                   f'history text,'
-                   f'response text,'
-                   f'ip_times text,'
-                   f'cname_times text,'
-                   f'ttl text,'
-                   f'cidr text,'
-                   f'asn text,'
-                   f'org text,'
-                   f'addr text,'
-                   f'isp text,'
-                   f'resolver text,'
-                   f'module text,'
-                   f'source text,'
-                   f'elapse float,'
-                   f'find int)')
+        column_str = ', '.join(f'"{name}" {kind}' for name, kind in columns)
+        self.query(f'create table "{table_name}" ({column_str})')
+        self.create_source_table(table_name)
+        self.run_migrations(table_name, 0)
+        self.set_version(table_name, schema_version)
+
+    def create_source_table(self, table_name):
+        """
+        Create the side table of all the modules and sources finding each subdomain
+
+        :param str table_name: result table name
+        """
+        self.query(f'create table if not exists "{table_name}_source" '
+                   f'(subdomain text, module text, source text, '
+                   f'unique (subdomain, module, source))')
+
+    def get_version(self, table_name):
+        """
+        Get the schema version of a result table
+
+        :param str table_name: table name
+        :return int: schema version (0 means created by older versions)
+        """
+        self.query(f'create table if not exists "{version_table}" '
+                   f'(name text primary key, version int)')
+        results = self.query(f'select version from "{version_table}" '
+                             f'where name = :name', name=table_name)
+        if results is None:
+            return 0
+        return results.scalar() or 0
+
+    def set_version(self, table_name, version):
+        self.query(f'create table if not exists "{version_table}" '
+                   f'(name text primary key, version int)')
+        self.query(f'insert or replace into "{version_table}" (name, version) '
+                   f'values (:name, :version)', name=table_name, version=version)
+
+    def migrate(self, table_name):
+        """
+        Upgrade a result table created by older versions to the current schema
+
+        :param str table_name: table name
+        """
+        table_name = table_name.replace('.', '_')
+        self.add_missing_columns(table_name)
+        self.create_source_table(table_name)
+        version = self.get_version(table_name)
+        if version >= schema_version:
+            return
+        self.run_migrations(table_name, version)
+        self.set_version(table_name, schema_version)
+
+    def run_migrations(self, table_name, start, end=schema_version):
+        for number in range(start, end):
+            logger.log('DEBUG', f'Migrating {table_name} table to schema version {number + 1}')
+            migrations[number](self, table_name)
+
+    def add_missing_columns(self, table_name):
+        """
+        Add the columns missing in tables created by older versions
+
+        :param str table_name: table name
+        """
+        table_name = table_name.replace('.', '_')
+        results = self.query(f'pragma table_info("{table_name}")')
+        if results is None:
+            return
+        exist_names = {row.name for row in results}
+        for name, kind in columns:
+            if name in exist_names:
+                continue
+            logger.log('DEBUG', f'Adding {name} column to {table_name} table')
+            self.query(f'alter table "{table_name}" add column "{name}" {kind}')
 
     def insert_table(self, table_name, result):
+        self.insert_rows(table_name, [result])
+
+    def insert_rows(self, table_name, results, overwrite=False):
+        """
+        Insert results with one prepared statement in one transaction, results
+        of a subdomain and port already saved are merged into the saved row,
+        the error is raised after rolling back when the results fail to save
+
+        :param str table_name: table name
+        :param list results: results list
+        :param bool overwrite: overwrite the saved fields with null values too,
+                               used by resolve and request results (default False)
+        """
         table_name = table_name.replace('.', '_')
-        self.conn.query(
-            f'insert into "{table_name}" '
-            f'(id, alive, resolve, request, url, subdomain, port, level,'
-            f'cname, ip, public, cdn, status, reason, title, banner, header,'
-            f'history, response, ip_times, cname_times, ttl, cidr, asn, org,'
-            f'addr, isp, resolver, module, source, elapse, find) '
-            f'values (:id, :alive, :resolve, :request, :url,'
-            f':subdomain, :port, :level, :cname, :ip, :public, :cdn,'
-            f':status, :reason, :title, :banner, :header, :history, :response,'
-            f':ip_times, :cname_times, :ttl, :cidr, :asn, :org, :addr, :isp,'
-            f':resolver, :module, :source, :elapse, :find)', **result)
-
-    def save_db(self, table_name, results, module_name=None):
+        rows = [gen_row(result) for result in results]
+        conn = self.native
+        try:
+            with conn:  # 成功时提交 失败时回滚
+                conn.executemany(get_insert_sql(table_name, overwrite), rows)
+                conn.executemany(get_source_sql(table_name), gen_sources(results))
+        except Exception as e:
+            logger.log('ERROR', f'Failed to save {len(rows)} results into {table_name} table')
+            logger.log('ERROR', e)
+            raise
+
+    def insert_sources(self, table_name, results):
+        """
+        Only record which modules and sources found the subdomains of results,
+        the error is raised after rolling back when failed
+
+        :param str table_name: table name
+        :param list results: results list
+        """
+        table_name = table_name.replace('.', '_')
+        conn = self.native
+        try:
+            with conn:
+                conn.executemany(get_source_sql(table_name), gen_sources(results))
+        except Exception as e:
+            logger.log('ERROR', f'Failed to save the sources of {len(results)} '
+                                f'results into {table_name} table')
+            logger.log('ERROR', e)
+            raise
+
+    def save_db(self, table_name, results, module_name=None, overwrite=False):
         """
         Save the results of each module in the database
 
         :param str table_name: table name
         :param list results: results list
         :param str module_name: module
+        :param bool overwrite: overwrite the saved fields with null values too
+        :return bool: whether the results were saved
         """
         logger.log('TRACE', f'Saving the subdomain results of {table_name} '
                             f'found by module {module_name} into database')
-        table_name = table_name.replace('.', '_')
-        if results:
-            try:
-                self.conn.bulk_query(
-                    f'insert into "{table_name}" '
-                    f'(id, alive, resolve, request, url, subdomain, port, level, '
-                    f'cname, ip, public, cdn, status, reason, title, banner, header, '
-                    f'history, response, ip_times, cname_times, ttl, cidr, asn, org, '
-                    f'addr, isp, resolver, module, source, elapse, find) '
-                    f'values (:id, :alive, :resolve, :request, :url, '
-                    f':subdomain, :port, :level, :cname, :ip, :public, :cdn,'
-                    f':status, :reason, :title, :banner, :header, :history, :response, '
-                    f':ip_times, :cname_times, :ttl, :cidr, :asn, :org, :addr, :isp, '
-                    f':resolver, :module, :source, :elapse, :find)', results)
-            except Exception as e:
-                logger.log('ERROR', e)
+        if not results:
+            return True
+        try:
+            self.insert_rows(table_name, results, overwrite)
+        except Exception:  # 已在insert_rows中记录
+            return False
+        return True
+
+    def create_blob_table(self):
+        """
+        Create the response blob table if not exists
+        """
+        self.query(f'create table if not exists "{respstore.blob_table}" '
+                   f'(hash text primary key, title text, size int, data blob)')
+
+    def save_blobs(self, rows):
+        """
+        Save response blobs, blobs already saved are ignored
+
+        :param list rows: blob rows of hash, title, size and data
+        """
+        self.create_blob_table()
+        conn = self.native
+        try:
+            with conn:
+                conn.executemany(f'insert or ignore into "{respstore.blob_table}" '
+                                 f'(hash, title, size, data) values '
+                                 f'(:hash, :title, :size, :data)', rows)
+        except Exception as e:
+            logger.log('ERROR', e)
+
+    def get_blob_text(self, body_hash):
+        """
+        Get the response text of a body hash
+
+        :param str body_hash: body hash
+        :return str: response text (None when not saved)
+        """
+        if not self.exist_table(respstore.blob_table):
+            return None
+        results = self.query(f'select data from "{respstore.blob_table}" '
+                             f'where hash = :hash', hash=body_hash)
+        if results is None:
+            return None
+        data = results.scalar()
+        if data is None:
+            return None
+        return respstore.decompress_text(data)
 
     def exist_table(self, table_name):
         """
@@ -136,9 +456,9 @@ class Database(object):
         """
         table_name = table_name.replace('.', '_')
         logger.log('TRACE', f'Determining whether the {table_name} table exists')
-        results = self.query(f'select count() from sqlite_master where type = "table" and'
-                             f' name = "{table_name}"')
-        if results.scalar() == 0:
+        results = self.query('select count() from sqlite_master where type = :type '
+                             'and name = :name', type='table', name=table_name)
+        if results is None or results.scalar() == 0:
             return False
         else:
             return True
@@ -176,6 +496,10 @@ class Database(object):
         table_name = table_name.replace('.', '_')
         logger.log('TRACE', f'Deleting {table_name} table')
         self.query(f'drop table if exists "{table_name}"')
+        self.query(f'drop table if exists "{table_name}_source"')
+        if self.exist_table(version_table):
+            self.query(f'delete from "{version_table}" where name = :name',
+                       name=table_name)
 
     def rename_table(self, table_name, new_table_name):
         """
@@ -189,6 +513,21 @@ class Database(object):
         logger.log('TRACE', f'Renaming {table_name} table to {new_table_name} table')
         self.query(f'alter table "{table_name}" '
                    f'rename to "{new_table_name}"')
+        if self.exist_table(f'{table_name}_source'):
+            self.query(f'drop table if exists "{new_table_name}_source"')
+            self.query(f'alter table "{table_name}_source" '
+                       f'rename to "{new_table_name}_source"')
+        # 索引名包含表名 重建索引以免与之后新建的同名表冲突
+        results = self.query('select name from sqlite_master where type = :type '
+                             'and tbl_name = :table and sql is not null',
+                             type='index', table=new_table_name)
+        for row in results.all() if results else ():
+            self.query(f'drop index if exists "{row.name}"')
+        version = self.get_version(table_name)
+        self.query(f'delete from "{version_table}" where name = :name', name=table_name)
+        if version:
+            self.run_migrations(new_table_name, 0, version)
+            self.set_version(new_table_name, version)
 
     def deduplicate_subdomain(self, table_name):
         """
@@ -234,7 +573,7 @@ class Database(object):
         table_name = table_name.replace('.', '_')
         sql = f'select id, alive, request, resolve, url, subdomain, level,' \
               f'cname, ip, public, cdn, port, status, reason, title, banner,' \
-              f'cidr, asn, org, addr, isp, source from "{table_name}" '
+              f'cidr, asn, org, addr, isp, source, change from "{table_name}" '
         if alive and limit:
             if limit in ['resolve', 'request']:
                 where = f' where {limit} = 1'
@@ -253,9 +592,17 @@ class Database(object):
 
     def get_resp_by_url(self, table_name, url):
         table_name = table_name.replace('.', '_')
-        sql = f'select response from "{table_name}" where url = "{url}"'
+        sql = f'select response, body_hash from "{table_name}" where url = :url'
         logger.log('TRACE', f'Get response data from {url}')
-        return self.query(sql).scalar()
+        results = self.query(sql, url=url)
+        if results is None:
+            return None
+        row = results.first()
+        if row is None:
+            return None
+        if row.response is not None or not row.body_hash:
+            return row.response  # 未使用响应体存储时保存的结果
+        return self.get_blob_text(row.body_hash)
 
     def get_data_by_fields(self, table_name, fields):
         table_name = table_name.replace('.', '_')
@@ -270,8 +617,47 @@ class Database(object):
         sql = f'update "{table_name}" set {field_str} where url = "{url}"'
         return self.query(sql)
 
+    def update_data_by_urls(self, table_name, data, fields):
+        """
+        Update the fields of the rows of many urls with one set based update
+        in one transaction, data without url is skipped
+
+        :param str table_name: table name
+        :param list data: data with url and the fields to update
+        :param list fields: fields to update
+        """
+        table_name = table_name.replace('.', '_')
+        names = ['url'] + list(fields)
+        rows = [[info.get(name) for name in names] for info in data if info.get('url')]
+        if not rows:
+            return
+        column_str = ', '.join(f'"{name}"' for name in fields)
+        value_str = ', '.join(f'u."{name}"' for name in fields)
+        if update_from_supported:
+            set_str = ', '.join(f'"{name}" = u."{name}"' for name in fields)
+            sql = (f'update "{table_name}" set {set_str} from temp.update_data as u '
+                   f'where "{table_name}".url = u.url')
+        else:  # 旧版SQLite不支持UPDATE FROM
+            sql = (f'update "{table_name}" set ({column_str}) = (select {value_str} '
+                   f'from temp.update_data as u where u.url = "{table_name}".url) '
+                   f'where url in (select url from temp.update_data)')
+        conn = self.native
+        try:
+            with conn:  # 成功时提交 失败时回滚
+                conn.execute('drop table if exists temp.update_data')
+                conn.execute(f'create temp table update_data '
+                             f'(url text primary key, {column_str})')
+                conn.executemany(f'insert or replace into temp.update_data '
+                                 f'values ({", ".join("?" for _ in names)})', rows)
+                conn.execute(sql)
+                conn.execute('drop table temp.update_data')
+        except Exception as e:
+            logger.log('ERROR', e)
+
     def close(self):
         """
-        Close the database connection
+        Close the records connection, the sqlite3 connection of the thread is
+        kept for later queries
         """
-        self.conn.close()
+        if self._conn is not None:
+            self._conn.close()
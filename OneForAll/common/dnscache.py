@@ -0,0 +1,159 @@
+"""
+DNS result cache shared by all resolution stages of one run
+
+Resolved subdomain infos are kept in memory until their DNS records expire,
+subdomains without result are kept for the negative TTL. At most
+dns_cache_size records are kept in memory, the least recently used ones are
+dropped first. The cache can be backed by a SQLite database so that it
+survives between runs.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+from dns.resolver import LRUCache
+
+from common import utils
+from common.database import Database
+from config import settings
+from config.log import logger
+
+answer_cache = LRUCache(settings.dns_cache_size)  # dnspython解析器共享的应答缓存
+
+
+def get_expire(info, now):
+    """
+    Get expire time of resolved info
+
+    :param dict info: resolved info or None when no result
+    :param int now: timestamp
+    :return int: expire timestamp
+    """
+    max_ttl = settings.dns_cache_max_ttl
+    if not info or info.get('resolve') != 1:
+        return now + min(settings.dns_cache_negative_ttl, max_ttl)
+    ttl = info.get('ttl')
+    try:
+        min_ttl = min(int(item) for item in str(ttl).split(','))
+    except ValueError:
+        min_ttl = 0
+    return now + min(min_ttl, max_ttl)
+
+
+class LRUDict(OrderedDict):
+    """
+    Thread safe dict that drops the least recently used items beyond its size
+
+    :param int size: max item count
+    """
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return self[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            while len(self) > self.size:
+                self.popitem(last=False)
+
+
+class ResolveCache(object):
+    """
+    TTL respecting cache of resolved subdomain infos
+
+    :param path: SQLite database path (None means memory only)
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = LRUDict(settings.dns_cache_size)  # {子域: (过期时间, 解析信息)}
+        self.hits = 0
+        self.misses = 0
+        if self.path:
+            db = Database(self.path)
+            db.query('create table if not exists resolve ('
+                     'subdomain text primary key, info text, expire int)')
+            db.close()
+
+    def load(self, subdomains, now):
+        """
+        Load unexpired records from the database into memory
+        """
+        db = Database(self.path)
+        for i in range(0, len(subdomains), 500):
+            batch = subdomains[i:i + 500]
+            params = {f's{j}': subdomain for j, subdomain in enumerate(batch)}
+            marks = ', '.join(f':{key}' for key in params)
+            rows = db.conn.query(f'select subdomain, info, expire from resolve '
+                                 f'where expire > :now and subdomain in ({marks})',
+                                 now=now, **params)
+            with self.lock:
+                for row in rows:
+                    self.records[row.subdomain] = (row.expire, json.loads(row.info))
+        db.close()
+
+    def lookup(self, subdomains):
+        """
+        Look up subdomains
+
+        :param list subdomains: subdomains to be resolved
+        :return: (cached infos, subdomains not cached), the info of a cached
+                 subdomain without result is None
+        """
+        now = utils.get_timestamp()
+        if self.path:
+            with self.lock:
+                unknown = [item for item in subdomains if item not in self.records]
+            self.load(unknown, now)
+        cached = dict()
+        misses = list()
+        with self.lock:
+            for subdomain in subdomains:
+                record = self.records.get(subdomain)
+                if record and record[0] > now:
+                    cached[subdomain] = record[1]
+                else:
+                    misses.append(subdomain)
+        self.hits += len(cached)
+        self.misses += len(misses)
+        logger.log('INFOR', f'DNS cache hit {len(cached)} subdomains, '
+                            f'{len(misses)} subdomains to be resolved')
+        return cached, misses
+
+    def store(self, subdomains, infos):
+        """
+        Store resolved results, subdomains without result are cached as negative
+
+        :param list subdomains: resolved subdomains
+        :param dict infos: resolved infos
+        """
+        now = utils.get_timestamp()
+        rows = list()
+        with self.lock:
+            for subdomain in subdomains:
+                info = infos.get(subdomain)
+                if info is not None:
+                    info = dict(info)
+                expire = get_expire(info, now)
+                self.records[subdomain] = (expire, info)
+                rows.append({'subdomain': subdomain, 'info': json.dumps(info),
+                             'expire': expire})
+        if self.path and rows:
+            db = Database(self.path)
+            db.conn.bulk_query('insert or replace into resolve (subdomain, info, expire) '
+                               'values (:subdomain, :info, :expire)', rows)
+            db.close()
+
+
+resolve_cache = ResolveCache(settings.dns_cache_path)
+wildcard_cache = LRUDict(settings.dns_cache_size)  # {主域: (过期时间, 是否泛解析)}
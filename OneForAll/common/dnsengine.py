@@ -0,0 +1,469 @@
+"""
+Built-in asyncio UDP DNS resolution engine
+
+An in-process alternative to massdns: raw DNS queries are sent to the
+nameserver pool over a few UDP sockets with a bounded in-flight window,
+unanswered queries are retried on other nameservers and the answers are
+handed to a callback in the same structure as the massdns JSON output.
+Truncated answers are queried again over TCP.
+"""
+
+import asyncio
+import json
+import random
+import socket
+import struct
+import time
+from collections import deque
+
+from config import settings
+from config.log import logger
+
+header_struct = struct.Struct('>HHHHHH')
+answer_struct = struct.Struct('>HHIH')
+qtypes = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15,
+          'TXT': 16, 'AAAA': 28, 'SRV': 33}
+qtype_names = {value: key for key, value in qtypes.items()}
+rcodes = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN',
+          4: 'NOTIMP', 5: 'REFUSED'}
+retry_rcodes = {2, 5}  # 换名称服务器重查的响应码
+truncated_flag = 0x0200  # TC标志 应答超出UDP报文长度被截断
+
+
+def read_nameservers(ns_path):
+    """
+    Read nameserver addresses, each line is ip or ip:port
+
+    :param ns_path: nameservers file path
+    :return list: (ip, port) list
+    """
+    nameservers = list()
+    with open(ns_path) as fd:
+        for line in fd:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.count(':') > 1:  # 只使用IPv4名称服务器
+                continue
+            ip, _, port = line.partition(':')
+            nameservers.append((ip, int(port or 53)))
+    return nameservers
+
+
+def encode_question(name, qtype):
+    """
+    Encode question section
+
+    :param str name: query name
+    :param int qtype: query type
+    :return bytes: question or None when the name is invalid
+    """
+    try:
+        labels = name.rstrip('.').encode('ascii').split(b'.')
+    except UnicodeEncodeError:
+        return None
+    body = bytearray()
+    for label in labels:
+        length = len(label)
+        if not 0 < length < 64:
+            return None
+        body.append(length)
+        body += label
+    if len(body) > 254:
+        return None
+    body += b'\x00'
+    body += struct.pack('>HH', qtype, 1)
+    return bytes(body)
+
+
+def read_name(buf, offset):
+    """
+    Read a possibly compressed domain name
+
+    :return: (name, offset after the name)
+    """
+    labels = list()
+    end = None
+    jumps = 0
+    while True:
+        length = buf[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | buf[offset + 1]
+            jumps += 1
+            if jumps > 32:
+                raise ValueError('Compression loop')
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(buf[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+    if end is None:
+        end = offset
+    return '.'.join(labels) + '.', end
+
+
+def parse_answers(buf, offset, count, qname):
+    """
+    Parse answer section
+
+    :param bytes buf: response packet
+    :param int offset: answer section offset
+    :param int count: answer count
+    :param str qname: query name
+    :return list: answers in massdns output structure
+    """
+    answers = list()
+    for _ in range(count):
+        if buf[offset] == 0xC0 and buf[offset + 1] == 12:  # 指向问题部分的压缩名称
+            name = qname
+            offset += 2
+        else:
+            name, offset = read_name(buf, offset)
+        rtype, rclass, ttl, length = answer_struct.unpack_from(buf, offset)
+        offset += 10
+        rdata = buf[offset:offset + length]
+        if rtype == 1 and length == 4:
+            data = socket.inet_ntoa(rdata)
+        elif rtype == 28 and length == 16:
+            data = socket.inet_ntop(socket.AF_INET6, rdata)
+        elif rtype in (2, 5, 12):
+            data, _ = read_name(buf, offset)
+        else:
+            data = rdata.hex()
+        offset += length
+        answers.append({'ttl': ttl, 'type': qtype_names.get(rtype, str(rtype)),
+                        'class': 'IN', 'name': name, 'data': data})
+    return answers
+
+
+class DNSEngine(object):
+    """
+    Asyncio UDP DNS resolution engine
+
+    The sockets are non-blocking and registered as readers of the event loop,
+    each wakeup drains all queued datagrams so that the loop overhead is not
+    paid per packet.
+
+    :param list nameservers: (ip, port) list
+    :param int concurrent:   max in-flight queries
+    :param str qtype:        query type
+    :param int tries:        max tries of each name
+    :param float timeout:    seconds to wait for each try
+    :param int sockets:      UDP socket count
+    """
+    def __init__(self, nameservers, concurrent=None, qtype='A', tries=None,
+                 timeout=None, sockets=None):
+        if not nameservers:
+            raise ValueError('No nameserver to resolve')
+        self.nameservers = list(nameservers)
+        random.shuffle(self.nameservers)
+        self.concurrent = concurrent or settings.brute_concurrent_num
+        self.qtype = qtypes.get(qtype, 1)
+        self.qtype_name = qtype_names[self.qtype]
+        self.tries = tries or settings.brute_resolve_num
+        self.timeout = timeout or settings.dns_query_timeout
+        self.socket_num = max(1, sockets or settings.brute_socket_num)
+        # 每个socket的事务ID只有65536个
+        self.concurrent = min(self.concurrent, 60000 * self.socket_num)
+        self.loop = None
+        self.sockets = list()
+        self.pending = list()  # 每个socket上等待响应的查询 {事务ID: 查询}
+        self.next_ids = list()
+        self.turn = 0  # 轮流使用socket和名称服务器
+        self.timeouts = deque()  # 按发送时间排序的(超时时间, socket, 事务ID, 查询)
+        self.callback = None
+        self.names = None
+        self.inflight = 0
+        self.done = 0  # 已得到结果或放弃的名称数量
+        self.waiter = None
+        self.tasks = set()  # 进行中的TCP查询
+        self.stats = {'sent': 0, 'received': 0, 'timeout': 0, 'retry': 0,
+                      'failed': 0, 'invalid': 0, 'truncated': 0}
+        self.status = dict()
+
+    def open(self):
+        for index in range(self.socket_num):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+            sock.bind(('0.0.0.0', 0))
+            sock.setblocking(False)
+            self.sockets.append(sock)
+            self.pending.append(dict())
+            self.next_ids.append(random.randrange(65536))
+            self.loop.add_reader(sock.fileno(), self.read, index)
+
+    def close(self):
+        for sock in self.sockets:
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+        self.sockets.clear()
+
+    def send(self, query):
+        """
+        Send query on a free transaction id, each try uses the next nameserver
+
+        :param list query: [name, question, tries, resolver]
+        """
+        self.turn += 1
+        index = self.turn % self.socket_num
+        pending = self.pending[index]
+        txid = self.next_ids[index]
+        while txid in pending:
+            txid = (txid + 1) & 0xFFFF
+        self.next_ids[index] = (txid + 1) & 0xFFFF
+        nameserver = self.nameservers[self.turn % len(self.nameservers)]
+        query[2] += 1
+        query[3] = nameserver
+        pending[txid] = query
+        packet = header_struct.pack(txid, 0x0100, 1, 0, 0, 0) + query[1]
+        try:
+            self.sockets[index].sendto(packet, nameserver)
+        except OSError as e:  # 发送失败的查询等待超时后重查
+            logger.log('TRACE', f'DNS socket error {e}')
+        self.timeouts.append((time.monotonic() + self.timeout, index, txid, query))
+        self.stats['sent'] += 1
+
+    def retry(self, query):
+        if query[2] >= self.tries:
+            self.stats['failed'] += 1
+            self.inflight -= 1
+            self.done += 1
+            return
+        self.stats['retry'] += 1
+        self.send(query)
+
+    def fill(self):
+        """
+        Send new queries until the in-flight window is full
+        """
+        while self.names is not None and self.inflight < self.concurrent:
+            try:
+                name = next(self.names)
+            except StopIteration:
+                self.names = None
+                break
+            name = name.strip().lower()
+            if not name:
+                continue
+            question = encode_question(name, self.qtype)
+            if question is None:
+                self.stats['invalid'] += 1
+                continue
+            self.inflight += 1
+            self.send([name, question, 0, None])
+        if self.names is None and not self.inflight and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def read(self, index):
+        """
+        Drain all queued datagrams of the socket
+        """
+        sock = self.sockets[index]
+        while True:
+            try:
+                data = sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logger.log('TRACE', f'DNS socket error {e}')
+                break
+            self.receive(index, data)
+        self.fill()
+
+    def receive(self, index, data):
+        try:
+            txid, flags, _, _, _, _ = header_struct.unpack_from(data)
+        except struct.error:
+            return
+        pending = self.pending[index]
+        query = pending.get(txid)
+        if query is None:
+            return
+        question = query[1]
+        end = 12 + len(question)
+        # 问题部分与查询不一致的响应可能是迟到或伪造的响应
+        if data[12:end].lower() != question:
+            return
+        del pending[txid]
+        self.stats['received'] += 1
+        if flags & truncated_flag:
+            # 截断的应答可能缺少记录 查询仍在进行中直到TCP查询结束
+            self.stats['truncated'] += 1
+            task = self.loop.create_task(self.query_tcp(query))
+            self.tasks.add(task)  # 保留引用以免任务被回收
+            task.add_done_callback(self.tasks.discard)
+            return
+        self.handle(query, data)
+
+    def handle(self, query, data):
+        """
+        Handle the answer of a query
+
+        :param list query: [name, question, tries, resolver]
+        :param bytes data: response packet
+        """
+        _, flags, _, ancount, _, _ = header_struct.unpack_from(data)
+        end = 12 + len(query[1])
+        rcode = flags & 0x000F
+        if rcode in retry_rcodes:
+            self.retry(query)
+            return
+        status = rcodes.get(rcode, str(rcode))
+        self.status[status] = self.status.get(status, 0) + 1
+        self.inflight -= 1
+        self.done += 1
+        if rcode:
+            return
+        name = query[0] + '.'
+        nameserver = query[3]
+        item = {'name': name, 'type': self.qtype_name, 'class': 'IN', 'status': status,
+                'resolver': f'{nameserver[0]}:{nameserver[1]}', 'data': {}}
+        if ancount:
+            try:
+                item['data']['answers'] = parse_answers(data, end, ancount, name)
+            except (IndexError, ValueError, struct.error):
+                logger.log('DEBUG', f'Malformed DNS response of {query[0]}')
+        self.callback(item)
+
+    async def exchange_tcp(self, query):
+        """
+        Send query to its last nameserver over TCP
+
+        :param list query: [name, question, tries, resolver]
+        :return bytes: response packet
+        """
+        txid = random.randrange(65536)
+        packet = header_struct.pack(txid, 0x0100, 1, 0, 0, 0) + query[1]
+        reader, writer = await asyncio.open_connection(*query[3])
+        try:
+            writer.write(struct.pack('>H', len(packet)) + packet)
+            length, = struct.unpack('>H', await reader.readexactly(2))
+            data = await reader.readexactly(length)
+        finally:
+            writer.close()
+        end = 12 + len(query[1])
+        if len(data) < end or data[:2] != packet[:2] \
+                or data[12:end].lower() != query[1]:
+            raise ValueError('Mismatched DNS TCP response')
+        return data
+
+    async def query_tcp(self, query):
+        """
+        Query again over TCP when the UDP answer is truncated, the query is
+        retried over UDP when the TCP query fails
+        """
+        try:
+            data = await asyncio.wait_for(self.exchange_tcp(query), self.timeout)
+        except (OSError, EOFError, ValueError, struct.error, asyncio.TimeoutError) as e:
+            logger.log('TRACE', f'DNS TCP query error of {query[0]} {e!r}')
+            self.retry(query)
+        else:
+            self.handle(query, data)
+        self.fill()
+
+    def expire(self):
+        """
+        Retry the queries that timed out
+        """
+        now = time.monotonic()
+        timeouts = self.timeouts
+        while timeouts and timeouts[0][0] <= now:
+            _, index, txid, query = timeouts.popleft()
+            pending = self.pending[index]
+            if pending.get(txid) is not query:
+                continue
+            del pending[txid]
+            self.stats['timeout'] += 1
+            self.retry(query)
+        self.fill()
+
+    async def run(self, names, callback, progress=None):
+        """
+        Resolve names
+
+        :param names: iterable of names, consumed lazily
+        :param callback: called with each NOERROR result
+        :param progress: progress reporter of finished names
+        """
+        self.loop = asyncio.get_event_loop()
+        self.callback = callback
+        self.names = iter(names)
+        self.waiter = self.loop.create_future()
+        self.open()
+        try:
+            self.fill()
+            interval = min(0.1, self.timeout / 4)
+            reported = 0
+            while not self.waiter.done():
+                await asyncio.wait([self.waiter], timeout=interval)
+                self.expire()
+                if progress:
+                    progress.update(self.done - reported)
+                    reported = self.done
+        finally:
+            self.close()
+        logger.log('DEBUG', f'DNS engine stats {self.stats} status {self.status}')
+
+
+def resolve(names, ns_path, callback, concurrent=None, qtype='A', progress=None):
+    """
+    Resolve names with the built-in engine
+
+    :param names: iterable of names
+    :param ns_path: nameservers file path
+    :param callback: called with each result in massdns output structure
+    :param int concurrent: max in-flight queries
+    :param str qtype: query type
+    :param progress: progress reporter of finished names
+    :return dict: engine stats
+    """
+    engine = DNSEngine(read_nameservers(ns_path), concurrent, qtype)
+    # 引擎依赖add_reader 在Windows下也需要使用SelectorEventLoop
+    loop = asyncio.SelectorEventLoop()
+    try:
+        loop.run_until_complete(engine.run(names, callback, progress))
+    finally:
+        loop.close()
+    return engine.stats
+
+
+def resolve_to_file(names, ns_path, output_path, concurrent=None, qtype='A',
+                    progress=None):
+    """
+    Resolve names and write massdns compatible JSON lines
+
+    :param names: iterable of names
+    :param ns_path: nameservers file path
+    :param output_path: output file path
+    :param int concurrent: max in-flight queries
+    :param str qtype: query type
+    :param progress: progress reporter of finished names
+    :return dict: engine stats
+    """
+    logger.log('DEBUG', 'Start running built-in DNS engine')
+    with open(output_path, 'w') as output:
+        def write(item):
+            output.write(json.dumps(item))
+            output.write('\n')
+        stats = resolve(names, ns_path, write, concurrent, qtype, progress)
+    logger.log('DEBUG', 'Finished built-in DNS engine')
+    return stats
+
+
+def resolve_file(dict_path, ns_path, output_path, concurrent=None, qtype='A'):
+    """
+    Resolve names in dict file and write massdns compatible JSON lines
+
+    :param dict_path: names file path
+    :param ns_path: nameservers file path
+    :param output_path: output file path
+    :param int concurrent: max in-flight queries
+    :param str qtype: query type
+    :return dict: engine stats
+    """
+    with open(dict_path) as names:
+        return resolve_to_file(names, ns_path, output_path, concurrent, qtype)
@@ -0,0 +1,94 @@
+"""
+Streaming exporters of subdomain results
+
+Rows are written into the result file one by one as they are read, so the
+memory used does not grow with the count of results. Results are exported as
+CSV, a JSON array or newline-delimited JSON, optionally compressed with gzip.
+"""
+
+import csv
+import gzip
+import json
+
+from common.tablib.format import serialize_objects_handler
+from config import settings
+
+formats = ['csv', 'json', 'ndjson']
+
+
+def get_path(path, compress=None):
+    """
+    Get the path of the exported file, .gz is appended when compressed
+
+    :param Path path: result path
+    :param bool compress: compress with gzip (default result_save_compress)
+    :return Path: exported file path
+    """
+    if compress is None:
+        compress = settings.result_save_compress
+    if compress and path.suffix != '.gz':
+        return path.with_name(f'{path.name}.gz')
+    return path
+
+
+def open_file(path, fmt):
+    # csv带BOM以便Excel识别编码
+    encoding = 'utf-8-sig' if fmt == 'csv' else 'utf-8'
+    if path.suffix == '.gz':
+        # 压缩级别6与9的压缩率相近 速度快得多
+        return gzip.open(path, 'wt', compresslevel=6, encoding=encoding,
+                         errors='ignore', newline='')
+    return open(path, 'w', encoding=encoding, errors='ignore', newline='')
+
+
+def write_csv(file, keys, rows):
+    writer = csv.writer(file)
+    if keys:
+        writer.writerow(keys)
+    for row in rows:
+        writer.writerow(row)
+
+
+def dump_row(keys, row):
+    return json.dumps(dict(zip(keys, row)), default=serialize_objects_handler)
+
+
+def write_json(file, keys, rows):
+    file.write('[')
+    for index, row in enumerate(rows):
+        if index:
+            file.write(', ')
+        file.write(dump_row(keys, row))
+    file.write(']')
+
+
+def write_ndjson(file, keys, rows):
+    for row in rows:
+        file.write(dump_row(keys, row))
+        file.write('\n')
+
+
+writers = {'csv': write_csv, 'json': write_json, 'ndjson': write_ndjson}
+
+
+def export_rows(path, fmt, keys, rows):
+    """
+    Write rows into a result file
+
+    :param Path path: exported file path, compressed when ends with .gz
+    :param str fmt: csv, json or ndjson
+    :param list keys: field names
+    :param rows: iterable of row values in the order of keys
+    :return int: count of rows written
+    """
+    count = 0
+
+    def counted():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    with open_file(path, fmt) as file:
+        writers[fmt](file, keys, counted())
+    return count
@@ -0,0 +1,140 @@
+"""
+Fast html title extractor
+
+Extract the title of a page with the html.parser tokenizer without building a
+BeautifulSoup tree. The fallback order is the same as BeautifulSoup based
+extraction: title, h1, h2, h3, meta description, meta keywords, short text.
+Parsing stops as soon as the title tag is closed.
+"""
+
+from html.parser import HTMLParser
+from multiprocessing import Pool
+
+# 与BeautifulSoup一致的空元素标签，不会包含内容
+void_tags = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+             'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr',
+             'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+             'nextid', 'spacer'}
+heading_tags = ('h1', 'h2', 'h3')
+preserve_tags = {'pre', 'textarea'}
+ascii_spaces = ' \n\t\x0c\r'
+max_text_len = 200
+
+
+class StopParsing(Exception):
+    pass
+
+
+class TitleParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = list()  # 打开的标签名
+        self.capture = dict()  # {标签名: 标签在stack中的位置}
+        self.texts = {name: list() for name in ('title',) + heading_tags}
+        self.metas = dict()
+        self.text = list()
+        self.text_len = 0
+        self.skip = 0  # 处于script或style中
+        self.preserve = 0  # 处于pre或textarea中
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            name = attrs.get('name')
+            if name in ('description', 'keywords') and name not in self.metas:
+                self.metas[name] = attrs.get('content')
+        if tag in void_tags:
+            return
+        if tag in self.texts and tag not in self.capture and not self.found(tag):
+            self.capture[tag] = len(self.stack)
+        if tag in ('script', 'style'):
+            self.skip += 1
+        elif tag in preserve_tags:
+            self.preserve += 1
+        self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in void_tags:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in self.stack:  # 与BeautifulSoup一样忽略未打开的结束标签
+            return
+        while self.stack:
+            name = self.stack.pop()
+            if name in ('script', 'style'):
+                self.skip -= 1
+            elif name in preserve_tags:
+                self.preserve -= 1
+            if self.capture.get(name) == len(self.stack):
+                self.capture.pop(name)
+                self.texts[name].append('')  # 标记已完成
+                if name == 'title':
+                    raise StopParsing
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        if self.skip or not data:
+            return
+        if not self.preserve and not data.strip(ascii_spaces):
+            # 与BeautifulSoup一样把只有空白的字符串折叠为一个换行或空格
+            data = '\n' if '\n' in data else ' '
+        for name in self.capture:
+            self.texts[name].append(data)
+        if self.text_len <= max_text_len:
+            self.text.append(data)
+            self.text_len += len(data)
+
+    def unknown_decl(self, data):
+        if data.upper().startswith('CDATA['):
+            self.handle_data(data[6:])
+
+    def found(self, tag):
+        return bool(self.texts[tag])
+
+    def get_title(self):
+        for name in ('title',) + heading_tags:
+            if name in self.capture or self.found(name):
+                return ''.join(self.texts[name])
+        for name in ('description', 'keywords'):
+            content = self.metas.get(name)
+            if content is not None:
+                return content
+        if self.text_len <= max_text_len:
+            return repr(''.join(self.text))
+        return 'None'
+
+
+def get_html_title(markup):
+    """
+    获取标题
+
+    :param str markup: html标签
+    :return str: 标题
+    """
+    parser = TitleParser()
+    try:
+        parser.feed(markup)
+        parser.close()
+    except StopParsing:
+        pass
+    return parser.get_title()
+
+
+def get_html_titles(markups, processes=None, pool=None):
+    """
+    Get titles of many pages, extracted in a process pool when processes > 1
+
+    :param list markups: html markups
+    :param int processes: process count (default None means the current process)
+    :param pool: existing process pool to use instead
+    :return list: titles
+    """
+    if pool:
+        return pool.map(get_html_title, markups, chunksize=64)
+    if not processes or processes <= 1:
+        return [get_html_title(markup) for markup in markups]
+    with Pool(processes) as pool:
+        return pool.map(get_html_title, markups, chunksize=64)
@@ -0,0 +1,449 @@
+"""
+Asyncio HTTP probing engine
+
+A minimal HTTP/1.1 client on asyncio streams for probing many urls at once.
+Connections go straight to the resolved IP, the results are returned as
+requests Response objects or requests exceptions so that the result
+processing is the same as the thread engine.
+"""
+
+import asyncio
+import socket
+import ssl
+import time
+import zlib
+from urllib.parse import urljoin, urlsplit
+
+import certifi
+import requests
+from requests import exceptions
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from common import utils, reachability
+from config import settings
+from config.log import logger
+
+redirect_codes = {301, 302, 303, 307, 308}
+
+
+def get_timeouts(timeout):
+    if isinstance(timeout, (tuple, list)):
+        return float(timeout[0]), float(timeout[1])
+    return float(timeout), float(timeout)
+
+
+def get_ssl_context(verify):
+    if verify:
+        return ssl.create_default_context(cafile=certifi.where())
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def raise_nofile_limit(count):
+    """
+    Raise the soft limit of open files for the concurrent connections
+
+    :param int count: wanted concurrent connections
+    :return int: usable concurrent connections
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return count
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = count + 256
+    if soft != resource.RLIM_INFINITY and soft < want:
+        new = want if hard == resource.RLIM_INFINITY else min(want, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new, hard))
+            soft = new
+        except (ValueError, OSError) as e:
+            logger.log('DEBUG', e.args)
+    if soft == resource.RLIM_INFINITY:
+        return count
+    return max(1, min(count, soft - 256))
+
+
+def new_decoder(encoding):
+    encoding = (encoding or '').lower()
+    if 'gzip' in encoding:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if 'deflate' in encoding:
+        return zlib.decompressobj()
+    return None
+
+
+class BodyCapture(object):
+    """
+    Keep at most max_size decoded bytes of a response body
+
+    :param str encoding: Content-Encoding of the response
+    :param int max_size: max bytes to keep
+    """
+    def __init__(self, encoding=None, max_size=None):
+        self.encoding = encoding
+        self.decoder = new_decoder(encoding)
+        self.max_size = max_size or settings.request_max_body_size
+        self.chunks = list()
+        self.size = 0
+        self.truncated = False
+        self.fed = False
+
+    def decode(self, data, limit):
+        try:
+            return self.decoder.decompress(data, limit)
+        except zlib.error:
+            if self.fed or 'deflate' not in self.encoding.lower():
+                raise
+            # 有些服务器返回没有zlib头的deflate数据
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decoder.decompress(data, limit)
+
+    def feed(self, data):
+        """
+        Feed raw body data
+
+        :param bytes data: raw body data
+        :return bool: whether the capture is full and the rest can be dropped
+        """
+        if not data:
+            return False
+        remaining = self.max_size - self.size
+        if self.decoder:
+            # max_length为0表示不限制，所以至少解压1字节来判断是否还有数据
+            body = self.decode(data, max(remaining, 1))
+            self.fed = True
+            full = bool(self.decoder.unconsumed_tail) or len(body) > remaining
+            body = body[:remaining]
+        else:
+            full = len(data) > remaining
+            body = data[:remaining]
+        if body:
+            self.chunks.append(body)
+            self.size += len(body)
+        if full:
+            self.truncated = True
+        return full
+
+    def get_body(self):
+        return b''.join(self.chunks)
+
+
+class HTTPEngine(object):
+    """
+    Asyncio HTTP probing engine
+
+    :param int concurrent: max concurrent requests
+    :param int per_host:   max concurrent requests of each IP
+    :param dict headers:   request headers
+    :param controller:     adaptive concurrency controller (default None means
+                           fixed per host limits)
+    """
+    def __init__(self, concurrent=None, per_host=None, headers=None, controller=None):
+        self.concurrent = concurrent or settings.request_async_concurrent_num
+        self.per_host = per_host or settings.request_per_host_num
+        self.headers = headers or dict()
+        timeout = settings.request_timeout_second
+        self.connect_timeout, self.read_timeout = get_timeouts(timeout)
+        self.allow_redirects = settings.request_allow_redirect
+        self.max_redirects = settings.request_redirect_limit
+        self.max_body_size = settings.request_max_body_size
+        self.ssl_context = get_ssl_context(settings.request_ssl_verify)
+        self.host_limits = dict()  # 每个IP的并发限制
+        self.controller = controller
+        self.reachability = settings.enable_reachability_cache
+        self.probing = dict()  # {(IP, 端口): 首次连接完成时设置结果的future}
+        header_lines = [f'{key}: {value}' for key, value in self.headers.items()
+                        if key.lower() not in ('host', 'connection')]
+        header_lines.append('Connection: close')
+        self.header_str = '\r\n'.join(header_lines)
+
+    async def read(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.read_timeout)
+        except asyncio.TimeoutError:
+            raise exceptions.ReadTimeout(f'Read timed out. '
+                                         f'(read timeout={self.read_timeout})')
+
+    async def wait_reachable(self, ip, port):
+        """
+        Wait until the endpoint is known open or this request is the one to
+        connect it, other virtual hosts of an unknown endpoint wait for the
+        result of the first connection
+
+        :return bool: whether this request connects the endpoint first
+        :raise ConnectionError: the endpoint is known unreachable
+        """
+        key = (ip, port)
+        while True:
+            status = reachability.cache.get(ip, port)
+            if status in reachability.dead_states:
+                raise reachability.unreachable_error(ip, port, status)
+            if status == 'open' or reachability.cache.is_unknown(ip, port):
+                return False
+            probe = self.probing.get(key)
+            if probe is None:
+                self.probing[key] = asyncio.get_event_loop().create_future()
+                return True
+            await asyncio.shield(probe)
+
+    def reachable_done(self, ip, port, status, first):
+        reachability.cache.record(ip, port, status)
+        if first:
+            if status is None:  # 首次连接无法判断状态时不让其余url逐个等待
+                reachability.cache.mark_unknown(ip, port)
+            probe = self.probing.pop((ip, port))
+            probe.set_result(None)
+
+    @staticmethod
+    async def open_socket(host, port):
+        """
+        Open a TCP connection, the host is resolved when it is not an IP
+
+        :return: connected non-blocking socket
+        """
+        loop = asyncio.get_event_loop()
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        family, kind, proto, _, address = infos[0]
+        sock = socket.socket(family, kind, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def connect(self, host, ip, port, https):
+        """
+        Connect an endpoint, the TCP connect and the TLS handshake are timed
+        separately so that only a TCP connect timeout marks it filtered
+        """
+        check = bool(ip and self.reachability)
+        first = check and await self.wait_reachable(ip, port)
+        status = None
+        sock = None
+        conn = None
+        try:
+            sock = await asyncio.wait_for(self.open_socket(ip or host, port),
+                                          self.connect_timeout)
+            status = 'open'
+            conn = await asyncio.wait_for(asyncio.open_connection(
+                sock=sock, ssl=self.ssl_context if https else None,
+                server_hostname=host if https else None), self.connect_timeout)
+            return conn
+        except asyncio.TimeoutError:
+            if status == 'open':  # TCP连接已建立 只是TLS握手慢
+                raise exceptions.ConnectTimeout(f'TLS handshake with {host}:{port} timed '
+                                                f'out. (connect timeout={self.connect_timeout})')
+            status = 'filtered'
+            raise exceptions.ConnectTimeout(f'Connection to {host}:{port} timed out. '
+                                            f'(connect timeout={self.connect_timeout})')
+        except ssl.SSLError as e:
+            raise exceptions.SSLError(f'{host}:{port} {e}')
+        except OSError as e:
+            if status is None:
+                status = reachability.get_error_status(e)
+            raise exceptions.ConnectionError(f'Failed to establish a new connection '
+                                             f'to {host}:{port}: {e}')
+        finally:
+            if check:
+                self.reachable_done(ip, port, status, first)
+            if sock is not None and conn is None:
+                sock.close()
+
+    async def read_body(self, reader, headers, capture):
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            while True:
+                line = await self.read(reader.readline())
+                try:
+                    size = int(line.split(b';')[0].strip() or b'0', 16)
+                except ValueError:
+                    raise exceptions.ChunkedEncodingError(f'Invalid chunk size {line!r}')
+                if size == 0:
+                    break
+                if capture.feed(await self.read(reader.readexactly(size))):
+                    return
+                await self.read(reader.readline())
+            return
+        length = headers.get('Content-Length')
+        if length is not None and length.strip().isdigit():
+            remaining = int(length)
+            while remaining > 0:
+                chunk = await self.read(reader.readexactly(min(remaining, 65536)))
+                remaining -= len(chunk)
+                if capture.feed(chunk):
+                    return
+            return
+        while True:
+            chunk = await self.read(reader.read(65536))
+            if not chunk or capture.feed(chunk):
+                return
+
+    async def fetch_one(self, url, ip):
+        """
+        Send one GET request without following redirects
+
+        :param str url: url
+        :param str ip: IP to connect (None means resolve the host)
+        :return: response
+        """
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        if parts.scheme not in ('http', 'https'):
+            raise exceptions.InvalidSchema(f'No connection adapters were found for {url}')
+        host = parts.hostname
+        port = parts.port or (443 if https else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+        host_header = host
+        if parts.port and parts.port != (443 if https else 80):
+            host_header = f'{host}:{port}'
+        start = time.monotonic()
+        reader, writer = await self.connect(host, ip, port, https)
+        connect_elapsed = time.monotonic() - start
+        try:
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {host_header}\r\n'
+                         f'{self.header_str}\r\n\r\n'.encode('latin-1', 'ignore'))
+            while True:
+                line = await self.read(reader.readline())
+                if not line:
+                    raise exceptions.ConnectionError('Remote end closed connection '
+                                                     'without response')
+                items = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+                try:
+                    code = int(items[1])
+                except (IndexError, ValueError):
+                    raise exceptions.ConnectionError(f'Invalid status line {line!r}')
+                reason = items[2] if len(items) > 2 else ''
+                headers = CaseInsensitiveDict()
+                while True:
+                    line = await self.read(reader.readline())
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    key, value = key.strip(), value.strip()
+                    if key in headers:  # 与urllib3一样合并重复的响应头
+                        value = f'{headers[key]}, {value}'
+                    headers[key] = value
+                if not 100 <= code < 200:
+                    break
+            capture = BodyCapture(headers.get('Content-Encoding'), self.max_body_size)
+            if code in (204, 304) or headers.get('Content-Length') == '0':
+                pass
+            elif utils.is_binary_type(headers.get('Content-Type')):
+                capture.truncated = True  # 二进制内容不读取响应体
+            else:
+                try:
+                    await self.read_body(reader, headers, capture)
+                except zlib.error as e:
+                    raise exceptions.ContentDecodingError(f'Failed to decode response '
+                                                          f'content {e}')
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            raise exceptions.ConnectionError(f'Connection broken: {e!r}')
+        except (ValueError, asyncio.LimitOverrunError) as e:
+            raise exceptions.ConnectionError(f'Invalid response: {e!r}')
+        finally:
+            writer.close()
+        resp = requests.Response()
+        resp.status_code = code
+        resp.reason = reason
+        resp.url = url
+        resp.headers = headers
+        resp.encoding = get_encoding_from_headers(headers)
+        resp._content = capture.get_body()
+        resp._content_consumed = True
+        resp.truncated = capture.truncated
+        resp.connect_elapsed = connect_elapsed
+        return resp
+
+    async def fetch(self, url, ip=None):
+        """
+        Send GET request and follow redirects
+
+        :param str url: url
+        :param str ip: IP to connect (None means resolve the host)
+        :return: response
+        """
+        history = list()
+        for _ in range(self.max_redirects + 1):
+            resp = await self.fetch_one(url, ip)
+            location = resp.headers.get('Location')
+            if not (self.allow_redirects and location and resp.status_code in redirect_codes):
+                resp.history = history
+                return resp
+            history.append(resp)
+            new_url = urljoin(url, location)
+            if urlsplit(new_url).hostname != urlsplit(url).hostname:
+                ip = None
+            url = new_url
+        raise exceptions.TooManyRedirects(f'Exceeded {self.max_redirects} redirects.')
+
+    async def probe(self, url, ip=None):
+        """
+        Request url under the per host limit
+
+        :return: response or exception
+        """
+        key = ip or urlsplit(url).hostname
+        if self.controller:
+            return await self.adaptive_probe(url, ip, key)
+        limit = self.host_limits.get(key)
+        if limit is None:
+            limit = self.host_limits[key] = asyncio.Semaphore(self.per_host)
+        async with limit:
+            try:
+                return await self.fetch(url, ip)
+            except Exception as e:
+                logger.log('DEBUG', e.args)
+                return e
+
+    async def adaptive_probe(self, url, ip, key):
+        windows = await self.controller.acquire_async(key)
+        start = time.monotonic()
+        try:
+            resp = await self.fetch(url, ip)
+        except Exception as e:
+            logger.log('DEBUG', e.args)
+            resp = e
+        self.controller.release_async(windows, resp, time.monotonic() - start)
+        return resp
+
+    async def run(self, tasks, callback):
+        """
+        Request urls
+
+        :param tasks: iterable of (index, url, ip), consumed lazily
+        :param callback: called with index and response of each task
+        """
+        tasks = iter(tasks)
+
+        async def worker():
+            for index, url, ip in tasks:
+                resp = await self.probe(url, ip)
+                callback(index, resp)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrent)))
+
+
+def bulk_fetch(tasks, callback, concurrent=None, headers=None, controller=None):
+    """
+    Request urls with the asyncio HTTP probing engine
+
+    :param tasks: iterable of (index, url, ip)
+    :param callback: called with index and response of each task
+    :param int concurrent: max concurrent requests
+    :param dict headers: request headers
+    :param controller: adaptive concurrency controller
+    """
+    concurrent = raise_nofile_limit(concurrent or settings.request_async_concurrent_num)
+    engine = HTTPEngine(concurrent, headers=headers, controller=controller)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(engine.run(tasks, callback))
+    finally:
+        loop.close()
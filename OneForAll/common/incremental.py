@@ -0,0 +1,207 @@
+"""
+Incremental re-scan
+
+The results of the previous run are kept in a backup table, subdomains whose
+stored DNS records have not expired are not resolved again, and urls whose
+DNS answers did not change and were probed recently are not requested again.
+Every result is marked with a change status: new, changed, same or gone.
+"""
+
+from common import utils
+from common.database import Database, fields
+from config import settings
+from config.log import logger
+
+
+def get_ips(ip_str):
+    if not ip_str:
+        return set()
+    return set(ip_str.split(','))
+
+
+def is_expired(info, now):
+    """
+    Whether the stored DNS records expired
+
+    :param dict info: last resolve info
+    :param int now: timestamp
+    :return bool: result
+    """
+    resolve_time = info.get('resolve_time')
+    ttl = info.get('ttl')
+    if not resolve_time or not ttl:
+        return True
+    try:
+        min_ttl = min(int(item) for item in ttl.split(','))
+    except ValueError:
+        return True
+    return resolve_time + min_ttl <= now
+
+
+class Incremental(object):
+    """
+    Incremental re-scan of one domain
+
+    :param str domain: main domain
+    """
+    def __init__(self, domain):
+        self.domain = domain
+        self.table = domain.replace('.', '_')
+        self.last_table = f'{self.table}_last'
+        self.subdomains = dict()  # 上次解析成功的子域及解析信息
+        # 上次请求过的(子域, 端口)及请求时间 url的协议可能已按探测结果切换 不用url匹配
+        self.endpoints = dict()
+        self.loaded = False
+
+    def backup(self):
+        """
+        Keep the results of the previous run in the backup table
+        """
+        db = Database()
+        if db.exist_table(self.table):
+            logger.log('INFOR', f'Keeping the previous results of {self.domain}')
+            db.drop_table(self.last_table)
+            db.rename_table(self.table, self.last_table)
+            db.migrate(self.last_table)
+        db.close()
+
+    def load(self):
+        """
+        Load the resolve and request index of the previous results
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        db = Database()
+        if not db.exist_table(self.last_table):
+            db.close()
+            return
+        names = ['subdomain', 'port', 'resolve', 'cname', 'ip', 'ttl', 'resolver',
+                 'resolve_time', 'request_time', 'change']
+        rows = db.get_data_by_fields(self.last_table, names)
+        for row in rows:
+            if row.change == 'gone':
+                continue
+            if row.resolve == 1 and row.subdomain not in self.subdomains:
+                self.subdomains[row.subdomain] = {'cname': row.cname,
+                                                  'ip': row.ip,
+                                                  'ttl': row.ttl,
+                                                  'resolver': row.resolver,
+                                                  'resolve_time': row.resolve_time}
+            if row.port and row.request_time:
+                self.endpoints[(row.subdomain, row.port)] = row.request_time
+        db.close()
+        logger.log('INFOR', f'Loaded {len(self.subdomains)} subdomains and '
+                            f'{len(self.endpoints)} urls of the previous results')
+
+    def reuse_resolve(self, data):
+        """
+        Reuse unexpired DNS records of the previous results so that they are
+        not resolved again
+
+        :param list data: collected subdomain data
+        :return list: data
+        """
+        self.load()
+        now = utils.get_timestamp()
+        count = 0
+        for info in data:
+            subdomain = info.get('subdomain')
+            last = self.subdomains.get(subdomain)
+            if last is None:
+                info['change'] = 'new'
+                continue
+            if info.get('ip') or is_expired(last, now):
+                continue
+            info.update(last)
+            info['resolve'] = 1
+            info['reason'] = 'OK'
+            info['change'] = 'same'
+            count += 1
+        logger.log('INFOR', f'Reused {count} unexpired DNS records')
+        return data
+
+    def mark_change(self, data):
+        """
+        Mark the resolved subdomains whose DNS answers changed
+
+        :param list data: resolved subdomain data
+        :return list: data
+        """
+        for info in data:
+            if info.get('change'):
+                continue
+            last = self.subdomains.get(info.get('subdomain'))
+            if last is None:
+                info['change'] = 'new'
+            elif get_ips(last.get('ip')) == get_ips(info.get('ip')):
+                info['change'] = 'same'
+            else:
+                info['change'] = 'changed'
+        return data
+
+    def split_request(self, req_data):
+        """
+        Split request data into urls to be requested and urls whose previous
+        results can be reused
+
+        :param list req_data: request data
+        :return: (request data, reused (subdomain, port) endpoints)
+        """
+        self.load()
+        now = utils.get_timestamp()
+        max_age = settings.incremental_request_max_age
+        new_data = list()
+        reused = list()
+        for info in req_data:
+            endpoint = (info.get('subdomain'), info.get('port'))
+            request_time = self.endpoints.get(endpoint)
+            if info.get('change') == 'same' and request_time \
+                    and now - request_time < max_age:
+                reused.append(endpoint)
+            else:
+                new_data.append(info)
+        logger.log('INFOR', f'Reuse the previous results of {len(reused)} urls')
+        return new_data, reused
+
+    def copy_last(self, where, change):
+        names = [name for name in fields if name not in ('id', 'change')]
+        name_str = ', '.join(names)
+        return (f'insert or ignore into "{self.table}" ({name_str}, change) '
+                f'select {name_str}, \'{change}\' from "{self.last_table}" '
+                f'where {where}')
+
+    def copy_reused(self, reused):
+        """
+        Copy the previous results of reused urls
+
+        :param list reused: reused (subdomain, port) endpoints
+        """
+        if not reused:
+            return
+        db = Database()
+        db.create_table(self.domain)
+        where = (f'id = (select min(id) from "{self.last_table}" '
+                 f'where subdomain = :subdomain and port = :port)')
+        sql = self.copy_last(where, 'same')
+        db.conn.bulk_query(sql, [{'subdomain': subdomain, 'port': port}
+                                 for subdomain, port in reused])
+        db.close()
+
+    def mark_gone(self):
+        """
+        Mark the subdomains not found this time as gone and drop the backup table
+        """
+        db = Database()
+        if not db.exist_table(self.last_table):
+            db.close()
+            return
+        # finder和altdns模块等直接解析请求的结果未标记
+        db.query(f'update "{self.table}" set change = '
+                 f'(case when subdomain in (select subdomain from "{self.last_table}") '
+                 f'then \'same\' else \'new\' end) where change is null')
+        where = (f'ifnull(change, \'\') != \'gone\' and subdomain not in '
+                 f'(select subdomain from "{self.table}" where subdomain is not null)')
+        db.query(self.copy_last(where, 'gone'))
+        db.drop_table(self.last_table)
+        db.close()
@@ -0,0 +1,187 @@
+"""
+Run journal for checkpoint and resume
+
+The journal records which stages of a target have started or finished and
+which work items are done, it is kept in a separate SQLite database so that
+the result tables are not affected.
+"""
+
+import json
+
+from common import utils
+from common.database import Database
+from config import settings
+from config.log import logger
+
+
+class Journal(object):
+    """
+    Persistent run journal of one target
+
+    :param str  target: target domain
+    :param str  name:   journal name, e.g. oneforall, brute
+    :param bool resume: resume from the journal, otherwise the journal is reset,
+                        a finished run is not resumed but starts a new run
+    """
+    def __init__(self, target, name, resume=False):
+        self.target = target
+        self.name = name
+        self.resume = resume
+        self.path = settings.result_save_dir.joinpath('journal.sqlite3')
+        self.create_tables()
+        if resume and self.get_stage('done')[0] == 'finished':
+            logger.log('INFOR', f'The last {name} run of {target} was finished, '
+                                f'start a new run')
+            self.resume = False
+        if not self.resume:
+            self.reset()
+
+    def get_db(self):
+        return Database(self.path)
+
+    def create_tables(self):
+        db = self.get_db()
+        db.query('create table if not exists stage ('
+                 'target text, name text, stage text, status text,'
+                 'value text, time int,'
+                 'primary key (target, name, stage))')
+        db.query('create table if not exists item ('
+                 'target text, name text, kind text, item text, value text,'
+                 'primary key (target, name, kind, item))')
+        db.close()
+
+    @property
+    def data_table(self):
+        return f'{self.target}_{self.name}_data'
+
+    def reset(self):
+        """
+        Remove all records of the target
+        """
+        logger.log('DEBUG', f'Resetting {self.name} journal of {self.target}')
+        db = self.get_db()
+        params = {'target': self.target, 'name': self.name}
+        db.conn.query('delete from stage where target = :target and name = :name', **params)
+        db.conn.query('delete from item where target = :target and name = :name', **params)
+        db.drop_table(self.data_table)
+        db.close()
+
+    def set_stage(self, stage, status, value=None):
+        db = self.get_db()
+        db.conn.query('insert or replace into stage '
+                      '(target, name, stage, status, value, time) '
+                      'values (:target, :name, :stage, :status, :value, :time)',
+                      target=self.target, name=self.name, stage=stage,
+                      status=status, value=json.dumps(value),
+                      time=utils.get_timestamp())
+        db.close()
+
+    def get_stage(self, stage):
+        """
+        Get stage record
+
+        :param str stage: stage name
+        :return: (status, value) or (None, None) when the stage never started
+        """
+        if not self.resume:
+            return None, None
+        db = self.get_db()
+        row = db.conn.query('select status, value from stage where target = :target '
+                            'and name = :name and stage = :stage',
+                            target=self.target, name=self.name, stage=stage).first()
+        db.close()
+        if row is None:
+            return None, None
+        return row.status, json.loads(row.value)
+
+    def begin(self, stage, value=None):
+        """
+        Mark stage as started
+
+        :param str stage: stage name
+        :param value: json serializable value stored with the stage
+        """
+        logger.log('DEBUG', f'{self.target} {self.name} stage {stage} started')
+        self.set_stage(stage, 'started', value)
+
+    def finish(self, stage, value=None):
+        """
+        Mark stage as finished
+
+        :param str stage: stage name
+        :param value: json serializable value stored with the stage
+        """
+        logger.log('DEBUG', f'{self.target} {self.name} stage {stage} finished')
+        self.set_stage(stage, 'finished', value)
+
+    def began(self, stage):
+        status, _ = self.get_stage(stage)
+        return status is not None
+
+    def finished(self, stage):
+        status, _ = self.get_stage(stage)
+        if status == 'finished':
+            logger.log('INFOR', f'Resume: skip the finished {stage} stage of {self.target}')
+            return True
+        return False
+
+    def value(self, stage):
+        _, value = self.get_stage(stage)
+        return value
+
+    def mark(self, kind, item, value=None):
+        """
+        Mark work item as done
+
+        :param str kind: item kind
+        :param str item: item
+        :param value: json serializable value stored with the item
+        """
+        db = self.get_db()
+        db.conn.query('insert or replace into item (target, name, kind, item, value) '
+                      'values (:target, :name, :kind, :item, :value)',
+                      target=self.target, name=self.name, kind=kind,
+                      item=str(item), value=json.dumps(value))
+        db.close()
+
+    def done(self, kind):
+        """
+        Get done work items
+
+        :param str kind: item kind
+        :return dict: done items and their values
+        """
+        if not self.resume:
+            return dict()
+        db = self.get_db()
+        rows = db.conn.query('select item, value from item where target = :target '
+                             'and name = :name and kind = :kind',
+                             target=self.target, name=self.name, kind=kind)
+        items = {row.item: json.loads(row.value) for row in rows}
+        db.close()
+        return items
+
+    def save_data(self, data):
+        """
+        Save stage output data as checkpoint
+
+        :param list data: data to be saved
+        """
+        logger.log('DEBUG', f'Saving {self.name} checkpoint data of {self.target}')
+        db = self.get_db()
+        db.drop_table(self.data_table)
+        db.create_table(self.data_table)
+        db.save_db(self.data_table, data, 'journal')
+        db.close()
+
+    def load_data(self):
+        """
+        Load checkpoint data
+
+        :return list: data
+        """
+        logger.log('DEBUG', f'Loading {self.name} checkpoint data of {self.target}')
+        db = self.get_db()
+        data = db.get_data(self.data_table).as_dict()
+        db.close()
+        return data
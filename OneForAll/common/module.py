@@ -9,10 +9,12 @@ import time
 import requests
 from config.log import logger
 from config import settings
-from common import utils
+from common import client, utils, pipeline
 from common.database import Database
 
 lock = threading.Lock()
+# 被取消的收集模块所在的线程 模块的下一次请求直接返回None使其尽快结束
+cancelled = set()
 
 
 class Module(object):
@@ -65,6 +67,13 @@ class Module(object):
         logger.log('DEBUG', f'{self.source} module found subdomains of {self.domain}\n'
                             f'{self.subdomains}')
 
+    @staticmethod
+    def is_cancelled():
+        """
+        Whether the module running in the current thread was cancelled
+        """
+        return threading.get_ident() in cancelled
+
     def head(self, url, params=None, check=True, **kwargs):
         """
         Custom head request
@@ -75,8 +84,9 @@ class Module(object):
         :param kwargs: other params
         :return: response object
         """
-        session = requests.Session()
-        session.trust_env = False
+        if self.is_cancelled():
+            return None
+        session = client.get_session()
         try:
             resp = session.head(url,
                                 params=params,
@@ -107,8 +117,9 @@ class Module(object):
         :param kwargs: other params
         :return: response object
         """
-        session = requests.Session()
-        session.trust_env = False
+        if self.is_cancelled():
+            return None
+        session = client.get_session()
         level = 'ERROR'
         if ignore:
             level = 'DEBUG'
@@ -144,8 +155,9 @@ class Module(object):
         :param kwargs: other params
         :return: response object
         """
-        session = requests.Session()
-        session.trust_env = False
+        if self.is_cancelled():
+            return None
+        session = client.get_session()
         try:
             resp = session.post(url,
                                 data=data,
@@ -173,8 +185,9 @@ class Module(object):
         :param kwargs: other params
         :return: response object
         """
-        session = requests.Session()
-        session.trust_env = False
+        if self.is_cancelled():
+            return None
+        session = client.get_session()
         try:
             resp = session.delete(url,
                                   cookies=self.cookie,
@@ -290,6 +303,9 @@ class Module(object):
                       'header': None,
                       'history': None,
                       'response': None,
+                      'truncated': None,
+                      'content_length': None,
+                      'body_hash': None,
                       'ip_times': None,
                       'cname_times': None,
                       'ttl': None,
@@ -302,7 +318,10 @@ class Module(object):
                       'module': self.module,
                       'source': self.source,
                       'elapse': self.elapse,
-                      'find': None}
+                      'find': None,
+                      'change': None,
+                      'resolve_time': None,
+                      'request_time': None}
             self.results.append(result)
         else:
             for subdomain in self.subdomains:
@@ -341,6 +360,9 @@ class Module(object):
                           'header': None,
                           'history': None,
                           'response': None,
+                          'truncated': None,
+                          'content_length': None,
+                          'body_hash': None,
                           'ip_times': ip_times,
                           'cname_times': cname_times,
                           'ttl': ttl,
@@ -353,7 +375,10 @@ class Module(object):
                           'module': self.module,
                           'source': self.source,
                           'elapse': self.elapse,
-                          'find': len(self.subdomains)}
+                          'find': len(self.subdomains),
+                          'change': None,
+                          'resolve_time': info.get('resolve_time'),
+                          'request_time': None}
                 self.results.append(result)
 
     def save_db(self):
@@ -361,9 +386,11 @@ class Module(object):
         Save module results into the database
         """
         logger.log('DEBUG', f'Saving results to database')
-        lock.acquire()
-        db = Database()
-        db.create_table(self.domain)
-        db.save_db(self.domain, self.results, self.source)
-        db.close()
-        lock.release()
+        # 流水线模式下结果交由流水线处理并统一存入数据库
+        if pipeline.feed(self.domain, self.results):
+            return
+        with lock:
+            db = Database()
+            db.create_table(self.domain)
+            db.save_db(self.domain, self.results, self.source)
+            db.close()
@@ -0,0 +1,296 @@
+"""
+Streaming pipeline: collect -> resolve -> request -> save
+
+Subdomains found by the collection modules flow into resolution and HTTP
+request as soon as they are found, each stage runs in its own thread and
+the stages are connected by bounded queues. Only the save stage writes to
+the database so the result table is written incrementally once. When the
+domain enables wildcard, requests start after all subdomains are resolved,
+because the wildcard filter counts IP and cname appearances over all results.
+"""
+
+import time
+import threading
+from queue import Queue, Empty
+
+from common import resolve, request, respstore
+from common.database import Database
+from modules import wildcard
+from config import settings
+from config.log import logger
+
+lock = threading.Lock()
+pipelines = dict()  # 正在运行的流水线 以主域为键
+
+END = object()  # 队列结束标志
+
+
+class Source(dict):
+    """
+    Result of a subdomain already in the pipeline, only which module and
+    source found it is saved
+    """
+
+
+def get_pipeline(domain):
+    """
+    Get the running pipeline of the domain
+
+    :param str domain: main domain
+    :return: pipeline object or None
+    """
+    with lock:
+        return pipelines.get(domain)
+
+
+def feed(domain, results):
+    """
+    Feed module results into the running pipeline of the domain
+
+    :param str  domain: main domain
+    :param list results: module results
+    :return bool: whether the results were taken by a pipeline
+    """
+    pipeline = get_pipeline(domain)
+    if pipeline is None:
+        return False
+    pipeline.put(results)
+    return True
+
+
+def get_batch(queue, size, interval):
+    """
+    Get a batch of items from queue
+
+    Return when the batch is full, or interval seconds passed since the first
+    item of the batch arrived, or the end flag is received.
+
+    :param queue: queue
+    :param int size: batch size
+    :param float interval: max waiting seconds
+    :return: (batch, whether the end flag is received)
+    """
+    batch = list()
+    deadline = None
+    while len(batch) < size:
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+        try:
+            item = queue.get(timeout=timeout)
+        except Empty:
+            break
+        if item is END:
+            return batch, True
+        batch.append(item)
+        if deadline is None:
+            deadline = time.time() + interval
+    return batch, False
+
+
+def drain(queue):
+    """
+    Discard the items of queue until the end flag is received so that the
+    producers of a failed stage are not blocked
+
+    :param queue: queue
+    :return int: count of discarded items
+    """
+    count = 0
+    while queue.get() is not END:
+        count += 1
+    return count
+
+
+class Pipeline(object):
+    """
+    Streaming pipeline of one main domain
+
+    :param str  domain:   main domain
+    :param bool dns:      resolve subdomains
+    :param bool req:      HTTP request subdomains
+    :param any  port:     range of ports to be requested
+    :param bool wildcard: deal wildcard subdomains
+    """
+    def __init__(self, domain, dns=True, req=True, port=None, wildcard=False):
+        self.domain = domain
+        self.dns = dns
+        self.req = req
+        self.ports = request.get_port_seq(port) if req else set()
+        self.wildcard = wildcard
+        size = settings.pipeline_queue_size
+        self.batch_size = settings.pipeline_batch_size
+        self.interval = settings.pipeline_flush_interval
+        self.resolve_queue = Queue(maxsize=size)
+        self.request_queue = Queue(maxsize=size)
+        self.save_queue = Queue(maxsize=size)
+        self.seen = set()  # 已进入流水线的子域
+        self.resolved = list()  # 需要处理泛解析时等待全部解析完成的结果
+        self.saved = 0
+        self.threads = list()
+
+    def put(self, results):
+        """
+        Put module results into pipeline, invalid subdomains are dropped and
+        only the source of a duplicate subdomain is saved
+
+        :param list results: module results
+        """
+        for info in results:
+            subdomain = info.get('subdomain')
+            if subdomain is None or info.get('resolve') == 0:
+                continue
+            with lock:
+                duplicate = subdomain in self.seen
+                self.seen.add(subdomain)
+            if duplicate:
+                # 与非流水线模式一致 记录发现该子域的所有模块和来源
+                self.save_queue.put(Source(info))
+                continue
+            info['id'] = None
+            # 队列满时阻塞调用的收集模块线程 以此控制内存占用
+            if self.dns:
+                self.resolve_queue.put(info)
+            else:
+                self.save_queue.put(info)
+
+    def resolve_batch(self, batch, next_queue):
+        try:
+            data = resolve.run_resolve(self.domain, batch)
+        except Exception as e:  # 解析线程退出会使流水线一直等待 记录丢失的子域后继续
+            logger.log('ERROR', e.args)
+            logger.log('ALERT', f'{len(batch)} pipeline subdomains of '
+                                f'{self.domain} were not resolved')
+            return
+        if self.req and self.wildcard:
+            # 泛解析按全部结果中IP和cname的出现次数判断 与非流水线模式一致
+            self.resolved.extend(data)
+            return
+        for info in data:
+            next_queue.put(info)
+
+    def resolve_stage(self):
+        next_queue = self.request_queue if self.req else self.save_queue
+        end = False
+        try:
+            while not end:
+                batch, end = get_batch(self.resolve_queue, self.batch_size, self.interval)
+                if batch:
+                    self.resolve_batch(batch, next_queue)
+            if self.req and self.wildcard:
+                for info in wildcard.deal_wildcard(self.resolved):
+                    next_queue.put(info)
+        except Exception as e:
+            logger.log('ERROR', e.args)
+            logger.log('ALERT', f'Pipeline resolve stage of {self.domain} failed, '
+                                f'{len(self.resolved)} resolved results were not requested')
+        finally:
+            self.resolved = list()
+            if not end:
+                count = drain(self.resolve_queue)
+                logger.log('ALERT', f'{count} pipeline subdomains of '
+                                    f'{self.domain} were not resolved')
+            next_queue.put(END)  # 下游阶段总能收到结束标志
+
+    def request_batch(self, batch):
+        req_data, _ = request.gen_req_data(batch, self.ports)
+        if not req_data:
+            return
+        try:
+            resp_queue = request.bulk_request(self.domain, req_data, ret=True)
+        except Exception as e:  # 请求线程退出会使流水线一直等待 记录丢失的url后继续
+            logger.log('ERROR', e.args)
+            logger.log('ALERT', f'{len(req_data)} pipeline urls of '
+                                f'{self.domain} were not requested')
+            return
+        while not resp_queue.empty():
+            index, resp = resp_queue.get()
+            self.save_queue.put(request.gen_new_info(req_data[index], resp))
+
+    def request_stage(self):
+        end = False
+        try:
+            while not end:
+                batch, end = get_batch(self.request_queue, self.batch_size, self.interval)
+                self.request_batch(batch)
+        except Exception as e:
+            logger.log('ERROR', e.args)
+            logger.log('ALERT', f'Pipeline request stage of {self.domain} failed')
+        finally:
+            if not end:
+                count = drain(self.request_queue)
+                logger.log('ALERT', f'{count} pipeline subdomains of '
+                                    f'{self.domain} were not requested')
+            self.save_queue.put(END)
+
+    def save_batch(self, db, batch):
+        sources = [info for info in batch if isinstance(info, Source)]
+        batch = [info for info in batch if not isinstance(info, Source)]
+        try:
+            respstore.store.flush(db)
+            # 未解析时保存的是收集结果 不用空值覆盖已有值
+            db.insert_rows(self.domain, batch, overwrite=self.dns)
+            db.insert_sources(self.domain, sources)
+        except Exception as e:  # 保存线程退出会使流水线一直等待 记录丢失的结果后继续
+            logger.log('ERROR', e.args)
+            logger.log('ALERT', f'{len(batch)} pipeline results of '
+                                f'{self.domain} were not saved')
+            return
+        self.saved += len(batch)
+        logger.log('DEBUG', f'Pipeline saved {self.saved} results of {self.domain}')
+
+    def save_stage(self):
+        db = Database()
+        end = False
+        try:
+            db.create_table(self.domain)
+            while not end:
+                batch, end = get_batch(self.save_queue, self.batch_size, self.interval)
+                if batch:
+                    self.save_batch(db, batch)
+        except Exception as e:
+            logger.log('ERROR', e.args)
+            logger.log('ALERT', f'Pipeline save stage of {self.domain} failed')
+        finally:
+            if not end:
+                count = drain(self.save_queue)
+                logger.log('ALERT', f'{count} pipeline results of '
+                                    f'{self.domain} were not saved')
+            db.close()
+
+    def start(self):
+        """
+        Start all pipeline stages and register pipeline so that module results
+        of the domain are fed into it
+        """
+        logger.log('INFOR', f'Start streaming pipeline of {self.domain}')
+        stages = [self.save_stage]
+        if self.dns:
+            stages.append(self.resolve_stage)
+            if self.req:
+                stages.append(self.request_stage)
+        for stage in stages:
+            name = stage.__name__.title().replace('_', '')
+            thread = threading.Thread(target=stage, name=f'Pipeline{name}Thread',
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        with lock:
+            pipelines[self.domain] = self
+
+    def join(self):
+        """
+        Stop feeding the pipeline and wait until all fed subdomains are saved
+        """
+        with lock:
+            pipelines.pop(self.domain, None)
+        if self.dns:
+            self.resolve_queue.put(END)
+        else:
+            self.save_queue.put(END)
+        for thread in self.threads:
+            thread.join()
+        logger.log('INFOR', f'Finished streaming pipeline of {self.domain}, '
+                            f'{len(self.seen)} subdomains in, {self.saved} results saved')
@@ -0,0 +1,187 @@
+"""
+Asyncio TCP connect sweep of IP:port endpoints
+
+Used as a pre-flight check before the HTTP requests of large port ranges, each
+unique endpoint is connected once and its status (open, closed or filtered)
+is kept in the reachability cache for the whole run. On the same connection
+the scheme of non-standard ports is sniffed with a TLS ClientHello, so that
+each endpoint is requested once with the scheme it speaks.
+"""
+
+import asyncio
+import socket
+import ssl
+
+from common import reachability
+from common.httpengine import raise_nofile_limit
+from common.progress import Progress
+from config import settings
+from config.log import logger
+
+tls_record_types = (0x15, 0x16)  # TLS告警和握手记录
+
+
+def get_client_hello():
+    """
+    Build a TLS ClientHello record with the ssl module
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    outgoing = ssl.MemoryBIO()
+    tls = context.wrap_bio(ssl.MemoryBIO(), outgoing)
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:  # 等待服务端回应 ClientHello已写入outgoing
+        pass
+    return outgoing.read()
+
+
+client_hello = get_client_hello()
+
+
+def need_sniff(port):
+    """
+    Whether the scheme of the port is sniffed, 80 and 443 are well known
+    """
+    return settings.enable_scheme_sniff and port not in (80, 443)
+
+
+async def sniff(sock, timeout):
+    """
+    Send a TLS ClientHello on a connected socket and tell the scheme by the
+    first byte of the reply, a TLS record (handshake or alert) means https and
+    anything else such as a plaintext 400 response means http
+
+    :return str: https, http or None when the endpoint did not reply
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        await asyncio.wait_for(loop.sock_sendall(sock, client_hello), timeout)
+        data = await asyncio.wait_for(loop.sock_recv(sock, 1), timeout)
+    except (asyncio.TimeoutError, OSError):
+        return None
+    if not data:
+        return None
+    if data[0] in tls_record_types:
+        return 'https'
+    return 'http'
+
+
+async def connect(ip, port, timeout, tries, sniff_scheme=False):
+    """
+    Check an endpoint with TCP connect, the scheme of an open endpoint is
+    sniffed on the same connection when sniff_scheme is True
+
+    :return tuple: (open, closed or filtered, https, http or None)
+    """
+    loop = asyncio.get_event_loop()
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    for _ in range(tries):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), timeout)
+            scheme = None
+            if sniff_scheme:
+                scheme = await sniff(sock, settings.scheme_sniff_timeout)
+            return 'open', scheme
+        except ConnectionRefusedError:
+            return 'closed', None
+        except (asyncio.TimeoutError, OSError) as e:  # 超时或不可达视为被过滤
+            logger.log('TRACE', f'{ip}:{port} {e!r}')
+        finally:
+            sock.close()
+    return 'filtered', None
+
+
+async def sweep(endpoints, results, concurrent, progress):
+    timeout = settings.port_preflight_timeout
+    tries = max(1, settings.port_preflight_tries)
+    endpoints = iter(endpoints)
+
+    async def worker():
+        for ip, port in endpoints:
+            results[(ip, port)] = await connect(ip, port, timeout, tries, need_sniff(port))
+            progress.update()
+
+    await asyncio.gather(*(worker() for _ in range(concurrent)))
+
+
+def run_sweep(endpoints, desc):
+    """
+    Connect endpoints concurrently and sniff the scheme of the open ones
+
+    :param list endpoints: (IP, port) endpoints
+    :param str desc: progress description
+    :return dict: {(IP, port): (status, scheme)}
+    """
+    concurrent = min(settings.port_preflight_concurrent_num, len(endpoints))
+    concurrent = raise_nofile_limit(concurrent)
+    results = dict()
+    progress = Progress(desc, len(endpoints), 'port')
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(sweep(endpoints, results, concurrent, progress))
+    finally:
+        loop.close()
+        progress.close()
+    schemes = {endpoint: scheme for endpoint, (status, scheme) in results.items()
+               if status == 'open' and need_sniff(endpoint[1])}
+    reachability.cache.update_schemes(schemes)
+    return results
+
+
+def check_ports(endpoints):
+    """
+    Check the status of endpoints, endpoints checked before are not checked again
+
+    :param set endpoints: (IP, port) endpoints
+    :return dict: {(IP, port): open, closed or filtered}
+    """
+    results = dict()
+    todo = list()
+    for ip, port in endpoints:
+        status = reachability.cache.get(ip, port)
+        if status:
+            results[(ip, port)] = status
+        else:
+            todo.append((ip, port))
+    if not todo:
+        return results
+    logger.log('INFOR', f'Checking {len(todo)} ports with TCP connect')
+    checked = {endpoint: status for endpoint, (status, _)
+               in run_sweep(todo, 'Port Check Progress').items()}
+    reachability.cache.update(checked)
+    results.update(checked)
+    counts = {'open': 0, 'closed': 0, 'filtered': 0}
+    for status in checked.values():
+        counts[status] += 1
+    logger.log('INFOR', f'Port check results {counts}')
+    return results
+
+
+def sniff_schemes(endpoints):
+    """
+    Sniff whether endpoints speak TLS, endpoints sniffed before are not
+    sniffed again and known unreachable endpoints are not sniffed
+
+    :param set endpoints: (IP, port) endpoints
+    :return dict: {(IP, port): https, http or None}
+    """
+    results = reachability.cache.get_schemes(endpoints)
+    todo = [(ip, port) for ip, port in endpoints if (ip, port) not in results
+            and reachability.cache.get(ip, port) not in reachability.dead_states]
+    if not todo:
+        return results
+    logger.log('INFOR', f'Sniffing the scheme of {len(todo)} ports')
+    checked = run_sweep(todo, 'Scheme Sniff Progress')
+    # 短超时的连接失败不足以判断被过滤 只记录开放和关闭
+    reachability.cache.update({endpoint: status for endpoint, (status, _) in checked.items()
+                               if status != 'filtered'})
+    results.update(reachability.cache.get_schemes(endpoints))
+    counts = {'https': 0, 'http': 0, None: 0}
+    for _, scheme in checked.values():
+        counts[scheme] += 1
+    logger.log('INFOR', f'Scheme sniff results {counts}')
+    return results
@@ -0,0 +1,76 @@
+"""
+Progress reporter shared by the long running stages
+
+Workers report finished items themselves, the bar is only redrawn at most
+every progress_interval seconds so there is no polling thread and an idle
+stage costs no CPU.
+"""
+
+import threading
+
+from tqdm import tqdm
+
+from config import settings
+
+
+class Progress(object):
+    """
+    Thread safe progress bar
+
+    :param str desc:  description
+    :param int total: total count (None means unknown)
+    :param str unit:  unit of items
+    """
+    def __init__(self, desc, total=None, unit='it'):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.bar = tqdm(total=total, desc=desc, unit=unit, ncols=80,
+                        mininterval=settings.progress_interval)
+
+    def update(self, num=1):
+        """
+        Report finished items
+
+        :param int num: finished item count
+        """
+        if not num:
+            return
+        with self.lock:
+            self.count += num
+            self.bar.update(num)
+
+    def iterate(self, items, step=1000):
+        """
+        Report the items as finished when they are consumed
+
+        :param items: iterable
+        :param int step: report every step items
+        :return: item generator
+        """
+        num = 0
+        for item in items:
+            yield item
+            num += 1
+            if num == step:
+                self.update(num)
+                num = 0
+        self.update(num)
+
+    def close(self, complete=False):
+        """
+        Close the bar
+
+        :param bool complete: set total to the finished count when the total
+                              was an estimate
+        """
+        with self.lock:
+            if complete:
+                self.bar.total = self.count
+                self.bar.refresh()
+            self.bar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
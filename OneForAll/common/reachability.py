@@ -0,0 +1,149 @@
+"""
+Reachability cache of the IP:port endpoints
+
+The status (open, closed or filtered) and the sniffed scheme of an endpoint
+are learned from the pre-flight TCP check or from the first connections of the
+requests, and shared by all the virtual hosts on the endpoint for the whole
+run. The urls of known unreachable endpoints fail fast instead of waiting for
+the connect timeout.
+"""
+
+import asyncio
+import errno
+import socket
+import threading
+
+from requests import exceptions
+
+from config import settings
+
+dead_states = ('closed', 'filtered')
+unreachable_errnos = {errno.EHOSTUNREACH, errno.ENETUNREACH}
+
+
+def get_error_status(error):
+    """
+    Get the endpoint status told by a connect error
+
+    :param Exception error: connect error
+    :return str: closed, filtered or None when the error tells nothing
+    """
+    if isinstance(error, ConnectionRefusedError):
+        return 'closed'
+    if isinstance(error, (socket.timeout, asyncio.TimeoutError)):
+        return 'filtered'
+    if getattr(error, 'errno', None) in unreachable_errnos:
+        return 'filtered'
+    return None
+
+
+def unreachable_error(ip, port, status):
+    return exceptions.ConnectionError(f'Skip the request because {ip}:{port} is {status}, '
+                                      f'it was unreachable earlier in this run')
+
+
+class Reachability(object):
+    """
+    Reachability of the IP:port endpoints in this run
+
+    A refused connection marks the endpoint closed, reachability_fail_num
+    timed out or unreachable connections mark it filtered. An endpoint once
+    seen open stays open so that its virtual hosts are always requested.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.records = dict()  # {(IP, 端口): 状态}
+        self.failures = dict()  # {(IP, 端口): 连接失败次数}
+        self.probing = set()  # 正在由线程首次连接的端点
+        self.unknown = set()  # 首次连接无法判断状态的端点 其余url不再逐个等待
+        self.schemes = dict()  # {(IP, 端口): 嗅探到的协议 None表示无法判断}
+
+    def get(self, ip, port):
+        with self.cond:
+            return self.records.get((ip, port))
+
+    def update(self, records):
+        with self.cond:
+            self.records.update(records)
+
+    def mark_unknown(self, ip, port):
+        """
+        Mark the endpoint whose first connection told nothing, the other urls
+        of the endpoint do not wait for each other any more
+        """
+        with self.cond:
+            self.unknown.add((ip, port))
+
+    def is_unknown(self, ip, port):
+        with self.cond:
+            return (ip, port) in self.unknown
+
+    def get_schemes(self, endpoints):
+        """
+        Get the sniffed schemes of endpoints
+
+        :param set endpoints: (IP, port) endpoints
+        :return dict: {(IP, port): https, http or None} of the sniffed endpoints
+        """
+        with self.cond:
+            return {key: self.schemes[key] for key in endpoints if key in self.schemes}
+
+    def update_schemes(self, schemes):
+        with self.cond:
+            self.schemes.update(schemes)
+
+    def record(self, ip, port, status):
+        """
+        Record the result of a connection
+
+        :param str ip: IP
+        :param int port: port
+        :param str status: open, closed, filtered or None when the result
+                           tells nothing about the reachability
+        """
+        key = (ip, port)
+        with self.cond:
+            if status is None or self.records.get(key) == 'open':
+                return
+            if status == 'filtered':
+                count = self.failures.get(key, 0) + 1
+                self.failures[key] = count
+                if count < settings.reachability_fail_num:
+                    return
+            self.records[key] = status
+
+    def check(self, ip, port):
+        """
+        Wait in the current thread until the endpoint is known open or this
+        thread is the one to connect it
+
+        :raise ConnectionError: the endpoint is known unreachable
+        """
+        key = (ip, port)
+        with self.cond:
+            while True:
+                status = self.records.get(key)
+                if status in dead_states:
+                    raise unreachable_error(ip, port, status)
+                if status == 'open' or key in self.unknown:
+                    return
+                if key not in self.probing:
+                    self.probing.add(key)
+                    return
+                self.cond.wait()
+
+    def done(self, ip, port, status):
+        """
+        Record the result of the connection allowed by check and wake up the
+        threads waiting for the endpoint, a result telling nothing also ends
+        the waiting so that the other urls are requested concurrently
+        """
+        self.record(ip, port, status)
+        if status is None:
+            self.mark_unknown(ip, port)
+        with self.cond:
+            self.probing.discard((ip, port))
+            self.cond.notify_all()
+
+
+cache = Reachability()
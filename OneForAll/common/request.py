@@ -1,14 +1,24 @@
 import json
+import time
+import hashlib
+import itertools
+from multiprocessing import Pool
 from threading import Thread
-from queue import Queue
+from queue import Queue, Empty
+from urllib.parse import urlsplit, urlunsplit
 
-import tqdm
 import requests
-from bs4 import BeautifulSoup
-
-from common import utils
+from requests import exceptions
+from urllib3.exceptions import NewConnectionError
+
+from common import utils, httpengine, portscan, reachability, respstore
+from common.aimd import Controller
+from common.budget import http_budget, aio_http_budget
+from common.htmltitle import get_html_title, get_html_titles
+from common.progress import Progress
 from config.log import logger
 from common.database import Database
+from common.ipasn import IPAsnInfo
 from config import settings
 
 
@@ -72,46 +82,6 @@ def gen_req_data(data, ports):
     return req_data, req_urls
 
 
-def get_html_title(markup):
-    """
-    获取标题
-
-    :param markup: html标签
-    :return: 标题
-    """
-    soup = BeautifulSoup(markup, 'html.parser')
-
-    title = soup.title
-    if title:
-        return title.text
-
-    h1 = soup.h1
-    if h1:
-        return h1.text
-
-    h2 = soup.h2
-    if h2:
-        return h2.text
-
-    h3 = soup.h3
-    if h3:
-        return h3.text
-
-    desc = soup.find('meta', attrs={'name': 'description'})
-    if desc:
-        return desc['content']
-
-    word = soup.find('meta', attrs={'name': 'keywords'})
-    if word:
-        return word['content']
-
-    text = soup.text
-    if len(text) <= 200:
-        return repr(text)
-
-    return 'None'
-
-
 def get_jump_urls(history):
     urls = list()
     for resp in history:
@@ -119,12 +89,34 @@ def get_jump_urls(history):
     return urls
 
 
-def get_progress_bar(total):
-    bar = tqdm.tqdm()
-    bar.total = total
-    bar.desc = 'Request Progress'
-    bar.ncols = 80
-    return bar
+def read_content(resp):
+    """
+    Read at most request_max_body_size bytes of the streamed response body
+
+    :param resp: response requested with stream=True
+    """
+    max_size = settings.request_max_body_size
+    chunks = list()
+    size = 0
+    truncated = False
+    try:
+        if resp.status_code in (204, 304) or resp.headers.get('Content-Length') == '0':
+            pass
+        elif utils.is_binary_type(resp.headers.get('Content-Type')):
+            truncated = True  # 二进制内容不读取响应体
+        else:
+            for chunk in resp.iter_content(65536):
+                if size + len(chunk) > max_size:
+                    chunks.append(chunk[:max_size - size])
+                    truncated = True
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+    finally:
+        resp.close()
+    resp._content = b''.join(chunks)
+    resp._content_consumed = True
+    resp.truncated = truncated
 
 
 def get_resp(url, session):
@@ -132,29 +124,94 @@ def get_resp(url, session):
     redirect = settings.request_allow_redirect
     proxy = utils.get_proxy()
     try:
-        resp = session.get(url, timeout=timeout, allow_redirects=redirect, proxies=proxy)
+        resp = session.get(url, timeout=timeout, allow_redirects=redirect,
+                           proxies=proxy, stream=True)
+        read_content(resp)
     except Exception as e:
         logger.log('DEBUG', e.args)
         resp = e
     return resp
 
 
-def request(urls_queue, resp_queue, session):
-    while not urls_queue.empty():
-        index, url = urls_queue.get()
-        resp = get_resp(url, session)
-        resp_queue.put((index, resp))
-        urls_queue.task_done()
+def get_resp_status(url, resp):
+    """
+    Get the status of the endpoint of url told by the result of its request
+
+    :param str url: requested url
+    :param resp: response or exception
+    :return str: open, closed, filtered or None when the result tells nothing
+    """
+    if not isinstance(resp, Exception):
+        return 'open'
+    req = getattr(resp, 'request', None)
+    if req is not None and req.url:
+        failed = urlsplit(req.url)
+        origin = urlsplit(url)
+        if (failed.hostname, get_url_port(req.url)) != (origin.hostname, get_url_port(url)):
+            return None  # 跳转后的url连接失败
+    if isinstance(resp, exceptions.ConnectTimeout):
+        return 'filtered'
+    if isinstance(resp, exceptions.ReadTimeout):
+        return 'open'  # TCP连接已建立 只是响应慢
+    if not isinstance(resp, exceptions.ConnectionError) or not resp.args:
+        return None
+    reason = getattr(resp.args[0], 'reason', None)
+    if not isinstance(reason, NewConnectionError):
+        return 'open' if reason is not None else None
+    error = reason.__cause__ or reason.__context__
+    return reachability.get_error_status(error)
+
+
+def use_reachability():
+    return settings.enable_reachability_cache and not settings.enable_request_proxy
+
+
+def window_resp(url, ip, session, controller=None):
+    """
+    Request url in a slot of the congestion window of its destination
+    """
+    if not controller:
+        return get_resp(url, session)
+    windows = controller.acquire(ip)
+    start = time.monotonic()
+    resp = get_resp(url, session)
+    controller.release(windows, resp, time.monotonic() - start)
+    return resp
+
+
+def reach_resp(url, ip, session, controller=None):
+    """
+    Request url unless its IP:port endpoint is known unreachable, the first
+    connection of an unknown endpoint decides for its other urls, the window
+    slot is only taken after waiting for the first connection
+    """
+    if not ip or not use_reachability():
+        return window_resp(url, ip, session, controller)
+    port = get_url_port(url)
+    try:
+        reachability.cache.check(ip, port)
+    except exceptions.ConnectionError as e:
+        logger.log('DEBUG', e.args)
+        return e
+    resp = None
+    try:
+        resp = window_resp(url, ip, session, controller)
+    finally:
+        status = get_resp_status(url, resp) if resp is not None else None
+        reachability.cache.done(ip, port, status)
+    return resp
 
 
-def progress(bar, total, urls_queue):
+def request(urls_queue, resp_queue, session, progress, controller=None):
     while True:
-        remaining = urls_queue.qsize()
-        done = total - remaining
-        bar.n = done
-        bar.update()
-        if remaining == 0:
+        try:
+            index, url, ip = urls_queue.get_nowait()
+        except Empty:  # 所有请求任务都已取出
             break
+        resp = reach_resp(url, ip, session, controller)
+        resp_queue.put((index, resp))
+        progress.update()
+        urls_queue.task_done()
 
 
 def get_session():
@@ -169,7 +226,16 @@ def get_session():
     return session
 
 
+def get_body_hash(resp):
+    body_hash = getattr(resp, 'body_hash', None)
+    if body_hash is None:
+        body_hash = hashlib.sha256(resp.content).hexdigest()
+        resp.body_hash = body_hash
+    return body_hash
+
+
 def gen_new_info(info, resp):
+    info['request_time'] = utils.get_timestamp()
     if isinstance(resp, Exception):
         info['reason'] = str(resp.args)
         info['request'] = 0
@@ -189,76 +255,401 @@ def gen_new_info(info, resp):
     info['header'] = json.dumps(dict(headers))
     history = resp.history
     info['history'] = json.dumps(get_jump_urls(history))
-    text = utils.decode_resp_text(resp)
-    title = get_html_title(text).strip()
-    info['title'] = utils.remove_invalid_string(title)
-    info['response'] = utils.remove_invalid_string(text)
+    content = resp.content
+    truncated = getattr(resp, 'truncated', False)
+    info['truncated'] = int(truncated)
+    length = headers.get('Content-Length', '').strip()
+    if length.isdigit():
+        info['content_length'] = int(length)
+    elif not truncated:
+        info['content_length'] = len(content)
+    body_hash = get_body_hash(resp)
+    info['body_hash'] = body_hash
+    if not settings.enable_response_store:
+        text = utils.decode_resp_text(resp)
+        title = get_html_title(text).strip()
+        info['title'] = utils.remove_invalid_string(title)
+        info['response'] = utils.remove_invalid_string(text)
+        return info
+    title = respstore.store.get_title(body_hash)
+    if title is None:  # 相同响应体只解码和提取标题一次
+        text = utils.remove_invalid_string(utils.decode_resp_text(resp))
+        title = utils.remove_invalid_string(get_html_title(text).strip())
+        respstore.store.add(body_hash, title, text)
+    info['title'] = title
+    info['response'] = None
     return info
 
 
+def get_results(resp_queue, count, interval):
+    """
+    Get a batch of request results
+
+    Return when count results are got or interval seconds passed since the
+    first result of the batch arrived.
+
+    :param Queue resp_queue: queue of (index, response)
+    :param int count: max batch size
+    :param float interval: max waiting seconds
+    :return list: (index, response) results
+    """
+    results = [resp_queue.get()]  # 阻塞等待下一个请求结果
+    deadline = time.monotonic() + interval
+    while len(results) < count:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            results.append(resp_queue.get(timeout=timeout))
+        except Empty:
+            break
+    return results
+
+
+def extract_titles(resps, pool):
+    """
+    Extract the titles of the bodies not seen before in the process pool, the
+    titles are memoized in the response store for gen_new_info
+
+    :param list resps: responses or exceptions
+    :param pool: process pool
+    """
+    texts = dict()
+    for resp in resps:
+        if isinstance(resp, Exception):
+            continue
+        body_hash = get_body_hash(resp)
+        if body_hash in texts or respstore.store.get_title(body_hash) is not None:
+            continue
+        texts[body_hash] = utils.remove_invalid_string(utils.decode_resp_text(resp))
+    titles = get_html_titles(list(texts.values()), pool=pool)
+    for (body_hash, text), title in zip(texts.items(), titles):
+        title = utils.remove_invalid_string(title.strip())
+        respstore.store.add(body_hash, title, text)
+
+
+def get_title_pool():
+    processes = settings.request_title_process_num
+    if not settings.enable_response_store or not processes or processes <= 1:
+        return None
+    return Pool(processes)
+
+
 def save(name, total, req_data, resp_queue):
     db = Database()
     db.create_table(name)
-    i = 0
-    while True:
-        if not resp_queue.empty():
-            i += 1
-            index, resp = resp_queue.get()
-            old_info = req_data[index]
-            new_info = gen_new_info(old_info, resp)
-            db.insert_table(name, new_info)
-            resp_queue.task_done()
-        if i >= total:  # 得存入完所有请求结果才能结束
-            break
-    db.close()
+    size = settings.request_save_batch_size
+    interval = settings.request_save_interval
+    pool = get_title_pool()
+    saved = 0
+    try:
+        while saved < total:  # 得存入完所有请求结果才能结束
+            results = get_results(resp_queue, min(size, total - saved), interval)
+            if pool:
+                extract_titles([resp for _, resp in results], pool)
+            infos = [gen_new_info(req_data[index], resp) for index, resp in results]
+            respstore.store.flush(db)
+            try:
+                db.insert_rows(name, infos, overwrite=True)
+            except Exception:  # 保存线程退出会使请求阶段一直等待 记录丢失的结果后继续
+                logger.log('ALERT', f'{len(infos)} request results of {name} were not saved')
+            for _ in results:
+                resp_queue.task_done()
+            saved += len(results)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        db.close()
+
+
+def use_async_engine():
+    if settings.request_engine != 'async':
+        return False
+    if settings.enable_request_proxy:
+        logger.log('DEBUG', 'Use the thread request engine because proxy is enabled')
+        return False
+    return True
+
+
+def get_first_ip(info):
+    ip = info.get('ip')
+    if not ip:
+        return None
+    return ip.split(',')[0]
+
+
+def gen_tasks(req_data):
+    """
+    Generate request tasks ordered round robin by destination IP so that the
+    requests to one IP are spread over the whole run
 
+    :param list req_data: request data
+    :return list: (index, url, ip) tasks
+    """
+    groups = dict()
+    for index, info in enumerate(req_data):
+        ip = get_first_ip(info)
+        groups.setdefault(ip, list()).append((index, info.get('url'), ip))
+    tasks = list()
+    for items in itertools.zip_longest(*groups.values()):
+        tasks.extend(item for item in items if item)
+    return tasks
 
-def bulk_request(domain, req_data, ret=False):
-    logger.log('INFOR', 'Requesting urls in bulk')
-    resp_queue = Queue()
+
+def get_asns(ips):
+    """
+    Get the ASN of destination IPs
+
+    :param set ips: IPs
+    :return dict: {ip: asn}
+    """
+    try:
+        ip_asn = IPAsnInfo()
+    except Exception as e:
+        logger.log('DEBUG', f'Request concurrency is not limited by ASN: {e}')
+        return dict()
+    asns = dict()
+    for ip in ips:
+        try:
+            asns[ip] = ip_asn.find(ip).get('asn')
+        except Exception as e:
+            logger.log('TRACE', e.args)
+    ip_asn.close()
+    return asns
+
+
+def get_controller(maximum, tasks):
+    """
+    Get the adaptive concurrency controller of the request stage
+
+    :param int maximum: max global concurrency
+    :param list tasks: request tasks
+    :return: controller (None when adaptive concurrency is disabled)
+    """
+    if not settings.enable_request_adaptive:
+        return None
+    per_asn = settings.request_adaptive_asn_num or None
+    asns = dict()
+    if per_asn:
+        asns = get_asns({ip for _, _, ip in tasks if ip})
+    return Controller(maximum, per_asn=per_asn, asns=asns)
+
+
+def get_url_port(url):
+    parts = urlsplit(url)
+    return parts.port or (443 if parts.scheme == 'https' else 80)
+
+
+def use_preflight(tasks):
+    if not settings.enable_port_preflight:
+        return False
+    if settings.enable_request_proxy:
+        return False
+    ports = {get_url_port(url) for _, url, _ in tasks}
+    return len(ports) >= settings.port_preflight_min_num
+
+
+def preflight(tasks, resp_queue):
+    """
+    Check the ports of the request tasks with TCP connect, the tasks of closed
+    or filtered ports are answered with an error without HTTP request
+
+    :param list tasks: (index, url, ip) request tasks
+    :param Queue resp_queue: queue of (index, response)
+    :return list: tasks to be requested
+    """
+    endpoints = {(ip, get_url_port(url)) for _, url, ip in tasks if ip}
+    status = portscan.check_ports(endpoints)
+    open_tasks = list()
+    for index, url, ip in tasks:
+        port = get_url_port(url)
+        state = status.get((ip, port))
+        if state in ('closed', 'filtered'):
+            error = exceptions.ConnectionError(f'Port {port} of {ip} is {state} '
+                                               f'in the pre-flight check')
+            resp_queue.put((index, error))
+        else:
+            open_tasks.append((index, url, ip))
+    logger.log('INFOR', f'Pre-flight check skipped {len(tasks) - len(open_tasks)} '
+                        f'urls of closed or filtered ports')
+    return open_tasks
+
+
+def use_sniff():
+    return settings.enable_scheme_sniff and not settings.enable_request_proxy
+
+
+def switch_schemes(tasks, req_data):
+    """
+    Sniff the scheme of the non-standard ports and request their urls with
+    the scheme the endpoint speaks instead of guessing by the port number
+
+    :param list tasks: (index, url, ip) request tasks
+    :param list req_data: request data, urls are updated in place
+    :return list: tasks
+    """
+    endpoints = set()
+    for _, url, ip in tasks:
+        port = get_url_port(url)
+        if ip and portscan.need_sniff(port):
+            endpoints.add((ip, port))
+    if not endpoints:
+        return tasks
+    schemes = portscan.sniff_schemes(endpoints)
+    new_tasks = list()
+    count = 0
+    for index, url, ip in tasks:
+        parts = urlsplit(url)
+        scheme = schemes.get((ip, get_url_port(url)))
+        if scheme and scheme != parts.scheme:
+            url = urlunsplit(parts._replace(scheme=scheme))
+            req_data[index]['url'] = url
+            count += 1
+        new_tasks.append((index, url, ip))
+    logger.log('INFOR', f'Switched the scheme of {count} urls by sniffing')
+    return new_tasks
+
+
+def async_bulk_request(tasks, resp_queue):
+    """
+    Request urls with the asyncio HTTP probing engine
+
+    :param list tasks: (index, url, ip) request tasks
+    :param Queue resp_queue: queue of (index, response)
+    """
+    task_count = len(tasks)
+    concurrent = min(settings.request_async_concurrent_num, max(1, task_count))
+    # 多个目标同时请求时共享全局异步请求总量
+    concurrent = aio_http_budget.acquire(concurrent)
+    progress = Progress('Request Progress', task_count, 'url')
+    workers = httpengine.raise_nofile_limit(concurrent)
+    controller = get_controller(workers, tasks)
+
+    def callback(index, resp):
+        resp_queue.put((index, resp))
+        progress.update()
+
+    try:
+        httpengine.bulk_fetch(tasks, callback, workers, utils.gen_fake_header(),
+                              controller)
+    finally:
+        aio_http_budget.release(concurrent)
+        progress.close()
+    if controller:
+        controller.log_summary()
+
+
+def thread_bulk_request(tasks, resp_queue):
+    """
+    Request urls with threads
+
+    :param list tasks: (index, url, ip) request tasks
+    :param Queue resp_queue: queue of (index, response)
+    """
     urls_queue = Queue()
-    task_count = len(req_data)
-    for index, info in enumerate(req_data):
-        url = info.get('url')
-        urls_queue.put((index, url))
+    task_count = len(tasks)
+    for task in tasks:
+        urls_queue.put(task)
     session = get_session()
     thread_count = req_thread_count()
     if task_count <= thread_count:
         # 如果请求任务数很小不用创建很多线程了
         thread_count = task_count
-    bar = get_progress_bar(task_count)
-
-    progress_thread = Thread(target=progress, name='ProgressThread',
-                             args=(bar, task_count, urls_queue), daemon=True)
-    progress_thread.start()
+    # 多个目标同时请求时共享全局请求线程总量
+    thread_count = http_budget.acquire(thread_count)
+    progress = Progress('Request Progress', task_count, 'url')
+    controller = get_controller(thread_count, tasks)
 
     for i in range(thread_count):
         request_thread = Thread(target=request, name=f'RequestThread-{i}',
-                                args=(urls_queue, resp_queue, session), daemon=True)
+                                args=(urls_queue, resp_queue, session, progress,
+                                      controller), daemon=True)
         request_thread.start()
+    urls_queue.join()
+    http_budget.release(thread_count)
+    progress.close()
+    if controller:
+        controller.log_summary()
+
+
+def bulk_request(domain, req_data, ret=False):
+    """
+    Request urls in bulk
+
+    :param str domain: domain to be requested
+    :param list req_data: request data
+    :param bool ret: return the response queue instead of saving the results
+    :return: queue of (index, response) when ret is True
+    """
+    logger.log('INFOR', 'Requesting urls in bulk')
+    resp_queue = Queue()
+    tasks = gen_tasks(req_data)
+    if use_preflight(tasks):
+        tasks = preflight(tasks, resp_queue)
+    if use_sniff():
+        tasks = switch_schemes(tasks, req_data)
+    save_thread = None
+    if not ret:
+        save_thread = Thread(target=save, name=f'SaveThread',
+                             args=(domain, len(req_data), req_data, resp_queue), daemon=True)
+        save_thread.start()
+    if tasks:
+        if use_async_engine():
+            async_bulk_request(tasks, resp_queue)
+        else:
+            thread_bulk_request(tasks, resp_queue)
     if ret:
-        urls_queue.join()
         return resp_queue
-    save_thread = Thread(target=save, name=f'SaveThread',
-                         args=(domain, task_count, req_data, resp_queue), daemon=True)
-    save_thread.start()
-    urls_queue.join()
     save_thread.join()
 
 
-def run_request(domain, data, port):
+def filter_done_data(domain, req_data):
+    """
+    Filter out the urls whose results have been saved in the table
+
+    The saved url may use the sniffed scheme instead of the generated one, so
+    the requested results are matched on subdomain and port.
+
+    :param  str domain: domain to be requested
+    :param  list req_data: request data
+    :return list: request data not done
+    """
+    db = Database()
+    db.create_table(domain)
+    table_name = domain.replace('.', '_')
+    rows = db.query(f'select subdomain, port from "{table_name}" '
+                    f'where request_time is not null')
+    done = {(row.subdomain, row.port) for row in rows or ()}
+    db.close()
+    new_data = [info for info in req_data
+                if (info.get('subdomain'), info.get('port')) not in done]
+    logger.log('INFOR', f'Resume: skip {len(req_data) - len(new_data)} requested urls')
+    return new_data
+
+
+def run_request(domain, data, port, resume=False, incremental=None):
     """
     HTTP request entrance
 
     :param  str domain: domain to be requested
     :param  list data: subdomains data to be requested
     :param  any port: range of ports to be requested
+    :param  bool resume: skip the urls already requested (default False)
+    :param  incremental: incremental re-scan object (default None)
     :return list: result
     """
     logger.log('INFOR', f'Start requesting subdomains of {domain}')
     data = utils.set_id_none(data)
     ports = get_port_seq(port)
     req_data, req_urls = gen_req_data(data, ports)
+    reused = list()
+    if incremental:
+        req_data, reused = incremental.split_request(req_data)
+    if resume:
+        req_data = filter_done_data(domain, req_data)
     bulk_request(domain, req_data)
+    if incremental:
+        incremental.copy_reused(reused)
     count = utils.count_alive(domain)
     logger.log('INFOR', f'Found that {domain} has {count} alive subdomains')
@@ -1,9 +1,11 @@
-import gc
 import json
 
 from config.log import logger
 from config import settings
-from common import utils
+from common import utils, dnsengine
+from common.budget import dns_budget
+from common.dnscache import resolve_cache
+from common.progress import Progress
 
 
 def filter_subdomain(data):
@@ -90,6 +92,7 @@ def gen_infos(data, qname, info, infos):
             info['cname'] = ','.join(cnames)
             info['ip'] = ','.join(ips)
             info['ttl'] = ','.join(ttl)
+            info['resolve_time'] = utils.get_timestamp()
             infos[qname] = info
     if not flag:
         logger.log('DEBUG', f'Resolving {qname} have not a record')
@@ -100,6 +103,31 @@ def gen_infos(data, qname, info, infos):
     return infos
 
 
+def deal_item(items, infos):
+    """
+    Process one resolved result in massdns output structure
+
+    :param dict items: resolved result
+    :param dict infos: subdomain infos to be updated
+    """
+    info = dict()
+    info['resolver'] = items.get('resolver')
+    qname = items.get('name')[:-1]  # 去除最右边的`.`点号
+    status = items.get('status')
+    if status != 'NOERROR':
+        logger.log('DEBUG', f'Resolving {qname}: {status}')
+        return
+    data = items.get('data')
+    if 'answers' not in data:
+        logger.log('DEBUG', f'Resolving {qname} have not any answers')
+        info['alive'] = 0
+        info['resolve'] = 0
+        info['reason'] = 'NoAnswer'
+        infos[qname] = info
+        return
+    gen_infos(data, qname, info, infos)
+
+
 def deal_output(output_path):
     logger.log('INFOR', f'Processing resolved results')
     infos = dict()  # 用来记录所有域名有关信息
@@ -112,39 +140,39 @@ def deal_output(output_path):
                 logger.log('ERROR', e.args)
                 logger.log('ERROR', f'Error resolve line {line}, skip this line')
                 continue
-            info = dict()
-            info['resolver'] = items.get('resolver')
-            qname = items.get('name')[:-1]  # 去除最右边的`.`点号
-            status = items.get('status')
-            if status != 'NOERROR':
-                logger.log('DEBUG', f'Resolving {qname}: {status}')
-                continue
-            data = items.get('data')
-            if 'answers' not in data:
-                logger.log('DEBUG', f'Resolving {qname} have not any answers')
-                info['alive'] = 0
-                info['resolve'] = 0
-                info['reason'] = 'NoAnswer'
-                infos[qname] = info
-                continue
-            infos = gen_infos(data, qname, info, infos)
+            deal_item(items, infos)
     return infos
 
 
-def run_resolve(domain, data):
+def run_engine(subdomains):
     """
-    调用子域解析入口函数
+    Resolve subdomains with the built-in DNS engine
 
-    :param str domain: 待解析的主域
-    :param list data: 待解析的子域数据列表
-    :return: 解析得到的结果列表
-    :rtype: list
+    :param list subdomains: subdomains to be resolved
+    :return dict: subdomain infos
     """
-    logger.log('INFOR', f'Start resolving subdomains of {domain}')
-    subdomains = filter_subdomain(data)
-    if not subdomains:
-        return data
+    logger.log('INFOR', f'Running built-in DNS engine to resolve subdomains')
+    infos = dict()
+    ns_path = utils.get_ns_path()
+    concurrent_num = dns_budget.acquire(10000)
+    progress = Progress('Resolve Progress', len(subdomains), 'name')
+    try:
+        dnsengine.resolve(subdomains, ns_path, lambda items: deal_item(items, infos),
+                          concurrent_num, progress=progress)
+    finally:
+        dns_budget.release(concurrent_num)
+        progress.close()
+    return infos
 
+
+def run_massdns(domain, subdomains):
+    """
+    Resolve subdomains with massdns
+
+    :param str domain: main domain
+    :param list subdomains: subdomains to be resolved
+    :return dict: subdomain infos
+    """
     massdns_dir = settings.third_party_dir.joinpath('massdns')
     result_dir = settings.result_save_dir
     temp_dir = result_dir.joinpath('temp')
@@ -155,8 +183,6 @@ def run_resolve(domain, data):
     save_name = f'collected_subdomains_{domain}_{timestring}.txt'
     save_path = temp_dir.joinpath(save_name)
     save_subdomains(save_path, subdomains)
-    del subdomains
-    gc.collect()
 
     output_name = f'resolved_result_{domain}_{timestring}.json'
     output_path = temp_dir.joinpath(output_name)
@@ -164,10 +190,46 @@ def run_resolve(domain, data):
     ns_path = utils.get_ns_path()
 
     logger.log('INFOR', f'Running massdns to resolve subdomains')
-    utils.call_massdns(massdns_path, save_path, ns_path,
-                       output_path, log_path, quiet_mode=True)
+    concurrent_num = dns_budget.acquire(10000)
+    progress = Progress('Resolve Progress', len(subdomains), 'name')
+    try:
+        utils.call_massdns(massdns_path, save_path, ns_path, output_path,
+                           log_path, quiet_mode=True, concurrent_num=concurrent_num)
+        progress.update(len(subdomains))
+    finally:
+        dns_budget.release(concurrent_num)
+        progress.close()
+    return deal_output(output_path)
+
 
-    infos = deal_output(output_path)
+def run_resolve(domain, data):
+    """
+    调用子域解析入口函数
+
+    :param str domain: 待解析的主域
+    :param list data: 待解析的子域数据列表
+    :return: 解析得到的结果列表
+    :rtype: list
+    """
+    logger.log('INFOR', f'Start resolving subdomains of {domain}')
+    subdomains = filter_subdomain(data)
+    if not subdomains:
+        return data
+    cached = dict()
+    if settings.enable_dns_cache:
+        cached, subdomains = resolve_cache.lookup(subdomains)
+    infos = dict()
+    if subdomains:
+        if utils.use_builtin_engine():
+            infos = run_engine(subdomains)
+        else:
+            infos = run_massdns(domain, subdomains)
+        if settings.enable_dns_cache:
+            resolve_cache.store(subdomains, infos)
+    del subdomains
+    for subdomain, info in cached.items():
+        if info is not None:
+            infos[subdomain] = dict(info)
     data = update_data(data, infos)
     logger.log('INFOR', f'Finished resolve subdomains of {domain}')
     return data
@@ -0,0 +1,83 @@
+"""
+Content-addressed store of response bodies
+
+Many urls answer with byte-identical bodies (default server pages, CDN error
+pages, parking pages). The decoded text of each distinct body is compressed
+and saved once in the response_blob table keyed by its body hash, result rows
+only keep the hash. Decoding and title extraction are done once per hash.
+"""
+
+import threading
+import zlib
+from collections import OrderedDict
+
+from config import settings
+
+blob_table = 'response_blob'
+
+
+def compress_text(text):
+    return zlib.compress(text.encode('utf-8', 'surrogatepass'),
+                         settings.response_compress_level)
+
+
+def decompress_text(data):
+    return zlib.decompress(data).decode('utf-8', 'surrogatepass')
+
+
+class ResponseStore(object):
+    """
+    Title memo and pending blobs of the response bodies seen in this process
+
+    :param int size: max count of memoized titles
+    """
+    def __init__(self, size=None):
+        self.lock = threading.Lock()
+        self.size = size or settings.response_memo_num
+        self.titles = OrderedDict()  # {body_hash: title} 最近使用的在最后
+        self.pending = dict()  # {body_hash: 待保存的blob行}
+
+    def get_title(self, body_hash):
+        """
+        Get the memoized title of a body
+
+        :param str body_hash: body hash
+        :return str: title (None when the body was not seen)
+        """
+        with self.lock:
+            title = self.titles.get(body_hash)
+            if title is not None:
+                self.titles.move_to_end(body_hash)
+            return title
+
+    def add(self, body_hash, title, text):
+        """
+        Memoize the title of a new body and queue its blob to be saved
+
+        :param str body_hash: body hash
+        :param str title: title
+        :param str text: decoded body text
+        """
+        row = {'hash': body_hash, 'title': title, 'size': len(text),
+               'data': compress_text(text)}
+        with self.lock:
+            self.titles[body_hash] = title
+            if len(self.titles) > self.size:
+                self.titles.popitem(last=False)
+            self.pending[body_hash] = row
+
+    def flush(self, db):
+        """
+        Save the pending blobs, must be called before the rows referencing
+        them are saved
+
+        :param db: Database
+        """
+        with self.lock:
+            rows = list(self.pending.values())
+            self.pending.clear()
+        if rows:
+            db.save_blobs(rows)
+
+
+store = ResponseStore()
@@ -0,0 +1,137 @@
+"""
+Thin data access layer over the standard sqlite3 module
+
+Queries of the result tables skip SQLAlchemy and records: each thread keeps one
+long-lived connection per database file, rows are namedtuples built straight
+from the cursor and results are fetched lazily.
+"""
+
+import sqlite3
+import threading
+from collections import namedtuple
+from functools import lru_cache
+
+from common.tablib import tablib
+
+# 每个连接建立时设置 WAL模式下读不阻塞写 写也不阻塞读
+pragmas = ['pragma journal_mode = wal', 'pragma synchronous = normal',
+           'pragma temp_store = memory', 'pragma cache_size = -16000']
+
+local = threading.local()
+
+
+def set_pragmas(conn):
+    cursor = conn.cursor()
+    for pragma in pragmas:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def connect(path):
+    """
+    Get the connection of the current thread to a database file, the
+    connection is opened once and kept until the thread exits
+
+    :param str path: database path
+    :return: sqlite3 connection
+    """
+    conns = getattr(local, 'conns', None)
+    if conns is None:
+        conns = local.conns = dict()
+    conn = conns.get(path)
+    if conn is None:
+        # 多个目标同时写入时等待锁释放而不是直接报database is locked
+        conn = sqlite3.connect(path, timeout=60)
+        set_pragmas(conn)
+        conns[path] = conn
+    return conn
+
+
+@lru_cache(maxsize=256)
+def get_row_type(names):
+    # count()这类不是合法标识符的列名改为位置名
+    return namedtuple('Row', names, rename=True)
+
+
+class Rows(object):
+    """
+    Lazy result of a query, rows are fetched from the cursor when iterated and
+    kept so the result can be iterated again
+
+    :param cursor: sqlite3 cursor of an executed query
+    """
+    def __init__(self, cursor):
+        names = tuple(item[0] for item in cursor.description or ())
+        self.keys = list(names)
+        self.row_type = get_row_type(names) if names else None
+        self.cursor = cursor
+        self.fetched = list()
+        self.pending = bool(names)
+
+    def __repr__(self):
+        return f'<Rows size={len(self.fetched)} pending={self.pending}>'
+
+    def __iter__(self):
+        yield from self.fetched
+        if not self.pending:
+            return
+        for values in self.cursor:
+            row = self.row_type._make(values)
+            self.fetched.append(row)
+            yield row
+        self.pending = False
+
+    def stream(self, size=1000):
+        """
+        Fetch the rows in batches without keeping them, the rows are only
+        read once so the memory used does not grow with the result
+
+        :param int size: rows of each fetch
+        """
+        yield from self.fetched
+        if not self.pending:
+            return
+        while True:
+            values = self.cursor.fetchmany(size)
+            if not values:
+                break
+            yield from map(self.row_type._make, values)
+        self.pending = False
+
+    def all(self):
+        if self.pending:
+            self.fetched.extend(map(self.row_type._make, self.cursor.fetchall()))
+            self.pending = False
+        return self.fetched
+
+    def as_dict(self):
+        keys = self.keys
+        return [dict(zip(keys, row)) for row in self.all()]
+
+    def first(self, default=None):
+        for row in self:
+            break
+        else:
+            return default
+        if self.pending:  # 未读完的语句会阻止同一连接上的删表等操作
+            self.cursor.close()
+            self.pending = False
+        return row
+
+    def scalar(self, default=None):
+        row = self.first()
+        return row[0] if row else default
+
+    @property
+    def dataset(self):
+        data = tablib.Dataset()
+        rows = self.all()
+        if not rows:
+            return data
+        data.headers = self.keys
+        for row in rows:
+            data.append(row)
+        return data
+
+    def export(self, fmt):
+        return self.dataset.export(fmt)
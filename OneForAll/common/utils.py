@@ -18,9 +18,9 @@ import requests
 import tenacity
 from dns.resolver import Resolver
 
+from common import exporter
 from common.database import Database
 from common.domain import Domain
-from common.records import Record, RecordCollection
 from config import settings
 from config.log import logger
 
@@ -210,8 +210,7 @@ def check_format(fmt):
     :param fmt: 传入的导出格式
     :return: 导出格式
     """
-    formats = ['csv', 'json', ]
-    if fmt in formats:
+    if fmt in exporter.formats:
         return fmt
     else:
         logger.log('ALERT', f'Does not support {fmt} format')
@@ -233,9 +232,9 @@ def save_to_db(name, data, module):
     :param str module: module name
     """
     db = Database()
-    db.drop_table(name)
     db.create_table(name)
-    db.save_db(name, data, module)
+    db.clear_table(name)
+    db.save_db(name, data, module, overwrite=True)
     db.close()
 
 
@@ -316,23 +315,15 @@ def remove_invalid_string(string):
     return re.sub(r'[\000-\010]|[\013-\014]|[\016-\037]', r'', string)
 
 
-def export_all_results(path, name, fmt, datas):
-    path = check_path(path, name, fmt)
+def export_all_results(path, name, fmt, datas, compress=None):
+    path = exporter.get_path(check_path(path, name, fmt), compress)
     logger.log('ALERT', f'The subdomain result for all main domains: {path}')
-    row_list = list()
-    for row in datas:
-        if 'header' in row:
-            row.pop('header')
-        if 'response' in row:
-            row.pop('response')
-        keys = row.keys()
-        values = row.values()
-        row_list.append(Record(keys, values))
-    rows = RecordCollection(iter(row_list))
-    content = rows.export(fmt)
-    if fmt == 'csv':
-        content = '\ufeff' + content
-    save_to_file(path, content)
+    if not datas:
+        exporter.export_rows(path, fmt, list(), list())
+        return
+    keys = [key for key in datas[0] if key not in ('header', 'response')]
+    rows = ([row.get(key) for key in keys] for row in datas)
+    exporter.export_rows(path, fmt, keys, rows)
 
 
 def export_all_subdomains(alive, path, name, datas):
@@ -351,7 +342,7 @@ def export_all_subdomains(alive, path, name, datas):
     save_to_file(path, data)
 
 
-def export_all(alive, fmt, path, datas):
+def export_all(alive, fmt, path, datas, compress=None):
     """
     将所有结果数据导出
 
@@ -359,11 +350,12 @@ def export_all(alive, fmt, path, datas):
     :param str fmt: 导出文件格式
     :param str path: 导出文件路径
     :param list datas: 待导出的结果数据
+    :param bool compress: 是否用gzip压缩(默认使用result_save_compress设置)
     """
     fmt = check_format(fmt)
     timestamp = get_timestring()
     name = f'all_subdomain_result_{timestamp}'
-    export_all_results(path, name, fmt, datas)
+    export_all_results(path, name, fmt, datas, compress)
     export_all_subdomains(alive, path, name, datas)
 
 
@@ -375,6 +367,9 @@ def dns_resolver():
     resolver.nameservers = settings.resolver_nameservers
     resolver.timeout = settings.resolver_timeout
     resolver.lifetime = settings.resolver_lifetime
+    if settings.enable_dns_cache:
+        from common.dnscache import answer_cache
+        resolver.cache = answer_cache  # 各阶段共享遵循TTL的应答缓存
     return resolver
 
 
@@ -587,7 +582,13 @@ def get_main_domain(domain):
 
 def call_massdns(massdns_path, dict_path, ns_path, output_path, log_path,
                  query_type='A', process_num=1, concurrent_num=10000,
-                 quiet_mode=False):
+                 quiet_mode=False, names=None):
+    """
+    Run massdns
+
+    :param dict_path: dictionary path, names are fed through stdin when None
+    :param names: name iterable fed to massdns through stdin
+    """
     logger.log('DEBUG', 'Start running massdns')
     quiet = ''
     if quiet_mode:
@@ -600,17 +601,27 @@ def call_massdns(massdns_path, dict_path, ns_path, output_path, log_path,
           f'--hashmap-size {concurrent_num} --resolvers {ns_path} ' \
           f'--resolve-count {resolve_num} --type {query_type} ' \
           f'--flush --output J --outfile {output_path} ' \
-          f'--root --error-log {log_path} {dict_path} --filter OK ' \
+          f'--root --error-log {log_path} {dict_path or ""} --filter OK ' \
           f'--sndbuf 0 --rcvbuf 0'
     logger.log('DEBUG', f'Run command {cmd}')
-    subprocess.run(args=cmd, shell=True)
+    if dict_path:
+        subprocess.run(args=cmd, shell=True)
+    else:
+        proc = subprocess.Popen(args=cmd, shell=True, stdin=subprocess.PIPE)
+        try:
+            for name in names:
+                proc.stdin.write(f'{name}\n'.encode('utf-8', 'ignore'))
+            proc.stdin.close()
+        except BrokenPipeError:
+            logger.log('ERROR', 'massdns exited before reading all names')
+        proc.wait()
     logger.log('DEBUG', f'Finished massdns')
 
 
-def get_massdns_path(massdns_dir):
+def gen_massdns_path(massdns_dir):
     path = settings.brute_massdns_path
     if path:
-        return path
+        return Path(path)
     system = platform.system().lower()
     machine = platform.machine().lower()
     name = f'massdns_{system}_{machine}'
@@ -620,16 +631,42 @@ def get_massdns_path(massdns_dir):
             massdns_dir = massdns_dir.joinpath('windows', 'x64')
         else:
             massdns_dir = massdns_dir.joinpath('windows', 'x86')
-    path = massdns_dir.joinpath(name)
-    path.chmod(S_IXUSR)
+    return massdns_dir.joinpath(name)
+
+
+def get_massdns_path(massdns_dir):
+    path = settings.brute_massdns_path
+    if path:
+        return path
+    path = gen_massdns_path(massdns_dir)
     if not path.exists():
         logger.log('FATAL', 'There is no massdns for this platform or architecture')
         logger.log('INFOR', 'Please try to compile massdns yourself '
                             'and specify the path in the configuration')
         exit(0)
+    path.chmod(S_IXUSR)
     return path
 
 
+def use_builtin_engine():
+    """
+    Whether to use the built-in DNS engine instead of massdns
+
+    :return bool: result
+    """
+    engine = settings.dns_resolve_engine
+    if engine == 'builtin':
+        return True
+    if engine == 'massdns':
+        return False
+    massdns_dir = settings.third_party_dir.joinpath('massdns')
+    if gen_massdns_path(massdns_dir).exists():
+        return False
+    logger.log('ALERT', 'There is no massdns for this platform or architecture, '
+                        'use the built-in DNS engine')
+    return True
+
+
 def is_subname(name):
     chars = string.ascii_lowercase + string.digits + '.-'
     for char in name:
@@ -711,10 +748,45 @@ def get_url_resp(url):
     return resp
 
 
+def is_binary_type(content_type):
+    """
+    Whether the Content-Type is a binary type whose body need not be read
+
+    :param str content_type: Content-Type of the response
+    :return bool: result
+    """
+    if not content_type:
+        return False
+    content_type = content_type.strip().lower()
+    return content_type.startswith(tuple(settings.request_binary_types))
+
+
+def trim_partial_char(content):
+    """
+    Trim the incomplete utf-8 character at the end of the truncated content
+    """
+    for i in range(1, min(4, len(content)) + 1):
+        byte = content[-i]
+        if byte & 0xC0 != 0x80:  # 找到字符的起始字节
+            need = 1
+            if byte >= 0xF0:
+                need = 4
+            elif byte >= 0xE0:
+                need = 3
+            elif byte >= 0xC0:
+                need = 2
+            if need > i:
+                return content[:-i]
+            break
+    return content
+
+
 def decode_resp_text(resp):
     content = resp.content
     if not content:
         return str('')
+    if getattr(resp, 'truncated', False):
+        content = trim_partial_char(content)
     try:
         # 先尝试用utf-8严格解码
         content = str(content, encoding='utf-8', errors='strict')
@@ -748,9 +820,9 @@ def looks_like_ip(maybe_ip):
 
 
 def deal_data(domain):
+    # 子域在保存时已按子域和端口去重
     db = Database()
     db.remove_invalid(domain)
-    db.deduplicate_subdomain(domain)
     db.close()
 
 
@@ -761,13 +833,21 @@ def get_data(domain):
     return data
 
 
+def get_data_by_fields(domain, fields):
+    db = Database()
+    data = db.get_data_by_fields(domain, fields).as_dict()
+    db.close()
+    return data
+
+
 def clear_data(domain):
+    # 只清空数据 保留索引和子域来源表
     db = Database()
-    db.drop_table(domain)
+    db.clear_table(domain)
     db.close()
 
 
-def get_ns_path(in_china=None, enable_wildcard=None, ns_ip_list=None):
+def get_ns_path(in_china=None, enable_wildcard=None, ns_ip_list=None, domain=None):
     data_dir = settings.data_storage_dir
     path = data_dir.joinpath('nameservers.txt')
     if in_china:
@@ -777,6 +857,9 @@ def get_ns_path(in_china=None, enable_wildcard=None, ns_ip_list=None):
     if not ns_ip_list:
         return path
     path = settings.authoritative_dns_path
+    if domain:
+        # 多个目标同时爆破时各自使用自己的权威名称服务器文件
+        path = path.with_name(f'{path.stem}_{domain}{path.suffix}')
     ns_data = '\n'.join(ns_ip_list)
     save_to_file(path, ns_data)
     return path
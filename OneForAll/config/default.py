@@ -32,10 +32,28 @@ enable_takeover_check = False  # 开启子域接管风险检查(默认False)
 http_request_port = 'small'  # HTTP请求子域(默认 'small'，探测80,443端口)
 # 参数可选值True，False分别表示导出存活，全部子域结果
 result_export_alive = False  # 只导出存活的子域结果(默认False)
-# 参数可选格式有 'csv', 'json'
+# 参数可选格式有 'csv', 'json', 'ndjson'(每行一个JSON对象)
 result_save_format = 'csv'  # 子域结果保存文件格式(默认csv)
+result_save_compress = False  # 用gzip压缩导出的结果文件，文件名加.gz后缀(默认False)
 # 参数path默认None使用OneForAll结果目录自动生成路径
 result_save_path = None  # 子域结果保存文件路径(默认None)
+# 流水线模式下收集到的子域会边收集边解析边请求，不再等待上一阶段全部结束
+enable_stream_pipeline = False  # 使用流式流水线模式(默认False)
+pipeline_queue_size = 10000  # 流水线各阶段队列容量(默认10000)
+pipeline_batch_size = 1000  # 流水线各阶段每批处理数量(默认1000)
+pipeline_flush_interval = 5.0  # 流水线各阶段未凑满一批时的最长等待秒数(默认5.0秒)
+# 多目标并行设置
+target_worker_num = 1  # 同时处理的目标数量(默认1，即逐个处理)
+global_dns_concurrent_num = 10000  # 所有目标共享的massdns并发查询总量(默认10000)
+global_request_thread_num = None  # 所有目标共享的请求线程总量(默认None，则与请求线程数量一致)
+global_request_async_num = 5000  # 所有目标共享的异步请求并发总量(默认5000)
+# 断点续扫设置
+enable_resume = False  # 从上次中断处继续(默认False)
+# 增量扫描设置
+enable_incremental_scan = False  # 保留上次结果 只重新解析和请求发生变化的子域(默认False)
+incremental_request_max_age = 86400  # 上次请求结果的最长复用秒数(默认86400秒)
+# 进度条设置
+progress_interval = 0.5  # 进度条最短刷新间隔秒数(默认0.5秒)
 
 # 收集模块设置
 save_module_result = False  # 保存各模块发现结果为json文件(默认False)
@@ -44,15 +62,26 @@ enable_partial_module = []  # 启用部分收集模块 必须禁用enable_all_mo
 # 只使用ask和baidu搜索引擎收集子域的示例
 # enable_partial_module = ['modules.search.ask', 'modules.search.baidu']
 module_thread_timeout = 90.0  # 每个收集模块线程超时时间(默认90秒)
+collect_deadline = None  # 收集阶段总超时秒数 超时后未完成的模块将被取消并丢弃之后的结果(默认None，不限制)
+collect_concurrent_num = 30  # 同时运行的收集模块数量(默认30)
+# 按模块类别限制同时运行的收集模块数量 未设置的类别只受collect_concurrent_num限制
+collect_source_limit = {'search': 10}
 
 # 爆破模块设置
 enable_wildcard_check = True  # 开启泛解析检测(默认True)
 enable_wildcard_deal = True  # 开启泛解析处理(默认True)
 brute_massdns_path = None  # 默认None自动选择 如需填写请填写绝对路径
+# 子域解析引擎(默认'auto'，有可用的massdns则使用massdns，否则使用内置引擎，可选'massdns'，'builtin')
+dns_resolve_engine = 'auto'
+dns_query_timeout = 2.0  # 内置解析引擎每次查询等待响应的秒数(默认2.0秒)
 brute_status_format = 'ansi'  # 爆破时状态输出格式（默认asni，可选json）
 brute_concurrent_num = 2000  # 并发查询数量(默认2000，最大推荐10000)
 brute_socket_num = 1  # 爆破时每个进程下的socket数量
 brute_resolve_num = 15  # 解析失败时尝试换名称服务器重查次数
+brute_chunk_size = 200000  # 爆破字典分块大小 每块完成后记录进度 中断后可从未完成的块继续(默认200000)
+brute_memory_rows = 500000  # 处理爆破结果时内存中保留的候选记录数量 超过后写入临时文件(默认500000)
+brute_dedup_error_rate = 0.0001  # 爆破字典去重使用的布隆过滤器误判率(默认0.0001)
+brute_dedup_capacity = 20000000  # 布隆过滤器最大容量 约占用48MB内存 字典更大时分块去重(默认20000000)
 # 爆破所使用的字典路径(默认None则使用data/subdomains.txt，自定义字典请使用绝对路径)
 brute_wordlist_path = None
 use_china_nameservers = True  # 使用中国域名服务器 如果你所在网络不在中国则建议设置False
@@ -99,11 +128,38 @@ request_proxy_pool = [{'http': 'http://127.0.0.1:1080',
 
 
 # 请求设置
+# HTTP请求引擎(默认'async'，可选'thread'，开启代理时使用'thread')
+request_engine = 'async'
 request_thread_count = None  # 请求线程数量(默认None，则根据情况自动设置)
+request_async_concurrent_num = 1000  # 异步请求引擎同时请求数量(默认1000)
+request_per_host_num = 8  # 异步请求引擎对同一IP的同时请求数量(默认8)
 request_timeout_second = (13, 27)  # 请求超时秒数(默认connect timout推荐略大于3秒)
 request_ssl_verify = False  # 请求SSL验证(默认False)
 request_allow_redirect = True  # 请求允许重定向(默认True)
 request_redirect_limit = 10  # 请求跳转限制(默认10次)
+# 自适应并发(AIMD)：无拥塞时逐步增加并发，近期超时或过载比例过高时按比例减少并发
+enable_request_adaptive = True  # 按全局、IP和ASN自适应调整请求并发(默认True)
+request_adaptive_min_num = 10  # 自适应全局并发下限(默认10)
+request_adaptive_asn_num = 64  # 同一ASN的并发上限(默认64，为0则不按ASN限制)
+request_adaptive_timeout_rate = 0.3  # 近期超时或过载比例达到该值时减少并发(默认0.3)
+request_adaptive_decrease = 0.5  # 减少并发时的乘数(默认0.5)
+request_adaptive_latency_factor = 3.0  # 连接延迟超过最小延迟的倍数时不再增加并发(默认3.0)
+request_max_body_size = 1048576  # 保存响应体的最大字节数，超过部分不再读取(默认1MB)
+# 不读取响应体的二进制内容类型前缀
+request_binary_types = ['image/', 'audio/', 'video/', 'font/', 'application/octet-stream',
+                        'application/zip', 'application/gzip', 'application/pdf',
+                        'application/x-tar', 'application/x-rar', 'application/x-7z',
+                        'application/x-iso9660', 'application/x-msdownload',
+                        'application/x-shockwave-flash', 'application/vnd.ms-',
+                        'application/vnd.openxmlformats', 'application/msword']
+# 响应体按哈希压缩后只保存一份，结果表只记录body_hash
+enable_response_store = False  # 开启响应体去重存储 开启后结果表response字段为空 响应体压缩保存在response_blob表中(默认False，在response字段中保存完整响应体)
+response_compress_level = 6  # 响应体zlib压缩级别(默认6)
+response_memo_num = 10000  # 按响应体哈希缓存标题的数量(默认10000)
+# 请求结果分批在一个事务中写入数据库，满一批或等待超时后写入
+request_save_batch_size = 1000  # 每批写入的请求结果数量(默认1000)
+request_save_interval = 2.0  # 一批请求结果的最长等待秒数(默认2.0秒)
+request_title_process_num = 1  # 保存请求结果时提取标题的进程数(默认1，即在保存线程中提取，需开启enable_response_store)
 # 默认请求头 可以在headers里添加自定义请求头
 request_default_headers = {
     'Accept': 'text/html,application/xhtml+xml,'
@@ -119,6 +175,9 @@ request_default_headers = {
     'X-Forwarded-For': '127.0.0.1'
 }
 enable_random_ua = True  # 使用随机UA(默认True，开启可以覆盖request_default_headers的UA)
+# 收集模块共享的长连接池设置
+http_pool_host_num = 100  # 缓存连接池的主机数量(默认100)
+http_pool_max_size = 10  # 每个主机连接池保持的最大连接数量(默认10)
 
 # 搜索模块设置
 # 开启全量搜索会尽量去获取搜索引擎搜索的全部结果，不过搜索耗时可能会过长
@@ -136,6 +195,11 @@ resolver_nameservers = [
 ]  # 指定查询的DNS域名服务器
 resolver_timeout = 5.0  # 解析超时时间(默认5.0秒)
 resolver_lifetime = 10.0  # 解析存活时间(默认10.0秒)
+enable_dns_cache = True  # 各解析阶段共享遵循TTL的DNS缓存(默认True)
+dns_cache_path = None  # DNS缓存的SQLite数据库路径(默认None，只缓存在内存中)
+dns_cache_size = 100000  # 内存中缓存的DNS应答和子域解析结果数量 超过后淘汰最久未使用的(默认100000)
+dns_cache_negative_ttl = 300  # 没有解析结果的缓存秒数(默认300秒)
+dns_cache_max_ttl = 86400  # 最长缓存秒数(默认86400秒)
 
 # 请求端口探测设置
 # 你可以在端口列表添加自定义端口
@@ -160,6 +224,18 @@ large_ports = [80, 81, 280, 300, 443, 591, 593, 832, 888, 901, 981, 1010, 1080,
                10880, 11371, 12043, 12046, 12443, 15672, 16225, 16080, 18091,
                18092, 20000, 20720, 24465, 28017, 28080, 30821, 43110, 61600]
 ports = {'small': small_ports, 'medium': medium_ports, 'large': large_ports}
+# 请求端口较多时先用TCP连接按IP:端口预检 只请求开放端口的URL
+enable_port_preflight = True  # 开启端口预检(默认True，使用代理时不预检)
+port_preflight_min_num = 3  # 请求端口数量达到该值才预检(默认3，即small端口范围不预检)
+port_preflight_concurrent_num = 2000  # 端口预检同时连接数量(默认2000)
+port_preflight_timeout = 3.0  # 端口预检连接超时秒数(默认3.0秒)
+port_preflight_tries = 2  # 端口预检超时的重试次数(默认2次)
+# 同一IP:端口上的子域共享可达性 已确认不可达的端点不再请求
+enable_reachability_cache = True  # 开启端点可达性缓存(默认True，使用代理时不开启)
+reachability_fail_num = 2  # 端点连接超时或不可达的次数达到该值视为不可达(默认2次，连接被拒绝立即视为不可达)
+# 非80和443端口用TLS ClientHello嗅探端点使用https还是http，不再只按端口号是否以443结尾猜测
+enable_scheme_sniff = True  # 开启协议嗅探(默认True，使用代理时不嗅探)
+scheme_sniff_timeout = 3.0  # 协议嗅探等待回应的秒数(默认3.0秒，超时则按端口号猜测)
 
 common_subnames = {'i', 'w', 'm', 'en', 'us', 'zh', 'w3', 'app', 'bbs',
                    'web', 'www', 'job', 'docs', 'news', 'blog', 'data',
@@ -10,12 +10,13 @@ OneForAll export from database module
 
 import fire
 
-from common import utils
+from common import exporter, utils
 from common.database import Database
 from config.log import logger
 
 
-def export_data(target, db=None, alive=False, limit=None, path=None, fmt='csv', show=False):
+def export_data(target, db=None, alive=False, limit=None, path=None, fmt='csv', show=False,
+                compress=None, keep=True):
     """
     OneForAll export from database module
 
@@ -23,22 +24,28 @@ def export_data(target, db=None, alive=False, limit=None, path=None, fmt='csv',
         python3 export.py --target name --fmt csv --dir= ./result.csv
         python3 export.py --target name --tb True --show False
         python3 export.py --db result.db --target name --show False
+        python3 export.py --target name --fmt ndjson --compress True --keep False
 
     Note:
-        --fmt csv/json (result format)
+        --fmt csv/json/ndjson (result format)
         --path   Result directory (default directory is ./results)
 
-    :param str  target:  Table to be exported
-    :param str  db:      Database path to be exported (default ./results/result.sqlite3)
-    :param bool alive:   Only export the results of alive subdomains (default False)
-    :param str  limit:   Export limit (default None)
-    :param str  fmt:     Result format (default csv)
-    :param str  path:    Result directory (default None)
-    :param bool show:    Displays the exported data in terminal (default False)
+    :param str  target:   Table to be exported
+    :param str  db:       Database path to be exported (default ./results/result.sqlite3)
+    :param bool alive:    Only export the results of alive subdomains (default False)
+    :param str  limit:    Export limit (default None)
+    :param str  fmt:      Result format (default csv)
+    :param str  path:     Result directory (default None)
+    :param bool show:     Displays the exported data in terminal (default False)
+    :param bool compress: Compress the result file with gzip (default result_save_compress)
+    :param bool keep:     Return the exported data (default True), rows are only
+                          streamed into the file when False
     """
 
     database = Database(db)
     domains = utils.get_domains(target)
+    # 多个目标还要导出汇总结果 需要保留数据
+    keep = keep or len(domains) > 1
     datas = list()
     if domains:
         for domain in domains:
@@ -46,27 +53,34 @@ def export_data(target, db=None, alive=False, limit=None, path=None, fmt='csv',
             rows = database.export_data(table_name, alive, limit)
             if rows is None:
                 continue
-            data, _, _ = do_export(fmt, path, rows, show, domain, target)
+            data, _, _ = do_export(fmt, path, rows, show, domain, target, compress, keep)
             datas.extend(data)
     database.close()
     if len(domains) > 1:
-        utils.export_all(alive, fmt, path, datas)
+        utils.export_all(alive, fmt, path, datas, compress)
     return datas
 
 
-def do_export(fmt, path, rows, show, domain, target):
+def do_export(fmt, path, rows, show, domain, target, compress=None, keep=True):
     fmt = utils.check_format(fmt)
-    path = utils.check_path(path, target, fmt)
+    path = exporter.get_path(utils.check_path(path, target, fmt), compress)
     if show:
         print(rows.dataset)
-    data = rows.export(fmt)
-    if fmt == 'csv':
-        data = '\ufeff' + data
-    utils.save_to_file(path, data)
-    logger.log('ALERT', f'The subdomain result for {domain}: {path}')
-    data = rows.as_dict()
+    data = list()
+    keys = rows.keys
+    stream = rows.stream()
+    if keep:
+        stream = gen_kept(stream, keys, data)
+    count = exporter.export_rows(path, fmt, keys, stream)
+    logger.log('ALERT', f'The subdomain result for {domain}: {path} ({count} rows)')
     return data, fmt, path
 
 
+def gen_kept(rows, keys, data):
+    for row in rows:
+        data.append(dict(zip(keys, row)))
+        yield row
+
+
 if __name__ == '__main__':
     fire.Fire(export_data)
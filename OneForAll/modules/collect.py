@@ -1,15 +1,29 @@
-import threading
+import asyncio
 import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from common import client
+from common.module import cancelled
 from config.log import logger
 from config import settings
 
 
 class Collect(object):
-    def __init__(self, domain):
+    """
+    Subdomain collection of a domain
+
+    :param str domain: main domain
+    :param Journal journal: run journal, finished modules are skipped when resuming
+    """
+    def __init__(self, domain, journal=None):
         self.domain = domain
+        self.journal = journal
         self.modules = []
         self.collect_funcs = []
+        self.executor = None
+        self.lock = threading.Lock()
+        self.threads = dict()  # {模块路径: 运行该模块的线程}
 
     def get_mod(self):
         """
@@ -31,11 +45,101 @@ class Collect(object):
         """
         Import do function
         """
-        for module in self.modules:
-            name = module.split('.')[-1]
-            import_object = importlib.import_module(module)
+        done = self.journal.done('module') if self.journal else dict()
+        for name in self.modules:
+            # 不同类别下有同名模块 以完整模块路径区分
+            parts = name.split('.')
+            category = parts[-2] if len(parts) > 2 else parts[-1]
+            if name in done:
+                logger.log('INFOR', f'Resume: skip the finished {name} module')
+                continue
+            import_object = importlib.import_module(name)
             func = getattr(import_object, 'run')
-            self.collect_funcs.append([func, name])
+            self.collect_funcs.append([func, name, category])
+
+    def call(self, func, name):
+        """
+        Run a blocking module entrance in a worker thread of the pool
+        """
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads[name] = ident
+        try:
+            result = func(self.domain)
+        finally:
+            with self.lock:
+                self.threads.pop(name, None)
+                stopped = ident in cancelled
+                cancelled.discard(ident)
+        if self.journal and not stopped:  # 被取消的模块结果不完整 续扫时重新运行
+            self.journal.mark('module', name)
+        return result
+
+    def cancel(self, name):
+        """
+        Cancel a running module, the module stops at its next request
+        """
+        with self.lock:
+            ident = self.threads.get(name)
+            if ident is not None:
+                cancelled.add(ident)
+
+    async def run_func(self, func, name, semaphores):
+        """
+        Run one collection module in the thread pool under the concurrency limits
+
+        :param func: module entrance
+        :param str name: module name
+        :param list semaphores: concurrency limits to be acquired
+        """
+        for semaphore in semaphores:
+            await semaphore.acquire()
+        future = self.executor.submit(self.call, func, name)
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(future),
+                                   settings.module_thread_timeout)
+        except asyncio.TimeoutError:
+            logger.log('ALERT', f'{name} module timed out')
+            self.cancel(name)
+            # 模块结束后才释放并发名额
+            await asyncio.wait([asyncio.wrap_future(future)])
+        except asyncio.CancelledError:
+            self.cancel(name)
+            raise
+        except Exception as e:
+            logger.log('ERROR', e.args)
+            logger.log('ERROR', f'{name} module error')
+        finally:
+            for semaphore in semaphores:
+                semaphore.release()
+
+    async def collect(self):
+        """
+        Run all collection modules with a global deadline, the modules that
+        have not finished by the deadline are cancelled
+        """
+        total = asyncio.Semaphore(settings.collect_concurrent_num)
+        limits = dict()
+        tasks = dict()
+        for func, name, category in self.collect_funcs:
+            semaphores = [total]
+            limit = settings.collect_source_limit.get(category)
+            if limit:
+                if category not in limits:
+                    limits[category] = asyncio.Semaphore(limit)
+                semaphores.append(limits[category])
+            task = asyncio.ensure_future(self.run_func(func, name, semaphores))
+            tasks[task] = name
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=settings.collect_deadline)
+        for task in pending:
+            # 线程无法强制终止 运行中的模块在下一次请求时停止
+            logger.log('ALERT', f'{tasks[task]} module was cancelled '
+                                f'because the collection deadline was reached')
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
 
     def run(self):
         """
@@ -44,25 +148,17 @@ class Collect(object):
         logger.log('INFOR', f'Start collecting subdomains of {self.domain}')
         self.get_mod()
         self.import_func()
-
-        threads = []
-        # Create subdomain collection threads
-        for func_obj, func_name in self.collect_funcs:
-            thread = threading.Thread(target=func_obj, name=func_name,
-                                      args=(self.domain,), daemon=True)
-            threads.append(thread)
-        # Start all threads
-        for thread in threads:
-            thread.start()
-        # Wait for all threads to finish
-        for thread in threads:
-            # 挨个线程判断超时 最坏情况主线程阻塞时间=线程数*module_thread_timeout
-            # 超时线程将脱离主线程 由于创建线程时已添加守护属于 所有超时线程会随着主线程结束
-            thread.join(settings.module_thread_timeout)
-
-        for thread in threads:
-            if thread.is_alive():
-                logger.log('ALERT', f'{thread.name} module thread timed out')
+        # 总并发由信号量限制 线程池大小与之相同
+        self.executor = ThreadPoolExecutor(settings.collect_concurrent_num,
+                                           thread_name_prefix='collect')
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.collect())
+        finally:
+            loop.close()
+            # 等待被取消的模块结束 不留下仍在运行的线程
+            self.executor.shutdown(wait=True)
+        client.log_stats()
 
 
 if __name__ == '__main__':
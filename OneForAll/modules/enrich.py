@@ -57,12 +57,8 @@ class Enrich(object):
 
     def save_db(self, data):
         db = Database()
-        for info in data:
-            url = info.pop('url')
-            info.pop('cname')
-            info.pop('ip')
-            info.pop('header')
-            db.update_data_by_url(self.domain, info, url)
+        fields = ['public', 'cdn', 'cidr', 'asn', 'org', 'addr', 'isp']
+        db.update_data_by_urls(self.domain, data, fields)
         db.close()
 
     def run(self):
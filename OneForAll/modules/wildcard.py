@@ -4,7 +4,7 @@ import tenacity
 from dns.exception import Timeout
 from dns.resolver import NXDOMAIN, YXDOMAIN, NoAnswer, NoNameservers
 
-from common import utils
+from common import utils, dnscache
 from config import settings
 from common import similarity
 from config.log import logger
@@ -116,7 +116,14 @@ def to_detect_wildcard(domain):
 
 
 def detect_wildcard(domain):
+    now = utils.get_timestamp()
+    cached = dnscache.wildcard_cache.get(domain)
+    if settings.enable_dns_cache and cached and cached[0] > now:
+        logger.log('DEBUG', f'Use the cached wildcard detection result of {domain}')
+        return cached[1]
     is_enable = to_detect_wildcard(domain)
+    expire = now + min(settings.dns_cache_negative_ttl, settings.dns_cache_max_ttl)
+    dnscache.wildcard_cache[domain] = (expire, is_enable)
     if is_enable:
         logger.log('ALERT', f'The domain {domain} enables wildcard')
     else:
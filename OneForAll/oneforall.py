@@ -8,13 +8,19 @@ OneForAll is a powerful subdomain integration tool
 :license: GNU General Public License v3.0, see LICENSE for more details.
 """
 
+import copy
 import fire
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 import export
 from brute import Brute
 from common import utils, resolve, request
+from common.pipeline import Pipeline
+from common.budget import dns_budget, http_budget
+from common.journal import Journal
+from common.incremental import Incremental
 from modules.collect import Collect
 from modules.srv import BruteSRV
 from modules.finder import Finder
@@ -65,10 +71,14 @@ class OneForAll(object):
         python3 oneforall.py --target example.com --req False run
         python3 oneforall.py --target example.com --takeover False run
         python3 oneforall.py --target example.com --show True run
+        python3 oneforall.py --target example.com --stream True run
+        python3 oneforall.py --targets ./domains.txt --workers 4 run
+        python3 oneforall.py --targets ./domains.txt --resume True run
+        python3 oneforall.py --targets ./domains.txt --incremental True run
 
     Note:
         --port   small/medium/large  See details in ./config/setting.py(default small)
-        --fmt    csv/json (result format)
+        --fmt    csv/json/ndjson (result format)
         --path   Result path (default None, automatically generated)
 
     :param str  target:     One domain (target or targets must be provided)
@@ -81,9 +91,14 @@ class OneForAll(object):
     :param str  fmt:        Result format (default csv)
     :param str  path:       Result path (default None, automatically generated)
     :param bool takeover:   Scan subdomain takeover (default False)
+    :param bool stream:     Use streaming pipeline mode (default False)
+    :param int  workers:    Number of targets processed at the same time (default 1)
+    :param bool resume:     Resume the interrupted run (default False)
+    :param bool incremental: Only re-resolve and re-request what changed (default False)
     """
     def __init__(self, target=None, targets=None, brute=None, dns=None, req=None,
-                 port=None, alive=None, fmt=None, path=None, takeover=None):
+                 port=None, alive=None, fmt=None, path=None, takeover=None,
+                 stream=None, workers=None, resume=None, incremental=None):
         self.target = target
         self.targets = targets
         self.brute = brute
@@ -94,6 +109,12 @@ class OneForAll(object):
         self.fmt = fmt
         self.path = path
         self.takeover = takeover
+        self.stream = stream
+        self.workers = workers
+        self.resume = resume
+        self.journal = None  # The run journal of the current domain
+        self.incremental = incremental
+        self.increment = None  # The incremental re-scan of the current domain
         self.domain = str()  # The domain currently being collected
         self.domains = set()  # All domains that are to be collected
         self.data = list()  # The subdomain results of the current domain
@@ -121,6 +142,14 @@ class OneForAll(object):
             self.fmt = settings.result_save_format
         if self.path is None:
             self.path = settings.result_save_path
+        if self.stream is None:
+            self.stream = bool(settings.enable_stream_pipeline)
+        if self.workers is None:
+            self.workers = settings.target_worker_num
+        if self.resume is None:
+            self.resume = bool(settings.enable_resume)
+        if self.incremental is None:
+            self.incremental = bool(settings.enable_incremental_scan)
 
     def check_param(self):
         """
@@ -129,6 +158,10 @@ class OneForAll(object):
         if self.target is None and self.targets is None:
             logger.log('FATAL', 'You must provide either target or targets parameter')
             exit(1)
+        if self.stream and (self.resume or self.incremental):
+            logger.log('FATAL', 'The streaming pipeline mode does not support '
+                                'resume or incremental, disable stream to use them')
+            exit(1)
 
     def export_data(self):
         """
@@ -139,89 +172,226 @@ class OneForAll(object):
         """
         return export.export_data(self.domain, alive=self.alive, fmt=self.fmt, path=self.path)
 
-    def main(self):
+    def collect(self):
         """
-        OneForAll main process
-
-        :return: subdomain results
-        :rtype: list
+        Collect subdomains by collection, SRV brute and brute modules
         """
-        utils.init_table(self.domain)
-
         if not self.access_internet:
             logger.log('ALERT', 'Because it cannot access the Internet, '
                                 'OneForAll will not execute the subdomain collection module!')
         if self.access_internet:
-            self.enable_wildcard = wildcard.detect_wildcard(self.domain)
-
-            collect = Collect(self.domain)
+            collect = Collect(self.domain, self.journal)
             collect.run()
 
-        srv = BruteSRV(self.domain)
-        srv.run()
+        if not self.journal.finished('srv'):
+            srv = BruteSRV(self.domain)
+            srv.run()
+            self.journal.finish('srv')
 
-        if self.brute:
+        # 爆破完成后记录在本日志中 续扫时不再重新爆破
+        if self.brute and not self.journal.finished('brute'):
             # Due to there will be a large number of dns resolution requests,
             # may cause other network tasks to be error
-            brute = Brute(self.domain, word=True, export=False)
+            brute = Brute(self.domain, word=True, export=False, resume=self.journal.resume)
             brute.enable_wildcard = self.enable_wildcard
             brute.quite = True
             brute.run()
+            self.journal.finish('brute')
 
-        utils.deal_data(self.domain)
-        # Export results without resolve
-        if not self.dns:
-            self.data = self.export_data()
-            self.datas.extend(self.data)
-            return self.data
-
-        self.data = utils.get_data(self.domain)
-
-        # Resolve subdomains
-        utils.clear_data(self.domain)
-        self.data = resolve.run_resolve(self.domain, self.data)
-        # Save resolve results
-        resolve.save_db(self.domain, self.data)
-
-        # Export results without HTTP request
-        if not self.req:
-            self.data = self.export_data()
-            self.datas.extend(self.data)
-            return self.data
-
-        if self.enable_wildcard:
-            # deal wildcard
-            self.data = wildcard.deal_wildcard(self.data)
-
-        # HTTP request
-        utils.clear_data(self.domain)
-        request.run_request(self.domain, self.data, self.port)
-
+    def discover(self):
+        """
+        Discover new subdomains from existing results by finder and altdns modules
+        """
         # Finder module
-        if settings.enable_finder_module:
+        if settings.enable_finder_module and not self.journal.finished('finder'):
             finder = Finder()
             finder.run(self.domain, self.data, self.port)
+            self.journal.finish('finder')
 
         # altdns module
-        if settings.enable_altdns_module:
+        if settings.enable_altdns_module and not self.journal.finished('altdns'):
             altdns = Altdns(self.domain)
             altdns.run(self.data, self.port)
+            self.journal.finish('altdns')
 
         # Information enrichment module
-        if settings.enable_enrich_module:
+        if settings.enable_enrich_module and not self.journal.finished('enrich'):
             enrich = Enrich(self.domain)
             enrich.run()
+            self.journal.finish('enrich')
 
+    def finish(self):
+        """
+        Export results and scan subdomain takeover
+
+        :return: subdomain results
+        :rtype: list
+        """
+        if self.increment:
+            self.increment.mark_gone()
         self.data = self.export_data()
         self.datas.extend(self.data)
 
         # Scan subdomain takeover
         if self.takeover:
             subdomains = utils.get_subdomains(self.data)
-            takeover = Takeover(targets=subdomains)
+            takeover = Takeover(targets=subdomains, use_saved=True)
             takeover.run()
+        self.journal.finish('done')
         return self.data
 
+    def stream_main(self):
+        """
+        OneForAll streaming pipeline process
+
+        Subdomains are resolved and requested as soon as they are collected,
+        results are written into the database incrementally by the pipeline.
+
+        :return: subdomain results
+        :rtype: list
+        """
+        utils.init_table(self.domain)
+        if self.access_internet:
+            self.enable_wildcard = wildcard.detect_wildcard(self.domain)
+        pipeline = Pipeline(self.domain, dns=self.dns, req=self.req,
+                            port=self.port, wildcard=self.enable_wildcard)
+        pipeline.start()
+        self.collect()
+        pipeline.join()
+
+        if not (self.dns and self.req):
+            self.data = self.export_data()
+            self.datas.extend(self.data)
+            self.journal.finish('done')
+            return self.data
+
+        # Finder and altdns only need these fields, do not load response into memory
+        fields = ['subdomain', 'url', 'history']
+        self.data = utils.get_data_by_fields(self.domain, fields)
+        self.discover()
+        return self.finish()
+
+    def main(self):
+        """
+        OneForAll main process
+
+        :return: subdomain results
+        :rtype: list
+        """
+        self.journal = Journal(self.domain, 'oneforall', self.resume)
+        if self.stream:
+            return self.stream_main()
+
+        self.increment = None
+        if self.incremental and self.dns:
+            self.increment = Incremental(self.domain)
+
+        if not self.journal.finished('collect'):
+            # Keep the results saved by finished modules when resuming
+            if not self.journal.began('collect'):
+                if self.increment:
+                    self.increment.backup()
+                utils.init_table(self.domain)
+            self.journal.begin('collect')
+            if self.access_internet:
+                self.enable_wildcard = wildcard.detect_wildcard(self.domain)
+            self.collect()
+            self.journal.finish('collect', self.enable_wildcard)
+        else:
+            self.enable_wildcard = self.journal.value('collect')
+
+        if not self.journal.finished('resolve'):
+            utils.deal_data(self.domain)
+            # Export results without resolve
+            if not self.dns:
+                self.data = self.export_data()
+                self.datas.extend(self.data)
+                self.journal.finish('done')
+                return self.data
+
+            self.data = utils.get_data(self.domain)
+            if self.increment:
+                self.data = self.increment.reuse_resolve(self.data)
+
+            # Resolve subdomains
+            utils.clear_data(self.domain)
+            self.data = resolve.run_resolve(self.domain, self.data)
+            if self.increment:
+                self.data = self.increment.mark_change(self.data)
+            # Save resolve results
+            resolve.save_db(self.domain, self.data)
+            # The table will be cleared by HTTP request, keep a checkpoint
+            if self.req:
+                self.journal.save_data(self.data)
+            self.journal.finish('resolve')
+        elif self.req:
+            self.data = self.journal.load_data()
+
+        # Export results without HTTP request
+        if not self.req:
+            if self.increment:
+                self.increment.mark_gone()
+            self.data = self.export_data()
+            self.datas.extend(self.data)
+            self.journal.finish('done')
+            return self.data
+
+        if self.enable_wildcard:
+            # deal wildcard
+            self.data = wildcard.deal_wildcard(self.data)
+
+        # HTTP request
+        if not self.journal.finished('request'):
+            resume = self.journal.began('request')
+            if not resume:
+                utils.clear_data(self.domain)
+            self.journal.begin('request')
+            request.run_request(self.domain, self.data, self.port,
+                                resume=resume, incremental=self.increment)
+            self.journal.finish('request')
+
+        self.discover()
+        return self.finish()
+
+    def spawn(self, domain):
+        """
+        Run main process of one target in a separate OneForAll worker
+
+        :param str domain: target domain
+        :return: subdomain results
+        :rtype: list
+        """
+        worker = copy.copy(self)
+        worker.domain = utils.get_main_domain(domain)
+        worker.data = list()
+        worker.datas = list()
+        worker.enable_wildcard = False
+        return worker.main()
+
+    def schedule(self):
+        """
+        Run multiple targets at the same time
+
+        All targets share the global DNS and HTTP concurrency budgets.
+        """
+        workers = min(self.workers, len(self.domains))
+        logger.log('INFOR', f'Running {workers} targets at the same time')
+        dns_budget.share(workers)
+        http_budget.share(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.spawn, domain): domain
+                       for domain in self.domains}
+            for future in as_completed(futures):
+                domain = futures[future]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    logger.log('ERROR', e.args)
+                    logger.log('ERROR', f'Error occurred while processing {domain}')
+                    continue
+                self.datas.extend(data)
+                logger.log('INFOR', f'Finished processing {domain}')
+
     def run(self):
         """
         OneForAll running entrance
@@ -247,9 +417,12 @@ class OneForAll(object):
         if not count:
             logger.log('FATAL', 'Failed to obtain domain')
             exit(1)
-        for domain in self.domains:
-            self.domain = utils.get_main_domain(domain)
-            self.main()
+        if self.workers > 1 and count > 1:
+            self.schedule()
+        else:
+            for domain in self.domains:
+                self.domain = utils.get_main_domain(domain)
+                self.main()
         if count > 1:
             utils.export_all(self.alive, self.fmt, self.path, self.datas)
         logger.log('INFOR', 'Finished OneForAll')
@@ -9,17 +9,18 @@ OneForAll subdomain takeover module
 """
 import time
 import json
-from threading import Thread
-from queue import Queue
+from threading import Thread, Lock
+from queue import Queue, Empty
 
 import fire
 from common.tablib.tablib import Dataset
-from tqdm import tqdm
 
 from config.log import logger
 from config import settings
 from common import utils
+from common.database import Database
 from common.module import Module
+from common.progress import Progress
 
 
 def get_fingerprint():
@@ -57,9 +58,12 @@ class Takeover(Module):
     :param int thread:   threads number (default 20)
     :param str fmt:      Result format (default csv)
     :param str path:     Result directory (default None)
+    :param bool use_saved: Read the responses saved by OneForAll instead of
+                           requesting again (default False)
     """
 
-    def __init__(self, target=None, targets=None, thread=20, path=None, fmt='csv'):
+    def __init__(self, target=None, targets=None, thread=20, path=None, fmt='csv',
+                 use_saved=False):
         Module.__init__(self)
         self.subdomains = set()
         self.module = 'Check'
@@ -69,10 +73,14 @@ class Takeover(Module):
         self.thread = thread
         self.path = path
         self.fmt = fmt
+        self.use_saved = use_saved
         self.fingerprints = None
         self.queue = Queue()  # subdomain queue
         self.cnames = list()
         self.results = Dataset()
+        self.lock = Lock()
+        self.hashes = dict()  # {url: 已保存响应体的哈希}
+        self.texts = dict()  # {body_hash: 响应体文本}
 
     def save(self):
         logger.log('DEBUG', 'Saving results')
@@ -82,14 +90,52 @@ class Takeover(Module):
             data = self.results.export(self.fmt)
         utils.save_to_file(self.path, data)
 
+    def load_hashes(self):
+        """
+        Load the body hash of the saved responses of the subdomains, these
+        responses are read from the response store instead of requested again
+        """
+        db = Database()
+        tables = {utils.get_main_domain(subdomain) for subdomain in self.subdomains}
+        for table in filter(None, tables):
+            if not db.exist_table(table):
+                continue
+            db.add_missing_columns(table)
+            rows = db.get_data_by_fields(table, ['url', 'body_hash'])
+            if rows is None:
+                continue
+            for row in rows:
+                if row.body_hash:
+                    self.hashes[row.url] = row.body_hash
+        db.close()
+
+    def get_saved_text(self, url):
+        body_hash = self.hashes.get(url)
+        if not body_hash:
+            return None
+        with self.lock:
+            if body_hash not in self.texts:
+                db = Database()
+                self.texts[body_hash] = db.get_blob_text(body_hash)
+                db.close()
+            return self.texts[body_hash]
+
     def compare(self, subdomain, cname, responses):
-        domain_resp = self.get('http://' + subdomain, check=False, ignore=True)
+        domain_text = self.get_saved_text('http://' + subdomain)
+        if domain_text is None:
+            domain_resp = self.get('http://' + subdomain, check=False, ignore=True)
+            if domain_resp is None:
+                return
+            domain_text = domain_resp.text
+        responses = [resp for resp in responses if resp in domain_text]
+        if not responses:  # 子域的响应不匹配指纹时不用再请求CNAME
+            return
         cname_resp = self.get('http://' + cname, check=False, ignore=True)
-        if domain_resp is None or cname_resp is None:
+        if cname_resp is None:
             return
 
         for resp in responses:
-            if resp in domain_resp.text and resp in cname_resp.text:
+            if resp in cname_resp.text:
                 logger.log('ALERT', f'{subdomain} takeover threat found')
                 self.results.append([subdomain, cname])
                 break
@@ -106,23 +152,17 @@ class Takeover(Module):
             responses = fingerprint.get('response')
             self.compare(subdomain, cname, responses)
 
-    def check(self):
-        while not self.queue.empty():  # 保证域名队列遍历结束后能退出线程
-            subdomain = self.queue.get()  # 从队列中获取域名
-            self.worker(subdomain)
-            self.queue.task_done()
-
-    def progress(self):
-        bar = tqdm()
-        bar.total = len(self.subdomains)
-        bar.desc = 'Check Progress'
-        bar.ncols = 80
+    def check(self, progress):
         while True:
-            done = bar.total - self.queue.qsize()
-            bar.n = done
-            bar.update()
-            if done == bar.total:  # 完成队列中所有子域的检查退出
+            try:
+                subdomain = self.queue.get_nowait()  # 从队列中获取域名
+            except Empty:  # 保证域名队列遍历结束后能退出线程
                 break
+            try:
+                self.worker(subdomain)
+            finally:
+                progress.update()
+                self.queue.task_done()
 
     def run(self):
         start = time.time()
@@ -138,21 +178,22 @@ class Takeover(Module):
         if self.subdomains:
             logger.log('INFOR', f'Checking subdomain takeover')
             self.fingerprints = get_fingerprint()
+            if self.use_saved:
+                # 由OneForAll调用时子域刚请求过 直接读取保存的响应
+                self.load_hashes()
             self.results.headers = ['subdomain', 'cname']
             # 创建待检查的子域队列
             for domain in self.subdomains:
                 self.queue.put(domain)
-            # 进度线程
-            progress_thread = Thread(target=self.progress, name='ProgressThread',
-                                     daemon=True)
-            progress_thread.start()
+            progress = Progress('Check Progress', len(self.subdomains), 'subdomain')
             # 检查线程
             for i in range(self.thread):
                 check_thread = Thread(target=self.check, name=f'CheckThread{i}',
-                                      daemon=True)
+                                      args=(progress,), daemon=True)
                 check_thread.start()
 
             self.queue.join()
+            progress.close()
             self.save()
         else:
             logger.log('FATAL', f'Failed to obtain domain')
@@ -179,7 +179,7 @@ def search_db(sql: str) -> str:
     
     history: 请求时URL跳转历史
     
-    response: 响应体文本内容
+    response: 响应体文本内容(OneForAll开启enable_response_store时为空)
     
     times: 在爆破中ip重复出现的次数
     